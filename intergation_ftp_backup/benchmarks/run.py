@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""End to end benchmarks of the FTP backup against a local stand-in server.
+
+They flag and upload every File of the site, so only run them on a
+throwaway site with `allow_tests` set in its site_config.json:
+
+	bench --site bench.local execute intergation_ftp_backup.benchmarks.run.run \\
+		--kwargs "{'files': 2000, 'file_size': 65536, 'latency': 0.01, 'parallel_uploads': 4}"
+
+Prints one JSON object per phase: files/s, MB/s, control round trips and
+the peak RSS of the worker. The phases share one process and ru_maxrss
+never goes down, so `cumulative_peak_rss_kb` is the peak since the worker
+started, and `peak_rss_growth_kb` how far the phase raised it, 0 when it
+stayed below an earlier peak.
+"""
+
+from __future__ import unicode_literals
+import os
+import json
+import time
+import resource
+import frappe
+from frappe import _
+from frappe.utils import cint, flt, get_files_path
+from intergation_ftp_backup.benchmarks.server import StandInServer
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import get_ftp_client
+from intergation_ftp_backup.ftp_backup_intrgration.settings import clear_settings_cache
+from intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings import ftp_backup_settings as backup
+
+fixture_prefix = "ftp-bench-"
+settings_doctype = "FTP Backup Settings"
+
+def run(files=1000, file_size=64 * 1024, latency=0, bandwidth=0, parallel_uploads=1, tls=0,
+	backups=50, transport_backend="ftplib", output=None):
+	"""Time `upload_from_folder`, `delete_older_backups` and `backup_to_ftp`.
+
+	:param files: number of synthetic attachments
+	:param file_size: size of each attachment in bytes
+	:param latency: seconds the server waits before answering each control command
+	:param bandwidth: bytes per second cap on data transfers, 0 for none
+	:param parallel_uploads: FTP sessions used for file uploads
+	:param tls: run the stand-in server with FTPS
+	:param backups: number of database dumps the retention phase prunes
+	:param transport_backend: `ftplib` or `asyncio`
+	:param output: also append the results to this file"""
+	if not frappe.conf.allow_tests:
+		frappe.throw(_("Benchmarks upload every File of the site, set allow_tests on a throwaway site to run them"))
+
+	params = {
+		"files": cint(files),
+		"file_size": cint(file_size),
+		"latency": flt(latency),
+		"bandwidth": cint(bandwidth),
+		"parallel_uploads": cint(parallel_uploads),
+		"tls": cint(tls),
+		"backups": cint(backups),
+		"transport_backend": transport_backend
+	}
+
+	results = []
+	with StandInServer(latency=params["latency"], bandwidth=params["bandwidth"], tls=params["tls"]) as server:
+		previous_settings = use_stand_in_server(server, params)
+		file_names = make_file_fixtures(params["files"], params["file_size"])
+
+		try:
+			results.append(bench_upload_from_folder(server, params))
+			reset_upload_flags(file_names)
+
+			results.append(bench_delete_older_backups(server, params))
+			results.append(bench_backup_to_ftp(server))
+		finally:
+			drop_file_fixtures(file_names)
+			frappe.db.set_value(settings_doctype, None, previous_settings)
+			frappe.db.commit()
+			clear_settings_cache()
+
+	lines = [json.dumps(dict(result, params=params), sort_keys=True) for result in results]
+	if output:
+		with open(output, "a") as f:
+			f.write("\n".join(lines) + "\n")
+
+	print("\n".join(lines))
+	return results
+
+class Measurement(object):
+	def __init__(self, phase, server):
+		self.phase = phase
+		self.server = server
+
+	def __enter__(self):
+		self.server.reset_counters()
+		self.peak_rss_before = get_peak_rss()
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *args):
+		self.seconds = time.time() - self.start
+		self.commands = self.server.commands
+		self.peak_rss = get_peak_rss()
+
+	def result(self, files, size):
+		seconds = self.seconds or 1e-9
+		return {
+			"phase": self.phase,
+			"files": files,
+			"bytes": size,
+			"seconds": round(self.seconds, 3),
+			"files_per_second": round(files / seconds, 2),
+			"mb_per_second": round(size / 1048576.0 / seconds, 3),
+			"control_round_trips": self.commands,
+			"cumulative_peak_rss_kb": self.peak_rss,
+			"peak_rss_growth_kb": self.peak_rss - self.peak_rss_before
+		}
+
+def get_peak_rss():
+	"""Peak RSS of this process since it started, in KB on Linux"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_upload_from_folder(server, params):
+	ftp_settings = get_stand_in_ftp_settings(server)
+	ftp_client = get_ftp_client(ftp_settings, params["tls"], backend=params["transport_backend"])
+	did_not_upload, error_log = [], []
+	uploaded = backup.UploadStatusBuffer()
+	pool = None
+	if params["parallel_uploads"] > 1:
+		pool = backup.get_upload_pool(params["transport_backend"], ftp_settings, params["tls"],
+			params["parallel_uploads"], did_not_upload, error_log, uploaded)
+
+	with Measurement("upload_from_folder", server) as measurement:
+		try:
+			backup.upload_from_folder(get_files_path(), 0, "/folder/files", ftp_client,
+				did_not_upload, error_log, uploaded, pool)
+		finally:
+			if pool:
+				pool.close()
+			uploaded.flush()
+
+	ftp_client.quit()
+	return measurement.result(*get_tree_stats(os.path.join(server.root, "folder")))
+
+def bench_delete_older_backups(server, params):
+	folder = os.path.join(server.root, "retention")
+	os.makedirs(folder)
+
+	now = time.time()
+	for i in range(params["backups"]):
+		path = os.path.join(folder, "{0}-site-database.sql.gz".format(i))
+		with open(path, "wb") as f:
+			f.write(b"0" * 1024)
+		os.utime(path, (now - i * 86400, now - i * 86400))
+
+	ftp_client = get_ftp_client(get_stand_in_ftp_settings(server), params["tls"], backend=params["transport_backend"])
+	with Measurement("delete_older_backups", server) as measurement:
+		backup.delete_older_backups(ftp_client, "/retention", 1)
+
+	ftp_client.quit()
+	return measurement.result(params["backups"] - len(os.listdir(folder)), 0)
+
+def bench_backup_to_ftp(server):
+	with Measurement("backup_to_ftp", server) as measurement:
+		did_not_upload, error_log = backup.backup_to_ftp()
+
+	if did_not_upload:
+		print(error_log)
+
+	return measurement.result(*get_tree_stats(os.path.join(server.root, "full")))
+
+def use_stand_in_server(server, params):
+	"""Point FTP Backup Settings at the stand-in server, returns the previous values"""
+	values = {
+		"enabled": 1,
+		"ftp_host": "127.0.0.1",
+		"ftp_port": server.port,
+		"ftp_authentication": "Anonymous",
+		"ftp_root_directory": "/full",
+		"ftp_tls": params["tls"],
+		"file_backup": 1,
+		"parallel_uploads": params["parallel_uploads"],
+		"transport_backend": params["transport_backend"],
+		"limit_no_of_backups": 0,
+		"keep_backups_for_days": 0,
+		"max_backups_size": 0,
+		"stream_db_backup": 0,
+		"deduplicate_files": 0,
+		"incremental_file_backup": 0
+	}
+
+	previous = frappe.db.get_value(settings_doctype, None, list(values), as_dict=True) or {}
+	previous = dict((field, previous.get(field)) for field in values)
+
+	frappe.db.set_value(settings_doctype, None, values)
+	frappe.db.commit()
+	# set_value skips on_update, drop the cached snapshot by hand
+	clear_settings_cache()
+
+	return previous
+
+def get_stand_in_ftp_settings(server):
+	return {"host": "127.0.0.1", "port": server.port, "user": "anonymous", "passwd": ""}
+
+def get_tree_stats(folder):
+	count, size = 0, 0
+	for root, dirs, files in os.walk(folder):
+		for name in files:
+			count += 1
+			size += os.path.getsize(os.path.join(root, name))
+
+	return count, size
+
+def make_file_fixtures(count, size):
+	folder = get_files_path()
+	file_names = []
+
+	for i in range(count):
+		file_name = "{0}{1}.bin".format(fixture_prefix, i)
+		with open(os.path.join(folder, file_name), "wb") as f:
+			f.write(os.urandom(size))
+
+		doc = frappe.get_doc({
+			"doctype": "File",
+			"file_name": file_name,
+			"file_url": "/files/" + file_name,
+			"file_size": size,
+			"is_private": 0,
+			"folder": "Home"
+		})
+		doc.name = frappe.generate_hash(length=10)
+		doc.db_insert()
+		file_names.append(doc.name)
+
+	frappe.db.commit()
+	return file_names
+
+def reset_upload_flags(file_names):
+	for i in range(0, len(file_names), 500):
+		batch = file_names[i:i + 500]
+		frappe.db.sql("""update `tabFile` set uploaded_to_dropbox=0
+			where name in ({0})""".format(", ".join(["%s"] * len(batch))), tuple(batch))
+
+	frappe.db.commit()
+
+def drop_file_fixtures(file_names):
+	for i in range(0, len(file_names), 500):
+		batch = file_names[i:i + 500]
+		frappe.db.sql("""delete from `tabFile`
+			where name in ({0})""".format(", ".join(["%s"] * len(batch))), tuple(batch))
+
+	frappe.db.commit()
+
+	folder = get_files_path()
+	for file_name in os.listdir(folder):
+		if file_name.startswith(fixture_prefix):
+			os.remove(os.path.join(folder, file_name))
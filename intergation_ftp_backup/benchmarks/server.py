@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import frappe
+from frappe import _
+
+try:
+	from pyftpdlib.authorizers import DummyAuthorizer
+	from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+	from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+	ThreadedFTPServer = None
+
+try:
+	# only there when pyOpenSSL is installed
+	from pyftpdlib.handlers import TLS_FTPHandler
+except ImportError:
+	TLS_FTPHandler = None
+
+class StandInServer(object):
+	"""Local FTP / FTPS server standing in for the real backup target.
+
+	`latency` seconds are added before every control command and data
+	transfers are capped at `bandwidth` bytes per second. Every control
+	command received over all sessions is counted in `commands`.
+
+		with StandInServer(latency=0.02) as server:
+			print(server.port, server.root)
+	"""
+	def __init__(self, latency=0, bandwidth=0, tls=False, certfile=None):
+		if not ThreadedFTPServer:
+			frappe.throw(_("Benchmarks need pyftpdlib, install it with `pip install pyftpdlib`"))
+
+		if tls and not TLS_FTPHandler:
+			frappe.throw(_("The FTPS stand-in server needs pyOpenSSL, install it with `pip install pyopenssl`"))
+
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.tls = tls
+		self.certfile = certfile
+		self.commands = 0
+		self.lock = threading.Lock()
+		self.root = tempfile.mkdtemp(prefix="ftp-backup-bench-")
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *args):
+		self.stop()
+
+	def start(self):
+		authorizer = DummyAuthorizer()
+		authorizer.add_anonymous(self.root, perm="elradfmwMT")
+
+		stand_in = self
+		base = TLS_FTPHandler if self.tls else FTPHandler
+
+		class Handler(base):
+			def pre_process_command(self, line, cmd, arg):
+				with stand_in.lock:
+					stand_in.commands += 1
+
+				if stand_in.latency:
+					time.sleep(stand_in.latency)
+
+				return base.pre_process_command(self, line, cmd, arg)
+
+		Handler.authorizer = authorizer
+		if self.tls:
+			Handler.certfile = self.certfile or make_self_signed_cert()
+
+		if self.bandwidth:
+			class DTPHandler(ThrottledDTPHandler):
+				read_limit = self.bandwidth
+				write_limit = self.bandwidth
+
+			Handler.dtp_handler = DTPHandler
+
+		self.server = ThreadedFTPServer(("127.0.0.1", 0), Handler)
+		self.port = self.server.address[1]
+
+		self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"handle_exit": False})
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.server.close_all()
+		self.thread.join()
+		shutil.rmtree(self.root, ignore_errors=True)
+
+	def reset_counters(self):
+		with self.lock:
+			self.commands = 0
+
+def make_self_signed_cert():
+	path = os.path.join(tempfile.mkdtemp(prefix="ftp-backup-bench-cert-"), "stand-in.pem")
+	subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+		"-subj", "/CN=localhost", "-keyout", path, "-out", path],
+		stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+	return path
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals, absolute_import
+import click
+from frappe.commands import pass_context
+
+@click.command('ftp-backup-all-sites')
+@click.option('--frequency', type=click.Choice(['Daily', 'Weekly']), help='Only sites with this Backup Frequency')
+@click.option('--concurrency', default=4, help='Sites backed up at the same time')
+@click.option('--stagger', default=10, help='Seconds between the starts of two site backups')
+@pass_context
+def ftp_backup_all_sites(context, frequency=None, concurrency=4, stagger=10):
+	"Back up every site with FTP Backup enabled, longest first, sharing FTP sessions per host"
+	from frappe.utils import get_sites
+	from intergation_ftp_backup.ftp_backup_intrgration.site_scheduler import backup_sites
+
+	backup_sites(context.sites or get_sites(), frequency, concurrency, stagger)
+
+@click.command('ftp-restore')
+@click.option('--list', 'list_only', is_flag=True, default=False, help='Only list the backups on the FTP server')
+@click.option('--database', help='Name of the database dump or of a change set to restore up to, the newest dump by default')
+@click.option('--skip-database', is_flag=True, default=False, help='Restore the attachments only')
+@click.option('--skip-files', is_flag=True, default=False, help='Restore the database only')
+@click.option('--parallel', type=int, help='FTP sessions downloading attachments, Parallel Uploads by default')
+@pass_context
+def ftp_restore(context, list_only=False, database=None, skip_database=False, skip_files=False, parallel=None):
+	"Restore the site from its FTP backup, streaming the dump into MariaDB and downloading attachments in parallel"
+	import frappe
+	from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import get_ftp_client, close_quietly
+	from intergation_ftp_backup.ftp_backup_intrgration.restore import list_backups, restore_backup
+	from intergation_ftp_backup.ftp_backup_intrgration.settings import get_settings
+
+	for site in context.sites:
+		try:
+			frappe.init(site=site)
+			frappe.connect()
+
+			if list_only:
+				settings = get_settings()
+				ftp_client = get_ftp_client(settings.ftp_settings, settings.ftp_tls)
+				try:
+					backups = list_backups(ftp_client, ftp_client.abspath(settings.ftp_root_directory))
+				finally:
+					close_quietly(ftp_client)
+
+				for dump in backups.databases:
+					print (dump.name, dump.size, dump.modify)
+					for change in dump.changes:
+						print ('  ', change.name, change.size, change.modify)
+				for tree in backups.files:
+					print (tree.folder, tree.files, 'files', tree.size, 'bytes')
+				print ('bundles', backups.bundles)
+			else:
+				restore_backup(database, not skip_database, not skip_files, parallel)
+		finally:
+			frappe.destroy()
+
+commands = [
+	ftp_backup_all_sites,
+	ftp_restore
+]
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""asyncio transport built on aioftp, picked with the Transport Backend setting.
+
+Every session of a job runs as coroutines on one event loop in a background
+thread. `AsyncFTPClient` is a blocking facade with the interface of
+`BackupClientMixin` for the code running in the job's own thread, and
+`AsyncUploadPool` keeps `parallel_uploads` sessions in flight on the loop
+without a thread per connection.
+"""
+
+from __future__ import unicode_literals
+import os
+import ssl
+import time
+import asyncio
+import threading
+import posixpath
+import frappe
+from ftplib import error_perm, error_temp
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from six.moves.queue import Queue, Empty
+from frappe.utils import encode
+from intergation_ftp_backup.ftp_backup_intrgration.transfer import BlockSizeTuner
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import (HashingReader,
+	UploadVerificationError, default_block_size, folder_check_round_trips, relative_store_round_trips,
+	is_unsupported_command_error, parse_features, pick_checksum, check_checksum)
+from intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings import (
+	UploadPool, combine_path)
+
+try:
+	import aioftp
+except ImportError:
+	aioftp = None
+
+# how often a blocking call hands transfer progress to its callback
+callback_interval = 0.2
+
+class EventLoopThread(object):
+	"""One event loop in a daemon thread, shared by every session of the process"""
+	def __init__(self):
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, name="ftp-asyncio")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def submit(self, coro):
+		return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+	def call(self, callback, *args):
+		self.loop.call_soon_threadsafe(callback, *args)
+
+	def run(self, coro, callback=None):
+		"""Wait for `coro`, called from outside the loop.
+
+		Blocks the coroutine hands to its `progress` queue are passed to
+		`callback` in the calling thread, which owns the frappe connection."""
+		progress = Queue()
+		future = self.submit(coro(progress.put) if callback else coro)
+
+		try:
+			while True:
+				try:
+					result = future.result(timeout=callback_interval if callback else None)
+					break
+				except FutureTimeoutError:
+					pass
+				finally:
+					drain(progress, callback)
+		except aioftp.StatusCodeError as e:
+			raise translate_error(e)
+		except BaseException:
+			# a JobTimeoutException lands here, leave nothing running on the loop
+			future.cancel()
+			raise
+
+		return result
+
+event_loop_thread = None
+
+def get_event_loop_thread():
+	global event_loop_thread
+	if not event_loop_thread:
+		event_loop_thread = EventLoopThread()
+
+	return event_loop_thread
+
+def drain(progress, callback):
+	while callback:
+		try:
+			block = progress.get_nowait()
+		except Empty:
+			break
+		callback(block)
+
+def translate_error(e):
+	"""ftplib error for an aioftp `StatusCodeError`, so callers handle both backends alike"""
+	code = str(e.received_codes[-1]) if e.received_codes else "550"
+	message = " ".join([code] + [line.strip() for line in e.info or []])
+
+	return error_temp(message) if code.startswith('4') else error_perm(message)
+
+class AsyncSession(object):
+	"""One aioftp session with the bookkeeping of `BackupClientMixin`"""
+	def __init__(self, ftp_settings, use_tls=False, transfer=None):
+		self.ftp_settings = ftp_settings
+		self.use_tls = use_tls
+		self.client = aioftp.Client()
+		self.home = None
+		self.known_dirs = set(['/'])
+		self.round_trips_saved = 0
+		self.command_stats = {}
+		self.block_size = default_block_size
+		self.bucket = None
+		self.tuner = None
+		self.verification = "Checksum"
+		self.checksum = None
+
+		if transfer:
+			self.block_size = transfer.block_size or default_block_size
+			self.bucket = transfer.bucket
+			self.tuner = BlockSizeTuner(self.block_size) if transfer.auto_tune else None
+			self.verification = transfer.verification or "Checksum"
+
+	def count(self, command, start):
+		stats = self.command_stats.setdefault(command, [0, 0])
+		stats[0] += 1
+		stats[1] += time.time() - start
+
+	async def connect(self):
+		start = time.time()
+		await self.client.connect(self.ftp_settings['host'], int(self.ftp_settings.get('port') or 21))
+		if self.use_tls:
+			# like ftplib.FTP_TLS, the server certificate is not verified
+			context = ssl.create_default_context()
+			context.check_hostname = False
+			context.verify_mode = ssl.CERT_NONE
+			await self.client.upgrade_to_tls(context)
+
+		await self.client.login(self.ftp_settings['user'], self.ftp_settings['passwd'])
+		self.home = str(await self.client.get_current_directory())
+		self.count('LOGIN', start)
+
+	def abspath(self, path):
+		if not path.startswith('/'):
+			path = posixpath.join(self.home, path)
+
+		return posixpath.normpath(path)
+
+	def remember_dir(self, path):
+		while path not in self.known_dirs:
+			self.known_dirs.add(path)
+			path = posixpath.dirname(path)
+
+	async def ensure_dir(self, path):
+		path = self.abspath(path)
+		if path in self.known_dirs:
+			self.round_trips_saved += folder_check_round_trips
+			return path
+
+		start = time.time()
+		try:
+			await self.client.make_directory(path, parents=True)
+		except aioftp.StatusCodeError:
+			# created by another session since the existence check
+			if not await self.client.is_dir(path):
+				raise
+		self.count('MKD', start)
+		self.remember_dir(path)
+
+		return path
+
+	async def store(self, path, fp, rest=None, progress=None):
+		path = posixpath.join(await self.ensure_dir(posixpath.dirname(path)), posixpath.basename(path))
+
+		start = time.time()
+		async with self.client.upload_stream(path, offset=rest or 0) as stream:
+			while True:
+				block_start = time.time()
+				buf = fp.read(self.tuner.size if self.tuner else self.block_size)
+				if not buf:
+					break
+
+				await stream.write(buf)
+				if self.tuner:
+					self.tuner.sample(len(buf), time.time() - block_start)
+				if self.bucket:
+					wait = self.bucket.reserve(len(buf))
+					if wait:
+						await asyncio.sleep(wait)
+				if progress:
+					progress(buf)
+
+		self.count('STOR', start)
+		self.round_trips_saved += relative_store_round_trips
+
+		return path
+
+	async def retrieve(self, path, progress):
+		start = time.time()
+		async with self.client.download_stream(path) as stream:
+			async for block in stream.iter_by_block(self.block_size):
+				progress(block)
+
+		self.count('RETR', start)
+
+	async def remote_size(self, path):
+		start = time.time()
+		try:
+			info = await self.client.stat(path)
+			return int(info['size']) if 'size' in info else None
+		except aioftp.StatusCodeError:
+			return None
+		finally:
+			self.count('SIZE', start)
+
+	async def get_checksum(self):
+		"""`BackupClientMixin.get_checksum`"""
+		if self.checksum is None:
+			self.checksum = (None, None)
+			if self.verification == "Checksum":
+				try:
+					code, info = await self.client.command('FEAT', '211')
+					features = parse_features(info[1:-1])
+				except aioftp.StatusCodeError:
+					features = {}
+
+				command, algorithm, name = pick_checksum(features)
+				try:
+					if command == 'HASH':
+						await self.client.command('OPTS HASH ' + name, '2xx')
+					self.checksum = (command, algorithm)
+				except aioftp.StatusCodeError:
+					pass
+
+		return self.checksum
+
+	async def verify(self, path, reader):
+		"""`BackupClientMixin.verify`"""
+		if self.verification == "None":
+			return
+
+		size = await self.remote_size(path)
+		if size is not None and size != reader.size:
+			raise UploadVerificationError("{0}: {1} bytes sent, {2} stored".format(path, reader.size, size))
+
+		command, algorithm = await self.get_checksum()
+		if not command:
+			return
+
+		start = time.time()
+		try:
+			code, info = await self.client.command(command + ' ' + path, '2xx')
+		except aioftp.StatusCodeError as e:
+			if not is_unsupported_command_error(translate_error(e)):
+				raise
+			self.checksum = (None, None)
+			return
+		finally:
+			self.count(command, start)
+
+		check_checksum(path, command, " ".join(info), reader)
+
+	async def mlsd(self, folder):
+		"""(name, facts) of `folder`, with aioftp's LIST fallback for servers without MLSD"""
+		start = time.time()
+		entries = []
+		async for path, info in self.client.list(folder):
+			entries.append((posixpath.basename(str(path)), dict(info)))
+
+		self.count('MLSD', start)
+		return entries
+
+	async def rename(self, source, destination):
+		start = time.time()
+		await self.client.rename(source, destination)
+		self.count('RNFR', start)
+
+	async def delete_many(self, paths):
+		failed = []
+		for path in paths:
+			start = time.time()
+			try:
+				await self.client.remove_file(path)
+			except aioftp.StatusCodeError as e:
+				failed.append((path, translate_error(e)))
+			self.count('DELE', start)
+
+		return failed
+
+	async def quit(self):
+		try:
+			await self.client.quit()
+		finally:
+			self.client.close()
+
+class AsyncFTPClient(object):
+	"""Blocking facade over an `AsyncSession`, used like the ftplib based clients"""
+	# delta uploads, compression and encryption are left to the ftplib backend, files go as they are here
+	delta_threshold = 0
+	processor = None
+
+	def __init__(self, ftp_settings, use_tls=False, transfer=None):
+		self.loop = get_event_loop_thread()
+		self.session = AsyncSession(ftp_settings, use_tls, transfer)
+		self.loop.run(self.session.connect())
+
+	@property
+	def round_trips_saved(self):
+		return self.session.round_trips_saved
+
+	@property
+	def command_stats(self):
+		return self.session.command_stats
+
+	def abspath(self, path):
+		return self.session.abspath(path)
+
+	def ensure_dir(self, path):
+		return self.loop.run(self.session.ensure_dir(path))
+
+	def get_checksum(self):
+		return self.loop.run(self.session.get_checksum())
+
+	def verify(self, path, reader):
+		self.loop.run(self.session.verify(path, reader))
+
+	def supports(self, feature):
+		# aioftp sends REST with its offset and lists with MLSD, falling back to LIST itself
+		return feature.upper() in ('REST', 'MLSD')
+
+	def store(self, path, fp, rest=None, callback=None):
+		return self.loop.run(lambda progress: self.session.store(path, fp, rest, progress), callback or noop)
+
+	def resume(self, path, fp, offset, callback=None):
+		if offset:
+			fp.seek(offset)
+			try:
+				self.store(path, fp, rest=offset, callback=callback)
+				return offset
+			except error_perm as e:
+				if not is_unsupported_command_error(e):
+					raise
+
+		fp.seek(0)
+		self.store(path, fp, callback=callback)
+		return 0
+
+	def retrbinary(self, cmd, callback):
+		self.loop.run(lambda progress: self.session.retrieve(cmd.split(' ', 1)[1], progress), callback)
+
+	def remote_size(self, path):
+		return self.loop.run(self.session.remote_size(path))
+
+	def mlsd(self, folder):
+		return self.loop.run(self.session.mlsd(folder))
+
+	def rename(self, source, destination):
+		self.loop.run(self.session.rename(source, destination))
+
+	def delete_many(self, paths, window=None):
+		return self.loop.run(self.session.delete_many(paths))
+
+	def quit(self):
+		self.loop.run(self.session.quit())
+
+def noop(block):
+	pass
+
+class AsyncUploadPool(UploadPool):
+	"""`UploadPool` running its sessions as coroutines on the shared event loop"""
+	def start(self, size):
+		self.loop = get_event_loop_thread()
+		# bounded like the thread pool's queue, released as each upload finishes
+		self.slots = threading.Semaphore(size * 4)
+		self.tasks = self.loop.run(make_queue())
+		self.workers = [self.loop.submit(self.work_async()) for i in range(size)]
+
+	def put(self, task):
+		self.slots.acquire()
+		self.loop.call(self.tasks.put_nowait, task)
+
+	def clear(self):
+		# runs on the loop ahead of the sentinels `stop` posts after it
+		self.loop.call(self.drop_tasks)
+
+	def drop_tasks(self):
+		while not self.tasks.empty():
+			self.tasks.get_nowait()
+			self.slots.release()
+
+	def stop(self):
+		for worker in self.workers:
+			self.loop.call(self.tasks.put_nowait, None)
+
+		for worker in self.workers:
+			worker.result()
+
+		self.workers = []
+
+	async def work_async(self):
+		session = None
+
+		while True:
+			task = await self.tasks.get()
+			if task is None:
+				break
+
+			file_name, filepath, folder = task
+			try:
+				if not session:
+					session = AsyncSession(self.ftp_settings, self.use_tls, self.transfer)
+					await session.connect()
+
+				stored = None
+				if os.path.exists(filepath):
+					stored = await store_file(session, filepath, folder)
+				self.results.put((file_name, filepath, folder, stored, None))
+			except Exception:
+				self.results.put((file_name, filepath, folder, None, frappe.get_traceback()))
+			finally:
+				self.slots.release()
+
+		if session:
+			self.add_session_stats(session)
+			try:
+				await session.quit()
+			except Exception:
+				pass
+
+async def make_queue():
+	# created on the loop, older Pythons bind an asyncio.Queue to the loop it is made in
+	return asyncio.Queue()
+
+async def store_file(session, filename, folder):
+	"""`store_file` of the ftplib backend, on an `AsyncSession`"""
+	start = time.time()
+	checksum = await session.get_checksum()
+	with open(encode(filename), 'rb') as f:
+		reader = HashingReader(f, checksum[1])
+		path = await session.store(combine_path(folder, os.path.basename(filename)), reader)
+	await session.verify(path, reader)
+
+	return frappe._dict({"path": path, "size": reader.size, "sha256": reader.hexdigest(),
+		"seconds": time.time() - start})
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import json
+import time
+import heapq
+import frappe
+from contextlib import contextmanager
+from frappe.utils import now_datetime, flt
+
+# number of files kept in `slowest_files`
+slowest_files_count = 10
+
+class BackupRun(object):
+	"""Timings and counters of one backup run, saved as an `FTP Backup Run`.
+
+	Only used from the thread owning the frappe connection. Upload workers
+	keep the command timings of their own session, merged in when they finish.
+	"""
+	def __init__(self, retry_count=0):
+		self.started = now_datetime()
+		self.start_time = time.time()
+		self.retry_count = retry_count
+		# set for the shard jobs of a coordinated backup
+		self.backup_id = None
+		self.shard = None
+		self.phases = {}
+		self.commands = {}
+		self.slowest = []
+		self.bytes_uploaded = 0
+		self.db_backup_size = 0
+		self.files_uploaded = 0
+		self.files_skipped = 0
+		self.files_failed = 0
+		self.resumed_uploads = 0
+		self.round_trips_saved = 0
+
+	@contextmanager
+	def phase(self, name):
+		"""Adds the time spent in the block to phase `name`"""
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+	def file_uploaded(self, stored, files=1):
+		"""`files` is the number of attachments packed in a bundle, a delta upload counts the patch it `sent`"""
+		if not stored:
+			return
+
+		self.files_uploaded += files
+		self.bytes_uploaded += stored.size if stored.sent is None else stored.sent
+
+		entry = (stored.seconds, stored.path, stored.size)
+		if len(self.slowest) < slowest_files_count:
+			heapq.heappush(self.slowest, entry)
+		else:
+			heapq.heappushpop(self.slowest, entry)
+
+	def db_uploaded(self, size):
+		self.db_backup_size = size or 0
+		self.bytes_uploaded += self.db_backup_size
+
+	def add_commands(self, command_stats):
+		for command, (count, seconds) in command_stats.items():
+			total = self.commands.setdefault(command, [0, 0])
+			total[0] += count
+			total[1] += seconds
+
+	def save(self, status, error=None):
+		"""Insert the `FTP Backup Run`, never lets a logging failure fail the backup"""
+		duration = time.time() - self.start_time
+
+		try:
+			frappe.get_doc({
+				"doctype": "FTP Backup Run",
+				"status": status,
+				"started": self.started,
+				"finished": now_datetime(),
+				"duration": duration,
+				"retry_count": self.retry_count,
+				"backup_id": self.backup_id,
+				"shard": self.shard,
+				"resumed_uploads": self.resumed_uploads,
+				"bytes_uploaded": self.bytes_uploaded,
+				"db_backup_size": self.db_backup_size,
+				"throughput": self.bytes_uploaded / 1048576.0 / duration if duration else 0,
+				"files_uploaded": self.files_uploaded,
+				"files_skipped": self.files_skipped,
+				"files_failed": self.files_failed,
+				"round_trips_saved": self.round_trips_saved,
+				"phases": dump_json(dict((name, flt(seconds, 3)) for name, seconds in self.phases.items())),
+				"commands": dump_json(dict((command, {"count": count, "seconds": flt(seconds, 3)})
+					for command, (count, seconds) in self.commands.items())),
+				"slowest_files": dump_json([{"path": path, "size": size, "seconds": flt(seconds, 3)}
+					for seconds, path, size in sorted(self.slowest, reverse=True)]),
+				"error": error
+			}).insert(ignore_permissions=True)
+			frappe.db.commit()
+		except Exception:
+			frappe.log_error(frappe.get_traceback(), "FTP Backup Run")
+
+def dump_json(data):
+	return json.dumps(data, indent=1, sort_keys=True)
+
+def start_backup_run(retry_count=0):
+	frappe.flags.ftp_backup_run = BackupRun(retry_count)
+	return frappe.flags.ftp_backup_run
+
+def get_backup_run():
+	"""The run of the current job, a throwaway one when called outside `take_backup_to_ftp`"""
+	if not frappe.flags.ftp_backup_run:
+		frappe.flags.ftp_backup_run = BackupRun()
+
+	return frappe.flags.ftp_backup_run
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""Differential database backups from the MariaDB binary log.
+
+A chain starts with a full dump, taken with `--master-data` so its head
+records the binlog position the dump is consistent with. Every later run
+ships a change set: what `mysqlbinlog` reads from the server for the
+site's database between the position the chain reached and the current
+one. A new chain starts once the current one is older than Full Backup
+Every (Days), or when the binlog it continues from was purged.
+
+`chains.json` at the backup root lists the chains, oldest first.
+Retention deletes whole chains, and a restore replays a full dump followed
+by its change sets in order.
+"""
+
+from __future__ import unicode_literals
+import json
+import frappe
+from io import BytesIO
+from datetime import timedelta
+from frappe.utils import cint, encode, get_datetime, now, now_datetime
+from intergation_ftp_backup.ftp_backup_intrgration.db_dump import get_connection_command
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import retrieve_bytes, store_renamed
+
+chains_version = 1
+
+class BackupChains(object):
+	"""Chain manifest stored at the backup root on the FTP server.
+
+	A chain has the file name of its `base` dump, when it `started`, the
+	binlog `position` it has been shipped up to, and its `changes`, each a
+	change set file name with the positions it starts and ends at.
+	"""
+	def __init__(self, path, data=None):
+		data = data or {}
+
+		self.path = path
+		self.chains = data.get("chains", [])
+
+	@classmethod
+	def load(cls, ftp_client, path):
+		data = retrieve_bytes(ftp_client, path)
+		if data is None:
+			return cls(path)
+
+		return cls(path, json.loads(data.decode('utf-8')))
+
+	@property
+	def current(self):
+		return self.chains[-1] if self.chains else None
+
+	def needs_full_backup(self, interval_days, binary_logs):
+		"""Whether the next run has to start a new chain"""
+		chain = self.current
+		if not chain or not chain.get("position"):
+			return True
+
+		if get_datetime(chain["started"]) < now_datetime() - timedelta(days=interval_days):
+			return True
+
+		# purged, the changes since the position can not be read anymore
+		return chain["position"]["file"] not in binary_logs
+
+	def start(self, base, position):
+		self.chains.append({
+			"base": base,
+			"started": now(),
+			"position": position,
+			"changes": []
+		})
+
+	def add_changes(self, name, position):
+		chain = self.current
+		chain["changes"].append({"name": name, "start": chain["position"], "end": position})
+		chain["position"] = position
+
+	def find(self, name):
+		"""The chain `name` is the base or a change set of, and the change sets up to it"""
+		for chain in self.chains:
+			if chain["base"] == name:
+				return chain, chain["changes"]
+
+			for i, change in enumerate(chain["changes"]):
+				if change["name"] == name:
+					return chain, chain["changes"][:i + 1]
+
+		return None, []
+
+	def remove(self, chain):
+		self.chains.remove(chain)
+
+	def save(self, ftp_client):
+		data = json.dumps({
+			"version": chains_version,
+			"chains": self.chains
+		}, indent=1, sort_keys=True)
+
+		store_renamed(ftp_client, self.path, BytesIO(encode(data)))
+
+def is_change_set(name):
+	return "-binlog.sql" in name
+
+def get_master_status():
+	"""The binlog file and position the server writes at, None when binary logging is off"""
+	status = frappe.db.sql("show master status", as_dict=True)
+	if not status:
+		return None
+
+	return {"file": status[0].File, "position": cint(status[0].Position)}
+
+def get_binary_logs():
+	"""Names of the binlog files still on the server, oldest first"""
+	return [row[0] for row in frappe.db.sql("show binary logs")]
+
+def get_binlog_command(start, end, binary_logs):
+	"""mysqlbinlog reading the site's changes from `start` up to `end` off the server"""
+	files = binary_logs[binary_logs.index(start["file"]):binary_logs.index(end["file"]) + 1]
+
+	args, env = get_connection_command("mysqlbinlog")
+	# the start position applies to the first file, the stop position to the last
+	args += ["--read-from-remote-server", "--database=" + frappe.conf.db_name,
+		"--start-position={0}".format(start["position"]), "--stop-position={0}".format(end["position"])]
+	args += files
+
+	return args, env
+
+def get_backup_chains(backups, chains):
+	"""Group the database folder's backups for retention.
+
+	Returns one entry per chain plus one per dump no chain lists, with the
+	name of the base, the modify time of its newest file, the total size
+	and its `files`, and separately the change sets no chain lists, left
+	by runs that failed before saving `chains.json`."""
+	by_name = dict((f.name, f) for f in backups)
+	listed = set()
+
+	entries = []
+	for chain in chains.chains:
+		names = [chain["base"]] + [change["name"] for change in chain["changes"]]
+		listed.update(names)
+
+		files = [by_name[name] for name in names if name in by_name]
+		entries.append(frappe._dict({
+			"name": chain["base"],
+			"modify": max([f.modify for f in files if f.modify] or [None]),
+			"size": sum(f.size or 0 for f in files),
+			"files": files,
+			"chain": chain
+		}))
+
+	orphans = []
+	for f in backups:
+		if f.name in listed:
+			continue
+
+		if is_change_set(f.name):
+			orphans.append(f)
+		else:
+			entries.append(frappe._dict({
+				"name": f.name,
+				"modify": f.modify,
+				"size": f.size,
+				"files": [f],
+				"chain": None
+			}))
+
+	return entries, orphans
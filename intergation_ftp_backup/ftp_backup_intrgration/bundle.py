@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import os
+import json
+import time
+import tarfile
+import tempfile
+import posixpath
+import frappe
+from io import BytesIO
+from rq.timeouts import JobTimeoutException
+from frappe.utils import encode, now_datetime
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import HashingReader
+from intergation_ftp_backup.ftp_backup_intrgration.backup_run import get_backup_run
+from intergation_ftp_backup.ftp_backup_intrgration.pipeline import processed_suffix
+
+class TarBundler(object):
+	"""Packs small attachments into rolling tar bundles in `folder`.
+
+	Files are added to a local tar until it reaches `bundle_size`. Then the
+	tar is sent with one STOR and verified, and `<bundle>.index.json` is
+	stored next to it. The index maps every `File` name to its path relative to the backup
+	root and to the offset and size of its data in the tar, so one file can
+	be fetched with REST + RETR. Files are only flagged uploaded once both
+	are stored. A bundle that fails to upload is reported per file and
+	picked up again by the next run. Bundles are named after the start time,
+	plus `label` for bundlers running at the same time. With the client's
+	processor a bundle is sent compressed and encrypted as `.tar.ftpz`, its
+	offsets are then of the decoded tar.
+	"""
+	def __init__(self, ftp_client, folder, root, bundle_size, threshold, did_not_upload, error_log, uploaded, watermark=None, label=None):
+		self.ftp_client = ftp_client
+		self.folder = folder
+		self.root = root
+		self.bundle_size = bundle_size
+		self.threshold = threshold
+		self.did_not_upload = did_not_upload
+		self.error_log = error_log
+		self.uploaded = uploaded
+		self.watermark = watermark
+		self.prefix = now_datetime().strftime('%Y%m%d_%H%M%S')
+		if label:
+			self.prefix += "-" + label
+		self.count = 0
+		self.fp = None
+		self.tar = None
+		self.members = []
+
+	def accepts(self, filepath):
+		try:
+			return os.stat(encode(filepath)).st_size < self.threshold
+		except OSError:
+			return False
+
+	def add(self, file_name, filepath, path):
+		"""Pack `filepath`, to be restored to the remote `path`"""
+		if not self.tar:
+			self.fp = tempfile.TemporaryFile()
+			self.tar = tarfile.open(fileobj=self.fp, mode="w", format=tarfile.PAX_FORMAT)
+
+		member = posixpath.relpath(path, self.root)
+		start = self.tar.offset
+		try:
+			tarinfo = self.tar.gettarinfo(encode(filepath), member)
+			with open(encode(filepath), 'rb') as f:
+				self.tar.addfile(tarinfo, f)
+		except Exception:
+			# cut a half written member, e.g. a file shrinking while read
+			self.fp.seek(start)
+			self.fp.truncate()
+			self.tar.offset = start
+			raise
+
+		# the data ends padded to a whole block where the tar stands now
+		blocks = (tarinfo.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+		self.members.append({
+			"file": file_name,
+			"filepath": filepath,
+			"path": member,
+			"offset": self.tar.offset - blocks * tarfile.BLOCKSIZE,
+			"size": tarinfo.size
+		})
+
+		if self.tar.offset >= self.bundle_size:
+			self.flush()
+
+	def flush(self):
+		"""Upload the current bundle and its index"""
+		if not self.members:
+			return
+
+		self.count += 1
+		name = "{0}-{1:04d}".format(self.prefix, self.count)
+		members, self.members = self.members, []
+
+		run = get_backup_run()
+		try:
+			self.tar.close()
+			self.fp.seek(0)
+
+			start = time.time()
+			checksum = self.ftp_client.get_checksum()[1]
+			processor = self.ftp_client.processor
+			bundle = name + ".tar" + (processed_suffix if processor else "")
+			reader = HashingReader(processor.reader(self.fp) if processor else self.fp, checksum)
+			path = self.ftp_client.store(posixpath.join(self.folder, bundle), reader)
+			self.ftp_client.verify(path, reader)
+			size = reader.size
+
+			index = {
+				"bundle": bundle,
+				"files": dict((m["file"], {"path": m["path"], "offset": m["offset"], "size": m["size"]})
+					for m in members)
+			}
+			reader = HashingReader(BytesIO(encode(json.dumps(index, sort_keys=True))), checksum)
+			index_path = self.ftp_client.store(posixpath.join(self.folder, name + ".index.json"), reader)
+			self.ftp_client.verify(index_path, reader)
+		except JobTimeoutException:
+			raise
+		except Exception:
+			error = frappe.get_traceback()
+			for m in members:
+				self.did_not_upload.append(m["filepath"])
+				self.error_log.append(error)
+				if self.watermark:
+					self.watermark.failed(m["file"])
+			run.files_failed += len(members)
+			return
+		finally:
+			self.discard()
+
+		run.file_uploaded(frappe._dict({"path": path, "size": size, "seconds": time.time() - start}), len(members))
+		for m in members:
+			self.uploaded.add(m["file"])
+			if self.watermark:
+				self.watermark.done(m["file"])
+
+	def discard(self):
+		"""Drop the local tar, files still in it are not flagged and go in a later run"""
+		if self.fp:
+			self.fp.close()
+
+		self.fp = None
+		self.tar = None
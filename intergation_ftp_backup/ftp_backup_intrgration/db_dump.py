@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import os
+import re
+import zlib
+import tempfile
+import subprocess
+import frappe
+from frappe import _
+from frappe.utils import cint, cstr, now_datetime
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# the comment `--master-data=2` writes in the head of a dump
+master_data_pattern = re.compile(br"CHANGE MASTER TO MASTER_LOG_FILE='([^']+)', MASTER_LOG_POS=(\d+)")
+
+# bytes of a dump searched for it
+master_data_head_size = 1024 * 1024
+
+compression_extensions = {
+	"gzip": ".gz",
+	"zstd": ".zst",
+	"none": ""
+}
+
+def is_compression_available(compression):
+	return compression != "zstd" or zstandard is not None
+
+def get_compressor(compression):
+	if compression == "zstd":
+		return zstandard.ZstdCompressor().compressobj()
+	elif compression == "gzip":
+		# wbits 16 + 15 writes a gzip header, same format `new_backup` produces
+		return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def get_decompressor(compression):
+	if compression == "zstd":
+		return zstandard.ZstdDecompressor().decompressobj()
+	elif compression == "gzip":
+		return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def get_compression(filename):
+	"""Compression of a dump named by `get_dump_filename` or `new_backup`"""
+	for compression, extension in compression_extensions.items():
+		if extension and filename.endswith(extension):
+			return compression
+
+	return "none"
+
+def get_dump_filename(compression, kind="database"):
+	"""Named like the dumps of `frappe.utils.backups` so retention treats them alike,
+	`kind` is "binlog" for the change sets of differential backups"""
+	return "{0}-{1}-{2}.sql{3}".format(now_datetime().strftime('%Y%m%d_%H%M%S'),
+		frappe.local.site.replace('.', '_'), kind, compression_extensions.get(compression, ""))
+
+def get_connection_command(program):
+	"""`program` logging in as the site's database user"""
+	args = [program, "-u", frappe.conf.db_name, "-h", frappe.conf.db_host or "localhost"]
+	if frappe.conf.db_port:
+		args += ["-P", cstr(frappe.conf.db_port)]
+
+	# keeps the password off the process list
+	env = dict(os.environ, MYSQL_PWD=frappe.conf.db_password or "")
+
+	return args, env
+
+def get_dump_command(master_data=False):
+	args, env = get_connection_command("mysqldump")
+	args += ["--single-transaction", "--quick", "--lock-tables=false"]
+	if master_data:
+		# with --single-transaction MariaDB takes the position of the snapshot, no global read lock
+		args.append("--master-data=2")
+	args.append(frappe.conf.db_name)
+
+	return args, env
+
+def get_restore_command():
+	args, env = get_connection_command("mysql")
+	args.append(frappe.conf.db_name)
+
+	return args, env
+
+class DumpStream(object):
+	"""Read-only file object producing the compressed mysqldump of the current site.
+
+	`storbinary` pulls from it block by block, so the dump goes from
+	mysqldump through the compressor into the FTP data connection without
+	a staging copy in the backups folder. `command` replaces mysqldump, e.g.
+	with the mysqlbinlog of a change set. With `master_data` the binlog
+	position of the dump is read from its head into `binlog_position`.
+	"""
+	chunk_size = 1024 * 1024
+
+	def __init__(self, compression="gzip", command=None, master_data=False):
+		args, env = command or get_dump_command(master_data)
+
+		self.program = args[0]
+		self.head = b"" if master_data else None
+		self.binlog_position = None
+		self.stderr = tempfile.TemporaryFile()
+		self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=self.stderr, env=env)
+		self.compressor = get_compressor(compression)
+		self.buffer = b""
+		self.position = 0
+		self.size = 0
+		self.eof = False
+
+	def read(self, size=-1):
+		while self.position >= len(self.buffer) and not self.eof:
+			self.fill()
+
+		if size is None or size < 0:
+			size = len(self.buffer) - self.position
+
+		data = self.buffer[self.position:self.position + size]
+		self.position += len(data)
+		self.size += len(data)
+
+		return data
+
+	def fill(self):
+		data = self.process.stdout.read(self.chunk_size)
+		if data and self.head is not None:
+			self.find_binlog_position(data)
+
+		if data:
+			self.buffer = self.compressor.compress(data) if self.compressor else data
+		else:
+			self.buffer = self.compressor.flush() if self.compressor else b""
+			self.eof = True
+			self.check_exit_status()
+
+		self.position = 0
+
+	def find_binlog_position(self, data):
+		self.head += data
+		match = master_data_pattern.search(self.head)
+		if match:
+			self.binlog_position = {"file": match.group(1).decode("utf-8"), "position": cint(match.group(2))}
+
+		if match or len(self.head) > master_data_head_size:
+			self.head = None
+
+	def check_exit_status(self):
+		if self.process.wait() != 0:
+			self.stderr.seek(0)
+			frappe.throw(_("{0} failed: {1}").format(self.program, cstr(self.stderr.read())))
+
+	def close(self):
+		if self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+
+		self.process.stdout.close()
+		self.stderr.close()
+
+class DumpRestore(object):
+	"""Write-only file object piping a compressed dump through the decompressor into mysql.
+
+	Blocks are decompressed as they arrive from the FTP data connection, so
+	the dump is restored without a staging copy. `close` waits for mysql
+	and raises if the restore failed.
+	"""
+	def __init__(self, compression="gzip"):
+		args, env = get_restore_command()
+
+		self.stderr = tempfile.TemporaryFile()
+		self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=self.stderr, stderr=self.stderr, env=env)
+		self.decompressor = get_decompressor(compression)
+		self.size = 0
+
+	def write(self, data):
+		self.size += len(data)
+		self.process.stdin.write(self.decompressor.decompress(data) if self.decompressor else data)
+
+	def close(self):
+		if self.decompressor and hasattr(self.decompressor, "flush"):
+			self.process.stdin.write(self.decompressor.flush())
+
+		self.process.stdin.close()
+		try:
+			if self.process.wait() != 0:
+				self.stderr.seek(0)
+				frappe.throw(_("mysql failed: {0}").format(cstr(self.stderr.read())))
+		finally:
+			self.stderr.close()
+
+	def kill(self):
+		if self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+
+		self.stderr.close()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""Block level delta uploads of large attachments, rsync style.
+
+After a large attachment is uploaded in full, its signature is stored
+under `deltas/` next to the files folder: the adler32 and md5 of every
+block. When the file changes, the local copy is scanned with a rolling
+adler32 for blocks the signature knows, and only a patch is uploaded:
+copies of those blocks and the bytes in between. The full copy on the
+target stays the base, every later patch is made against it and replaces
+the one before. A file whose patch would exceed `max_delta_ratio` of its
+size or `max_delta_literal` is uploaded in full again and becomes the new
+base.
+"""
+
+from __future__ import unicode_literals
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import tempfile
+import posixpath
+from six import indexbytes
+from frappe.utils import encode
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import retrieve_bytes
+
+signature_block_size = 64 * 1024
+
+# patches larger than this share of the file are sent as a full upload instead
+max_delta_ratio = 0.5
+
+# changed bytes are rolled over in Python at about 1 MB/s, past this a full upload is quicker
+max_delta_literal = 64 * 1024 * 1024
+
+# literal bytes per data op
+data_op_size = 1024 * 1024
+
+# magic, block size, size of the base
+signature_header = struct.Struct(">8sIQ")
+# adler32 and md5 of a block
+signature_entry = struct.Struct(">I16s")
+# magic, block size, size of the base, size and sha256 of the file
+delta_header = struct.Struct(">8sIQQ32s")
+# b"C", first block and number of blocks copied from the base
+copy_op = struct.Struct(">cII")
+# b"D", length of the bytes that follow
+data_op = struct.Struct(">cI")
+
+signature_magic = b"FTPSIG01"
+delta_magic = b"FTPDLT01"
+
+class Signature(object):
+	"""Weak and strong checksums of the blocks of a base file"""
+	def __init__(self, block_size, size, blocks):
+		self.block_size = block_size
+		self.size = size
+		self.blocks = blocks
+
+		self.index = {}
+		for i, (weak, strong) in enumerate(blocks):
+			self.index.setdefault(weak, []).append((i, strong))
+
+	@classmethod
+	def load(cls, ftp_client, path):
+		"""The signature stored at `path`, None when there is none"""
+		data = retrieve_bytes(ftp_client, path)
+		return cls.loads(data) if data is not None else None
+
+	@classmethod
+	def loads(cls, data):
+		magic, block_size, size = signature_header.unpack_from(data)
+		if magic != signature_magic:
+			return None
+
+		offset = signature_header.size
+		blocks = []
+		while offset < len(data):
+			blocks.append(signature_entry.unpack_from(data, offset))
+			offset += signature_entry.size
+
+		return cls(block_size, size, blocks)
+
+	def dumps(self):
+		return signature_header.pack(signature_magic, self.block_size, self.size) + b"".join(
+			signature_entry.pack(weak, strong) for weak, strong in self.blocks)
+
+	def find(self, weak, data):
+		"""Index of the base block holding `data`, None when there is none"""
+		candidates = self.index.get(weak)
+		if not candidates:
+			return None
+
+		strong = hashlib.md5(data).digest()
+		for i, block_strong in candidates:
+			if block_strong == strong:
+				return i
+
+def get_delta_folder(folder):
+	"""Remote folder of the signatures and patches of the files in `folder`"""
+	return posixpath.join(posixpath.dirname(folder), "deltas", posixpath.basename(folder))
+
+def get_delta_paths(folder, filename):
+	"""Remote paths of the signature and the patch of `filename` uploaded to `folder`"""
+	path = posixpath.join(get_delta_folder(folder), os.path.basename(filename))
+	return path + ".sig", path + ".delta"
+
+def make_signature(filepath, block_size=signature_block_size):
+	blocks = []
+	size = 0
+	with open(encode(filepath), 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			blocks.append((weak_checksum(block), hashlib.md5(block).digest()))
+			size += len(block)
+
+	return Signature(block_size, size, blocks)
+
+def weak_checksum(data):
+	return zlib.adler32(data) & 0xffffffff
+
+def make_delta(filepath, signature, max_ratio=max_delta_ratio):
+	"""Patch turning the base `signature` describes into `filepath`, as a temporary file at offset 0.
+
+	Blocks found at the block boundaries of the last match are checked
+	with one adler32 in C, only bytes in changed regions are rolled over
+	in Python. Returns None once the bytes not found in the base exceed
+	`max_ratio` of the file or `max_delta_literal`."""
+	bs = signature.block_size
+	with open(encode(filepath), 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		if not size:
+			return None
+
+		m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			patch = tempfile.TemporaryFile()
+			writer = DeltaWriter(patch, bs)
+			patch.write(delta_header.pack(delta_magic, bs, signature.size, size, hashlib.sha256(m).digest()))
+
+			max_literal = min(int(size * max_ratio), max_delta_literal)
+			literal_start = 0
+			i = 0
+			weak = weak_checksum(m[0:bs]) if size >= bs else 0
+			a, b = weak & 0xffff, weak >> 16
+
+			while i + bs <= size:
+				block = signature.find(weak, m[i:i + bs]) if weak in signature.index else None
+				if block is not None:
+					writer.data(m, literal_start, i)
+					writer.copy(block)
+					i += bs
+					literal_start = i
+					if i + bs <= size:
+						weak = weak_checksum(m[i:i + bs])
+						a, b = weak & 0xffff, weak >> 16
+					continue
+
+				if writer.literal + i + 1 - literal_start > max_literal:
+					patch.close()
+					return None
+
+				if i + bs == size:
+					break
+
+				# roll the window on by one byte
+				out, new = indexbytes(m, i), indexbytes(m, i + bs)
+				a = (a - out + new) % 65521
+				b = (b - bs * out + a - 1) % 65521
+				weak = (b << 16) | a
+				i += 1
+
+			# right after a match, a tail shorter than a block may be the base's last block
+			if i == literal_start and 0 < size - i < bs:
+				tail = m[i:size]
+				block = signature.find(weak_checksum(tail), tail)
+				if block is not None:
+					writer.copy(block)
+					literal_start = size
+
+			writer.data(m, literal_start, size)
+			writer.flush()
+		finally:
+			m.close()
+
+	if writer.literal > max_literal:
+		patch.close()
+		return None
+
+	patch.seek(0)
+	return patch
+
+class DeltaWriter(object):
+	"""Writes the ops of a patch, merging copies of consecutive blocks"""
+	def __init__(self, fp, block_size):
+		self.fp = fp
+		self.block_size = block_size
+		self.run = None
+		self.literal = 0
+
+	def copy(self, block):
+		if self.run and self.run[0] + self.run[1] == block:
+			self.run[1] += 1
+		else:
+			self.flush()
+			self.run = [block, 1]
+
+	def data(self, m, start, end):
+		if start >= end:
+			return
+
+		self.flush()
+		self.literal += end - start
+		for offset in range(start, end, data_op_size):
+			data = m[offset:min(offset + data_op_size, end)]
+			self.fp.write(data_op.pack(b"D", len(data)))
+			self.fp.write(data)
+
+	def flush(self):
+		if self.run:
+			self.fp.write(copy_op.pack(b"C", self.run[0], self.run[1]))
+			self.run = None
+
+def get_sha256(filepath):
+	digest = hashlib.sha256()
+	with open(encode(filepath), 'rb') as f:
+		for block in iter(lambda: f.read(data_op_size), b''):
+			digest.update(block)
+
+	return digest.digest()
+
+def read_delta_header(fp):
+	magic, block_size, base_size, size, sha256 = delta_header.unpack(fp.read(delta_header.size))
+	if magic != delta_magic:
+		raise ValueError("not a delta patch")
+
+	return block_size, base_size, size, sha256
+
+def apply_delta(filepath, patch):
+	"""Rebuild `filepath` from its base, the local copy now, and the `patch` file object.
+
+	Written to `<filepath>.part` and renamed once its sha256 matches the
+	one in the patch. Returns False when the local copy is not the base,
+	True as well when it is the patched file already."""
+	block_size, base_size, size, sha256 = read_delta_header(patch)
+	local_size = os.path.getsize(encode(filepath))
+	if local_size == size and get_sha256(filepath) == sha256:
+		return True
+
+	if local_size != base_size:
+		return False
+
+	digest = hashlib.sha256()
+	part = encode(filepath + ".part")
+	with open(encode(filepath), 'rb') as base, open(part, 'wb') as out:
+		while True:
+			op = patch.read(1)
+			if not op:
+				break
+
+			if op == b"C":
+				first, count = struct.unpack(">II", patch.read(8))
+				base.seek(first * block_size)
+				remaining = count * block_size
+				while remaining > 0:
+					data = base.read(min(remaining, data_op_size))
+					if not data:
+						break
+					out.write(data)
+					digest.update(data)
+					remaining -= len(data)
+			elif op == b"D":
+				length = struct.unpack(">I", patch.read(4))[0]
+				data = patch.read(length)
+				out.write(data)
+				digest.update(data)
+			else:
+				raise ValueError("unknown delta op {0!r}".format(op))
+
+	if digest.digest() != sha256 or os.path.getsize(part) != size:
+		os.remove(part)
+		raise ValueError("{0} does not match its delta".format(filepath))
+
+	os.rename(part, encode(filepath))
+	return True
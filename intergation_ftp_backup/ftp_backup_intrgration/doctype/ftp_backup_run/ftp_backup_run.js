@@ -0,0 +1,8 @@
+// Copyright (c) 2019, Frappe and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('FTP Backup Run', {
+	refresh: function(frm) {
+
+	}
+});
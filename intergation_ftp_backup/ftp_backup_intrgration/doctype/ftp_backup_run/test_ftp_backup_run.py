@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import json
+import frappe
+import unittest
+from intergation_ftp_backup.ftp_backup_intrgration.backup_run import BackupRun
+
+class TestFTPBackupRun(unittest.TestCase):
+	def tearDown(self):
+		frappe.db.sql("delete from `tabFTP Backup Run` where backup_id like %s", "test-%")
+		frappe.db.commit()
+
+	def save_run(self, status, error=None):
+		run = BackupRun(retry_count=1)
+		run.backup_id = "test-" + frappe.generate_hash(length=10)
+		run.phases = {"listing": 1.23456, "uploads": 4.5}
+		# two sessions merged into the run
+		run.add_commands({"STOR": [3, 0.5], "MKD": [1, 0.125]})
+		run.add_commands({"STOR": [2, 0.25], "RECONNECT": [1, 2.0]})
+		run.file_uploaded(frappe._dict({"path": "/files/a.pdf", "size": 1024, "sent": None, "seconds": 0.5}))
+		# past the range of a signed 32 bit column
+		run.db_uploaded(3 * 1024 ** 3)
+		run.save(status, error)
+
+		name = frappe.db.get_value("FTP Backup Run", {"backup_id": run.backup_id})
+		self.assertTrue(name, status)
+		return frappe.get_doc("FTP Backup Run", name)
+
+	def test_save(self):
+		for status in ("Success", "Failed", "Timed Out"):
+			doc = self.save_run(status, None if status == "Success" else "550 Permission denied")
+
+			self.assertEqual(doc.status, status)
+			self.assertEqual(doc.retry_count, 1)
+			self.assertEqual(json.loads(doc.phases), {"listing": 1.235, "uploads": 4.5})
+			self.assertEqual(json.loads(doc.commands), {
+				"STOR": {"count": 5, "seconds": 0.75},
+				"MKD": {"count": 1, "seconds": 0.125},
+				"RECONNECT": {"count": 1, "seconds": 2.0}
+			})
+			self.assertEqual(json.loads(doc.slowest_files), [{"path": "/files/a.pdf", "size": 1024, "seconds": 0.5}])
+			self.assertEqual(doc.files_uploaded, 1)
+			self.assertEqual(doc.db_backup_size, 3 * 1024 ** 3)
+			self.assertEqual(doc.bytes_uploaded, 3 * 1024 ** 3 + 1024)
+			self.assertEqual(doc.error, None if status == "Success" else "550 Permission denied")
@@ -5,6 +5,7 @@ frappe.ui.form.on('FTP Backup Settings', {
 	refresh: function(frm) {
 		frm.clear_custom_buttons();
 		frm.events.take_backup(frm);
+		frm.events.export_encryption_key(frm);
 	},
 
 	take_backup: function(frm) {
@@ -16,6 +17,25 @@ frappe.ui.form.on('FTP Backup Settings', {
 				})
 			}).addClass("btn-primary")
 		}
+	},
+
+	export_encryption_key: function(frm) {
+		if (frm.doc.encrypt_backups && frm.doc.encryption_key) {
+			frm.add_custom_button(__("Export Encryption Key"), function() {
+				frappe.call({
+					method: "intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings.export_encryption_key",
+					callback: function(r) {
+						if (r.message) {
+							frappe.msgprint({
+								title: __("Encryption Key"),
+								message: __("Keep a copy away from this site, encrypted backups cannot be restored without it.")
+									+ "<br><code>" + r.message + "</code>"
+							});
+						}
+					}
+				})
+			})
+		}
 	}
 });
 
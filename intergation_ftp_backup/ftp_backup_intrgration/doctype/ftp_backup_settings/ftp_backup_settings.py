@@ -5,32 +5,150 @@
 from __future__ import unicode_literals
 import frappe
 import os
+import re
 import json
+import time
+import pytz
+import binascii
+import posixpath
+import threading
 from frappe import _
 from frappe.model.document import Document
 from ftplib import FTP, FTP_TLS, error_perm
 from frappe.utils.backups import new_backup
+from frappe.utils.password import get_decrypted_password
 from frappe.utils.background_jobs import enqueue
 from six.moves.urllib.parse import urlparse, parse_qs
 from frappe.integrations.utils import make_post_request
 from rq.timeouts import JobTimeoutException
 from frappe.utils import (cint, split_emails,
-	get_files_path, get_backups_path, get_url, encode)
+	get_files_path, get_backups_path, get_url, encode, get_time, get_time_zone)
 from six import text_type
+from io import BytesIO
+from six.moves.queue import Queue, Empty
 from ftplib import FTP, FTP_TLS
 from dateutil import parser
+from datetime import datetime, timedelta
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import (get_ftp_client,
+	is_unsupported_command_error, is_backend_available, close_quietly, store_renamed, HashingReader,
+	UploadVerificationError)
+from intergation_ftp_backup.ftp_backup_intrgration.manifest import ContentManifest
+from intergation_ftp_backup.ftp_backup_intrgration.bundle import TarBundler
+from intergation_ftp_backup.ftp_backup_intrgration.watermark import (FileWatermark,
+	get_files_modified_since, get_latest_positions)
+from intergation_ftp_backup.ftp_backup_intrgration.db_dump import (DumpStream,
+	get_dump_filename, is_compression_available)
+from intergation_ftp_backup.ftp_backup_intrgration.delta import (Signature, make_signature, make_delta,
+	read_delta_header, get_delta_folder, get_delta_paths)
+from intergation_ftp_backup.ftp_backup_intrgration.binlog import (BackupChains, get_backup_chains,
+	get_binary_logs, get_binlog_command, get_master_status)
+from intergation_ftp_backup.ftp_backup_intrgration.pipeline import (FileProcessor, is_encryption_available,
+	is_compressible, get_encryption_key, generate_encryption_key, processed_suffix)
+from intergation_ftp_backup.ftp_backup_intrgration.upload_queue import UploadQueue
+from intergation_ftp_backup.ftp_backup_intrgration.backup_run import start_backup_run, get_backup_run
+from intergation_ftp_backup.ftp_backup_intrgration.transfer import BandwidthSchedule, TokenBucket
+from intergation_ftp_backup.ftp_backup_intrgration.settings import get_settings, clear_settings_cache
 
 ignore_list = [".DS_Store"]
 
+# number of File rows fetched per query while scanning for uploads
+file_page_length = 500
+
+# uploaded File names are flagged in batches of this size, or after this many seconds
+status_batch_size = 500
+status_flush_interval = 30
+
+# uploads started but not finished, kept in redis so a retried job can resume them
+in_flight_key = "ftp_backup_in_flight"
+# records of uploads no job comes back for, e.g. after failed retries, expire
+in_flight_expiry = 7 * 24 * 60 * 60
+# how often the byte offset of an in-flight upload is saved
+progress_interval = 16 * 1024 * 1024
+
 class FTPBackupSettings(Document):
 	def validate(self):
 		if self.enabled and self.limit_no_of_backups and self.no_of_backups < 1:
 			frappe.throw(_('Number of DB backups cannot be less than 1'))
 
+		if self.parallel_uploads and self.parallel_uploads < 1:
+			frappe.throw(_('Number of parallel uploads cannot be less than 1'))
+
+		if self.stream_db_backup and not is_compression_available(self.db_backup_compression):
+			frappe.throw(_('{0} compression needs the zstandard python package').format(self.db_backup_compression))
+
+		if self.differential_db_backup and not self.stream_db_backup:
+			frappe.throw(_('Differential database backups need Stream Database Backup, the full dumps record their binary log position'))
+
+		if cint(self.full_backup_interval) < 0:
+			frappe.throw(_('Full Backup Every (Days) cannot be negative'))
+
+		if self.transport_backend == "asyncio" and not is_backend_available("asyncio"):
+			frappe.throw(_('The asyncio transport backend needs the aioftp python package'))
+
+		if self.bundle_small_files and (cint(self.bundle_threshold) < 1 or cint(self.bundle_size) < 1):
+			frappe.throw(_('Bundle threshold and bundle size must be at least 1'))
+
+		if self.delta_upload and cint(self.delta_threshold) < 1:
+			frappe.throw(_('Delta Upload Threshold must be at least 1 MB'))
+
+		if self.encrypt_backups:
+			self.validate_encryption_key()
+
+		if (self.compress_files or self.encrypt_backups) and self.transport_backend == "asyncio":
+			frappe.throw(_('Compression and encryption before upload need the ftplib transport backend'))
+
+		if (self.compress_files or self.encrypt_backups) and self.delta_upload:
+			frappe.throw(_('Delta uploads patch the plain files on the target, they cannot be combined with compression or encryption'))
+
+		if cint(self.processing_workers) < 0:
+			frappe.throw(_('Processing Workers cannot be negative, use 0 for one per CPU'))
+
+		if self.upload_block_size and self.upload_block_size < 1:
+			frappe.throw(_('Upload block size cannot be less than 1 KB'))
+
+		if cint(self.day_bandwidth_limit) < 0 or cint(self.night_bandwidth_limit) < 0:
+			frappe.throw(_('Bandwidth limits cannot be negative, use 0 for no limit'))
+
+		if cint(self.keepalive_interval) < 0:
+			frappe.throw(_('Keepalive Interval cannot be negative, use 0 to turn keepalives off'))
+
+		if cint(self.files_per_shard) < 0:
+			frappe.throw(_('Files per shard job cannot be negative, use 0 for one job'))
+
+	def validate_encryption_key(self):
+		if not is_encryption_available():
+			frappe.throw(_('Encryption needs the cryptography python package'))
+
+		if not self.encryption_key:
+			self.encryption_key = generate_encryption_key()
+			# shown once, the site's own database backup is encrypted with it
+			frappe.msgprint(_('An encryption key was generated:<br><code>{0}</code><br>Keep a copy of it away from this site, '
+				'encrypted backups cannot be restored without it. Export Encryption Key shows it again.').format(self.encryption_key),
+				title=_('Encryption Key'))
+		elif set(self.encryption_key) != set('*'):
+			# masked when unchanged
+			try:
+				get_encryption_key(self.encryption_key)
+			except ValueError as e:
+				frappe.throw(_('Invalid Encryption Key: {0}').format(e))
+
+	def on_update(self):
+		clear_settings_cache()
+
+@frappe.whitelist()
+def export_encryption_key():
+	"""The encryption key, to be kept off the site: the site's database backup is encrypted with it"""
+	frappe.only_for("System Manager")
+
+	return get_decrypted_password("FTP Backup Settings", "FTP Backup Settings", "encryption_key", raise_exception=False)
+
 @frappe.whitelist()
 def take_backup():
 	"""Enqueue longjob for taking backup to ftp"""
-	enqueue("intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings.take_backup_to_ftp", queue='long', timeout=1500)
+	if get_settings().files_per_shard:
+		enqueue("intergation_ftp_backup.ftp_backup_intrgration.shards.coordinate_backup", queue='long', timeout=1500)
+	else:
+		enqueue("intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings.take_backup_to_ftp", queue='long', timeout=1500)
 	frappe.msgprint(_("Queued for backup. It may take a few minutes to an hour."))
 
 def take_backups_daily():
@@ -40,37 +158,56 @@ def take_backups_weekly():
 	take_backups_if("Weekly")
 
 def take_backups_if(freq):
-	if frappe.db.get_value("FTP Backup Settings", None, "backup_frequency") == freq:
-		take_backup_to_ftp()
+	settings = get_settings()
+	if settings.backup_frequency == freq:
+		if settings.files_per_shard:
+			enqueue("intergation_ftp_backup.ftp_backup_intrgration.shards.coordinate_backup", queue='long', timeout=1500)
+		else:
+			take_backup_to_ftp()
 
-def take_backup_to_ftp(retry_count=0, upload_db_backup=True):
+def take_backup_to_ftp(retry_count=0, upload_db_backup=True, connection_pool=None):
 	did_not_upload, error_log = [], []
+	run = start_backup_run(retry_count)
+	settings = None
 	try:
-		if cint(frappe.db.get_value("FTP Backup Settings", None, "enabled")):
-			did_not_upload, error_log = backup_to_ftp(upload_db_backup)
+		settings = get_settings()
+		if settings.enabled:
+			did_not_upload, error_log = backup_to_ftp(upload_db_backup, connection_pool, settings=settings)
 			if did_not_upload: raise Exception
 
-			send_email(True, "FTP")
+			run.save("Success")
+			send_email(True, "FTP", settings=settings)
 	except JobTimeoutException:
+		run.save("Timed Out")
 		if retry_count < 2:
 			args = {
 				"retry_count": retry_count + 1,
-				"upload_db_backup": False #considering till worker timeout db backup is uploaded
+				# considering till worker timeout db backup is uploaded or in flight and resumed,
+				# a streamed dump can not be resumed and is taken again
+				"upload_db_backup": upload_db_backup and bool(frappe.flags.ftp_db_stream_pending)
 			}
 			enqueue("intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings.take_backup_to_ftp",
 				queue='long', timeout=1500, **args)
 	except Exception:
-		if isinstance(error_log, str):
-			error_message = error_log + "\n" + frappe.get_traceback()
-		else:
-			file_and_error = [" - ".join(f) for f in zip(did_not_upload, error_log)]
-			error_message = ("\n".join(file_and_error) + "\n" + frappe.get_traceback())
+		error_message = get_error_message(did_not_upload, error_log) + "\n" + frappe.get_traceback()
 		frappe.errprint(error_message)
-		send_email(False, "FTP", error_message)
+		run.save("Failed", error_message)
+		send_email(False, "FTP", error_message, settings)
 
-def send_email(success, service_name, error_status=None):
+def get_error_message(did_not_upload, error_log):
+	if isinstance(error_log, str):
+		return error_log
+
+	file_and_error = [" - ".join(f) for f in zip(did_not_upload, error_log)]
+	return "\n".join(file_and_error)
+
+def send_email(success, service_name, error_status=None, settings=None):
+	if not frappe.db:
+		frappe.connect()
+
+	settings = settings or get_settings()
 	if success:
-		if frappe.db.get_value("FTP Backup Settings", None, "send_email_for_successful_backup") == '0':
+		if not settings.send_email_for_successful_backup:
 			return
 
 		subject = "Backup Upload Successful"
@@ -88,21 +225,27 @@ def send_email(success, service_name, error_status=None):
 		<p>Please contact your system manager for more information.</p>
 		""" % (service_name, error_status)
 
-	if not frappe.db:
-		frappe.connect()
-
-	recipients = split_emails(frappe.db.get_value("FTP Backup Settings", None, "send_notifications_to"))
+	recipients = split_emails(settings.send_notifications_to)
 	frappe.sendmail(recipients=recipients, subject=subject, message=message)
 
 def combine_path(root_dir, dst_dir):
 	return '/'.join([] + root_dir.rstrip('/').split('/') + dst_dir.strip('/').split('/'))
 
-def backup_to_ftp(upload_db_backup=True):
+def backup_to_ftp(upload_db_backup=True, connection_pool=None, shard=None, settings=None):
+	"""Back up this site, with sessions from `connection_pool` when one is shared by several sites.
+
+	A `shard` of `shards.coordinate_backup` backs up either the database or
+	one name range of one files folder. Interrupted uploads are resumed by
+	the coordinator, and the watermark and manifest are left out, since
+	shards run in parallel."""
 	if not frappe.db:
 		frappe.connect()
 
-	# upload database
-	ftp_settings, use_tls, root_directory, file_backup, limit_no_of_backups, no_of_backups  = get_ftp_settings()
+	settings = settings or get_settings()
+	ftp_settings = settings.ftp_settings
+	use_tls = settings.ftp_tls
+	root_directory = settings.ftp_root_directory
+	file_backup = settings.file_backup
 
 	if not ftp_settings['host']:
 		return 'Failed backup upload', 'No FTP host! Please enter valid host for FTP.'
@@ -113,44 +256,270 @@ def backup_to_ftp(upload_db_backup=True):
 	if not root_directory:
 		return 'Failed backup upload', 'No FTP username! Please enter valid username for FTP.'
 
-	ftp_client = FTP_TLS(**ftp_settings) if use_tls else FTP(**ftp_settings)
+	run = get_backup_run()
+	transfer = get_transfer_options(settings)
+	# forked before this backup opens sessions or starts upload threads
+	processor = transfer.processor = get_file_processor(settings)
+	try:
+		with run.phase("connect"):
+			if connection_pool:
+				ftp_client = connection_pool.acquire(ftp_settings, use_tls, transfer, settings.transport_backend)
+			else:
+				ftp_client = get_ftp_client(ftp_settings, use_tls, transfer, settings.transport_backend)
+	except Exception:
+		if processor:
+			processor.terminate()
+		raise
+
+	did_not_upload = []
+	error_log = []
+	uploaded = UploadStatusBuffer()
+	pool = None
+	manifest = None
+	watermark = None
+	bundler = None
+	chains = None
+	completed = False
 
 	try:
-		if upload_db_backup:
-			backup = new_backup(ignore_files=True)
+		# everything below is addressed by absolute path, no CWD juggling per file
+		root_directory = ftp_client.abspath(root_directory)
+
+		# finish what a previous, timed out job left half uploaded
+		if not shard:
+			with run.phase("resume"):
+				resume_interrupted_uploads(ftp_client, did_not_upload, error_log, uploaded)
+				uploaded.flush()
+
+		if shard:
+			upload_db_backup = upload_db_backup and shard.db
+			file_backup = file_backup and not shard.db
+
+		if upload_db_backup and (settings.limit_no_of_backups or settings.keep_backups_for_days
+			or settings.max_backups_size or settings.differential_db_backup):
+			chains = BackupChains.load(ftp_client, combine_path(root_directory, "/chains.json"))
+
+		if upload_db_backup and settings.stream_db_backup and settings.differential_db_backup:
+			with run.phase("db_upload"):
+				size = upload_db_backup_differential(ftp_client, combine_path(root_directory, "/database"), chains,
+					settings.db_backup_compression, settings.full_backup_interval)
+			run.db_uploaded(size)
+		elif upload_db_backup and settings.stream_db_backup:
+			with run.phase("db_upload"):
+				size = upload_db_backup_stream(ftp_client, combine_path(root_directory, "/database"), settings.db_backup_compression)
+			run.db_uploaded(size)
+		elif upload_db_backup:
+			with run.phase("new_backup"):
+				backup = new_backup(ignore_files=True)
 			filename = os.path.join(get_backups_path(), os.path.basename(backup.backup_path_db))
-			upload_file_to_ftp(filename, combine_path(root_directory, "/database"), ftp_client)
+			try:
+				with run.phase("db_upload"):
+					stored = upload_file_to_ftp(filename, combine_path(root_directory, "/database"), ftp_client)
+				run.db_uploaded(stored.size if stored else 0)
+			except JobTimeoutException:
+				raise
+			except Exception:
+				did_not_upload.append(filename)
+				error_log.append(frappe.get_traceback())
+				# keep the older databases, the new one did not make it
+				upload_db_backup = False
 
+		if upload_db_backup:
 			# delete older databases
-			if limit_no_of_backups:
-				delete_older_backups(ftp_client, combine_path(root_directory, "/database"), no_of_backups)
+			if settings.limit_no_of_backups or settings.keep_backups_for_days or settings.max_backups_size:
+				with run.phase("retention"):
+					delete_older_backups(ftp_client, combine_path(root_directory, "/database"),
+						settings.no_of_backups if settings.limit_no_of_backups else None,
+						max_age_days=settings.keep_backups_for_days,
+						max_size=settings.max_backups_size * 1024 * 1024, chains=chains)
 
 		# upload files to files folder
-		did_not_upload = []
-		error_log = []
-
 		if file_backup:
-			upload_from_folder(get_files_path(), 0, combine_path(root_directory, "/files"), ftp_client, did_not_upload, error_log)
-			upload_from_folder(get_files_path(is_private=1), 1, combine_path(root_directory, "/private/files"), ftp_client, did_not_upload, error_log)
+			reconcile_positions = None
+			if settings.incremental_file_backup and not shard:
+				watermark = FileWatermark("|".join([ftp_settings['host'], ftp_settings['user'], root_directory]))
+				if watermark.needs_reconciliation(settings.reconciliation_interval):
+					# flag based run, the incremental scans start from where the File table is now
+					reconcile_positions = get_latest_positions()
+
+			scan_watermark = watermark if watermark and not reconcile_positions else None
+
+			if settings.deduplicate_files and not shard:
+				with run.phase("manifest"):
+					manifest = ContentManifest.load(ftp_client, combine_path(root_directory, "/manifest.json"))
+
+			if settings.parallel_uploads > 1:
+				pool = get_upload_pool(settings.transport_backend, ftp_settings, use_tls, settings.parallel_uploads, did_not_upload, error_log, uploaded, manifest, scan_watermark, transfer, connection_pool)
+
+			if settings.bundle_small_files:
+				bundler = TarBundler(ftp_client, combine_path(root_directory, "/bundles"), root_directory,
+					settings.bundle_size * 1024 * 1024, settings.bundle_threshold * 1024,
+					did_not_upload, error_log, uploaded, scan_watermark, shard.label if shard else None)
 
+			try:
+				with run.phase("file_backup"):
+					if shard:
+						upload_from_folder(get_files_path(is_private=shard.is_private), shard.is_private,
+							combine_path(root_directory, "/private/files" if shard.is_private else "/files"), ftp_client,
+							did_not_upload, error_log, uploaded, pool, bundler=bundler, name_range=(shard.first, shard.last),
+							upload_order=settings.upload_order)
+					else:
+						for is_private in get_folder_order(settings.private_files_first):
+							upload_from_folder(get_files_path(is_private=is_private), is_private,
+								combine_path(root_directory, "/private/files" if is_private else "/files"), ftp_client,
+								did_not_upload, error_log, uploaded, pool, manifest, scan_watermark, bundler,
+								upload_order=settings.upload_order)
+
+					if bundler:
+						bundler.flush()
+					if pool:
+						pool.close()
+
+				if reconcile_positions:
+					watermark.reconciled(reconcile_positions)
+			finally:
+				try:
+					if bundler:
+						bundler.discard()
+					if pool:
+						# closed above when the files went through, here the run is cut short
+						pool.abort()
+					if manifest:
+						with run.phase("manifest"):
+							save_manifest(manifest, ftp_client, uploaded)
+				finally:
+					uploaded.flush()
+					if watermark:
+						watermark.save()
+
+		completed = True
 		return did_not_upload, list(set(error_log))
 
 	finally:
-		ftp_client.quit()
+		run.round_trips_saved = ftp_client.round_trips_saved + (pool.round_trips_saved if pool else 0)
+
+		run.add_commands(ftp_client.command_stats)
+		if pool:
+			run.add_commands(pool.command_stats)
+
+		if processor:
+			if completed:
+				processor.close()
+			else:
+				processor.terminate()
+
+		if connection_pool and completed:
+			connection_pool.release(ftp_client)
+		else:
+			ftp_client.quit()
+
+def upload_db_backup_stream(ftp_client, folder, compression):
+	"""Pipe mysqldump through the compressor straight into the FTP data connection.
+
+	Sent as `<name>.part` and renamed when complete and verified, so an
+	interrupted stream never looks like a finished backup. Returns the
+	compressed size."""
+	compression = get_available_compression(compression)
+	stream = DumpStream(compression)
+	store_db_stream(ftp_client, combine_path(folder, get_dump_filename(compression)), stream)
+
+	return stream.size
+
+def upload_db_backup_differential(ftp_client, folder, chains, compression, full_backup_interval):
+	"""Ship the binlog changes since the last run, or a full dump starting a new chain, see `binlog`.
+
+	Returns the compressed size, 0 when nothing changed."""
+	compression = get_available_compression(compression)
+
+	# the position first, the binlog it is in is then listed for sure
+	end = get_master_status()
+	if not end:
+		frappe.throw(_('Differential database backups need binary logging, log_bin is off on the database server'))
+	binary_logs = get_binary_logs()
+
+	if chains.needs_full_backup(full_backup_interval, binary_logs):
+		stream = DumpStream(compression, master_data=True)
+		path = store_db_stream(ftp_client, combine_path(folder, get_dump_filename(compression)), stream)
+		name = posixpath.basename(path)
+		if not stream.binlog_position:
+			frappe.throw(_('No binary log position in the head of {0}, the next run takes a full dump again').format(name))
+
+		chains.start(name, stream.binlog_position)
+	else:
+		start = chains.current["position"]
+		if start == end:
+			return 0
+
+		stream = DumpStream(compression, get_binlog_command(start, end, binary_logs))
+		path = store_db_stream(ftp_client, combine_path(folder, get_dump_filename(compression, "binlog")), stream)
+		name = posixpath.basename(path)
+		chains.add_changes(name, end)
+
+	chains.save(ftp_client)
+	return stream.size
+
+def get_available_compression(compression):
+	"""`compression`, gzip when its package went missing since the settings were saved"""
+	if not is_compression_available(compression):
+		compression = "gzip"
+
+	return compression
+
+def store_db_stream(ftp_client, path, stream):
+	"""Store `stream` as `<path>.part`, renamed to `path` once verified.
+
+	Encrypted by the client's processor when it has one, the dump is
+	compressed already. Returns the path stored."""
+	frappe.flags.ftp_db_stream_pending = True
+
+	processor = ftp_client.processor
+	if processor:
+		path += processed_suffix
+
+	try:
+		store_renamed(ftp_client, path, processor.reader(stream, compress=False) if processor else stream)
+		frappe.flags.ftp_db_stream_pending = False
+	finally:
+		stream.close()
 
-def upload_from_folder(path, is_private, ftp_folder, ftp_client, did_not_upload, error_log):
+	return path
+
+def upload_from_folder(path, is_private, ftp_folder, ftp_client, did_not_upload, error_log, uploaded, pool=None, manifest=None, watermark=None, bundler=None, name_range=None, upload_order=None):
+	"""Upload the attachments of one folder.
+
+	Without a `watermark` every row not flagged `uploaded_to_dropbox` is
+	considered in `upload_order`, see `UploadQueue`, with one only the rows
+	modified past it. `name_range` limits the flag based scan to names
+	between its first and last, inclusive, None leaving that end open.
+	Files small enough for the `bundler` are packed into its tar bundles instead."""
 	if not os.path.exists(path):
 		return
 
+	if pool:
+		# create the folders once here, workers racing on MKD would fail each other
+		create_folder_if_not_exists(ftp_client, ftp_folder)
+		if ftp_client.delta_threshold:
+			create_folder_if_not_exists(ftp_client, get_delta_folder(ftp_folder))
+
+	run = get_backup_run()
 	if is_fresh_upload():
-		response = get_uploaded_files_meta(ftp_folder, ftp_client)
+		with run.phase("listing"):
+			remote_index = get_remote_index(ftp_client, ftp_folder)
 	else:
-		response = frappe._dict({"entries": []})
+		remote_index = {}
 
 	path = text_type(path)
 
-	for f in frappe.get_all("File", filters={"is_folder": 0, "is_private": is_private,
-		"uploaded_to_dropbox": 0}, fields=['file_url', 'name', 'file_name']):
+	if watermark:
+		files = get_files_modified_since(is_private, watermark.positions[is_private], file_page_length)
+	else:
+		# only a retry goes on from where the timed out job stopped
+		files = UploadQueue(is_private, upload_order, name_range, file_page_length, resume=run.retry_count > 0)
+
+	for f in files:
+		if watermark:
+			watermark.track(f)
+
 		if is_private:
 			filename = f.file_url.replace('/private/files/', '')
 		else:
@@ -160,114 +529,745 @@ def upload_from_folder(path, is_private, ftp_folder, ftp_client, did_not_upload,
 		filepath = os.path.join(path, filename)
 
 		if filename in ignore_list:
+			if watermark:
+				watermark.done(f.name)
 			continue
 
 		found = False
-		for file_metadata in response.entries:
+		remote_file = remote_index.get(os.path.basename(filepath))
+		if remote_file:
 			try:
-				if (os.path.basename(filepath) == file_metadata.name
-					and os.stat(encode(filepath)).st_size == int(file_metadata.size)):
+				if os.stat(encode(filepath)).st_size == remote_file.size:
 					found = True
-					update_file_ftp_status(f.name)
-					break
+			except Exception:
+				error_log.append(frappe.get_traceback())
+		elif ftp_client.processor:
+			# its size differs from the file's, but it is only renamed from .part once complete
+			found = os.path.basename(filepath) + processed_suffix in remote_index
+
+		if found:
+			run.files_skipped += 1
+			uploaded.add(f.name)
+
+		if not found and manifest and os.path.exists(filepath):
+			try:
+				found = link_duplicate(manifest, filepath, combine_path(ftp_folder, os.path.basename(filepath)), f.name, uploaded)
+				if found:
+					run.files_skipped += 1
 			except Exception:
 				error_log.append(frappe.get_traceback())
 
+			if len(manifest.linked) >= status_batch_size:
+				save_manifest(manifest, ftp_client, uploaded)
+
 		if not found:
+			if bundler and bundler.accepts(filepath):
+				# flagged and settled in the watermark when its bundle is stored
+				try:
+					bundler.add(f.name, filepath, combine_path(ftp_folder, os.path.basename(filepath)))
+				except JobTimeoutException:
+					raise
+				except Exception:
+					did_not_upload.append(filepath)
+					error_log.append(frappe.get_traceback())
+					run.files_failed += 1
+					if watermark:
+						watermark.failed(f.name)
+				continue
+
+			if pool:
+				pool.submit(f.name, filepath, ftp_folder)
+				continue
+
 			try:
-				upload_file_to_ftp(filepath, ftp_folder, ftp_client)
-				update_file_ftp_status(f.name)
+				stored = upload_file_to_ftp(filepath, ftp_folder, ftp_client, f.name, delta=True)
+				uploaded.add(f.name)
+				run.file_uploaded(stored)
+				if manifest and stored:
+					manifest.add(stored.sha256, stored.path, stored.size)
+			except JobTimeoutException:
+				raise
 			except Exception:
 				did_not_upload.append(filepath)
 				error_log.append(frappe.get_traceback())
+				run.files_failed += 1
+				if watermark:
+					watermark.failed(f.name)
+				continue
+
+		if watermark:
+			watermark.done(f.name)
+
+def link_duplicate(manifest, filepath, path, file_name, uploaded):
+	"""Whether the content of `filepath` is on the target already.
+
+	Same path and size counts as uploaded, same content under another path
+	becomes a manifest link flagged once the manifest is saved."""
+	size = os.stat(encode(filepath)).st_size
+	if manifest.has(path, size):
+		uploaded.add(file_name)
+		return True
+
+	digest = manifest.find(filepath, size)
+	if digest:
+		manifest.link(path, digest, file_name)
+		return True
+
+	return False
 
-def upload_file_to_ftp(filename, folder, ftp_client):
-	"""upload files with chunk of 15 mb to reduce session append calls"""
+def save_manifest(manifest, ftp_client, uploaded):
+	if manifest.unlinked:
+		# unflagged before the manifest drops the links, a failed save leaves them to be uploaded again
+		uploaded.flush()
+		unflag_files(manifest.unlinked)
+		manifest.unlinked = []
+
+	for file_name in manifest.save(ftp_client):
+		uploaded.add(file_name)
+
+def unflag_files(paths):
+	"""Clear `uploaded_to_dropbox` of the attachments at the remote `paths`, so they are uploaded again"""
+	file_urls = []
+	for path in paths:
+		folder, name = posixpath.split(path)
+		file_urls.append(("/private/files/" if folder.endswith("/private/files") else "/files/") + name)
+
+	frappe.db.sql("""update `tabFile` set uploaded_to_dropbox=0
+		where file_url in ({0})""".format(", ".join(["%s"] * len(file_urls))), tuple(file_urls))
+
+def upload_file_to_ftp(filename, folder, ftp_client, file_name=None, delta=False):
+	"""upload a file in blocks of the client's block size, see `get_transfer_options`.
+
+	Errors are raised to the caller. An upload that fails verification is
+	no longer in flight, it is sent again from the start. `delta` is passed
+	on to `store_file`."""
 	if not os.path.exists(filename):
 		return
 
+	if ftp_client.processor:
+		# sent again in full when interrupted, see `store_processed`
+		return store_file(filename, folder, ftp_client)
+
+	path = combine_path(folder, os.path.basename(filename))
+	record = mark_in_flight(path, filename, file_name)
+
+	try:
+		stored = store_file(filename, folder, ftp_client, UploadProgress(path, record), delta)
+	except UploadVerificationError:
+		clear_in_flight(path)
+		raise
+
+	# anything else leaves it in flight, the next job resumes it
+	clear_in_flight(path)
+	return stored
+
+def store_file(filename, folder, ftp_client, callback=None, delta=False):
+	"""upload and verify a single file, errors are raised to the caller.
+
+	Returns the remote path, size, sha256 hashed while sending and the seconds it took.
+	The server's checksum, if any, is hashed in the same pass. With `delta`,
+	a file of at least the client's delta threshold is sent as a patch
+	against the copy on the target when it can, see `store_delta`. A client
+	with a processor sends it compressed and encrypted, see `store_processed`."""
+	if ftp_client.processor:
+		return store_processed(filename, folder, ftp_client)
+
+	delta = delta and is_delta_candidate(ftp_client, os.path.getsize(encode(filename)))
+	if delta:
+		stored = store_delta(filename, folder, ftp_client)
+		if stored:
+			return stored
+
+	start = time.time()
 	with open(encode(filename), 'rb') as f:
-		path = "{0}/{1}".format(folder, os.path.basename(filename))
+		reader = HashingReader(f, ftp_client.get_checksum()[1])
+		path = ftp_client.store(combine_path(folder, os.path.basename(filename)), reader, callback=callback)
+	ftp_client.verify(path, reader)
+
+	if delta:
+		# the new base, later changes are patched against it
+		store_verified(ftp_client, get_delta_paths(folder, filename)[0], BytesIO(make_signature(filename).dumps()))
+
+	return frappe._dict({"path": path, "size": reader.size, "sha256": reader.hexdigest(),
+		"seconds": time.time() - start})
+
+def store_processed(filename, folder, ftp_client):
+	"""Upload `filename` compressed and encrypted as `<name>.ftpz`, see `pipeline`.
+
+	Stored as `.part` and renamed once verified. An interrupted upload is
+	not resumed, the output differs every time it is made. Path, size and
+	sha256 are of the attachment, `sent` is the size on the target."""
+	start = time.time()
+	path = combine_path(folder, os.path.basename(filename))
+	with open(encode(filename), 'rb') as f:
+		reader = ftp_client.processor.reader(f, is_compressible(filename))
+		sent = store_renamed(ftp_client, path + processed_suffix, reader)
+
+	return frappe._dict({"path": path, "size": reader.source_size, "sha256": reader.hexdigest(),
+		"sent": sent, "seconds": time.time() - start})
+
+def is_delta_candidate(ftp_client, size):
+	return bool(ftp_client.delta_threshold) and size >= ftp_client.delta_threshold
+
+def store_delta(filename, folder, ftp_client):
+	"""Upload the blocks of `filename` changed since its base was uploaded, see `delta`.
+
+	The patch replaces the one of an earlier change, the base stays. Returns
+	None when the file has to be sent in full, after removing a signature
+	and patch that would no longer match the new base."""
+	signature_path, patch_path = get_delta_paths(folder, filename)
+	signature = Signature.load(ftp_client, signature_path)
+	if not signature:
+		return None
 
+	start = time.time()
+	patch = make_delta(filename, signature)
+	if not patch:
+		ftp_client.delete_many([signature_path, patch_path])
+		return None
+
+	try:
+		sha256 = read_delta_header(patch)[3]
+		patch.seek(0)
+		sent = store_verified(ftp_client, patch_path, patch)
+	finally:
+		patch.close()
+
+	size = os.path.getsize(encode(filename))
+
+	# the content of the path once the patch is applied, `sent` is what went over the wire
+	return frappe._dict({"path": combine_path(folder, os.path.basename(filename)), "size": size,
+		"sha256": binascii.hexlify(sha256).decode('ascii'), "sent": sent, "seconds": time.time() - start})
+
+def store_verified(ftp_client, path, fp):
+	"""Store and verify `fp`, returns its size"""
+	reader = HashingReader(fp, ftp_client.get_checksum()[1])
+	ftp_client.store(path, reader)
+	ftp_client.verify(path, reader)
+
+	return reader.size
+
+def mark_in_flight(path, filename, file_name=None):
+	"""Remember an upload to remote `path` until it completes"""
+	stat = os.stat(encode(filename))
+	record = frappe._dict({
+		"filename": filename,
+		"file_name": file_name,
+		"size": stat.st_size,
+		"mtime": stat.st_mtime,
+		"offset": 0
+	})
+	cache = frappe.cache()
+	cache.hset(in_flight_key, path, record)
+	cache.expire(cache.make_key(in_flight_key), in_flight_expiry)
+
+	return record
+
+def clear_in_flight(path):
+	frappe.cache().hdel(in_flight_key, path)
+
+class UploadProgress(object):
+	"""storbinary callback saving how far an in-flight upload got"""
+	def __init__(self, path, record):
+		self.path = path
+		self.record = record
+		self.saved = record.offset
+
+	def __call__(self, block):
+		self.record.offset += len(block)
+		if self.record.offset - self.saved >= progress_interval:
+			frappe.cache().hset(in_flight_key, self.path, self.record)
+			self.saved = self.record.offset
+
+def resume_interrupted_uploads(ftp_client, did_not_upload, error_log, uploaded):
+	"""Continue uploads a timed out job left behind, using REST from the remote SIZE.
+
+	Files changed or removed locally since are dropped here, a changed
+	attachment is picked up again by the regular File scan. Completed
+	uploads are verified like new ones."""
+	run = get_backup_run()
+	for path, record in (frappe.cache().hgetall(in_flight_key) or {}).items():
+		# redis hands the fields back as bytes
+		path = frappe.safe_decode(path)
+		record = frappe._dict(record)
 		try:
-			create_folder_if_not_exists(ftp_client, folder)
-			pwd = ftp_client.pwd()
-			ftp_client.cwd(folder)
-
-			ftp_client.storbinary('STOR %s' % os.path.basename(filename), f)
-			
-			ftp_client.cwd(pwd)
-		except Exception:
-			error = "File Path: {path}\n".format(path=path)
-			error += frappe.get_traceback()
-			frappe.log_error(error)
-			print (error)
-		
-def create_folder_if_not_exists(ftp_client, path):
-	def _mkdirs_(currentDir):
-		if currentDir != "":
+			stat = os.stat(encode(record.filename))
+		except OSError:
+			clear_in_flight(path)
+			continue
+
+		if stat.st_size != record.size or stat.st_mtime != record.mtime:
+			clear_in_flight(path)
+			continue
+
+		try:
+			if (is_delta_candidate(ftp_client, record.size)
+				and ftp_client.remote_size(get_delta_paths(posixpath.dirname(path), path)[0]) is not None):
+				# the remote copy is a delta base, not the start of this upload
+				clear_in_flight(path)
+				continue
+
+			offset = ftp_client.remote_size(path) or 0
+			if offset > record.size:
+				offset = 0
+
+			checksum = ftp_client.get_checksum()[1]
+			with open(encode(record.filename), 'rb') as f:
+				reader = HashingReader(f, checksum)
+				if offset < record.size:
+					record.offset = offset
+					# hash what the server has in the pass that skips it
+					reader.skip(offset)
+					started_at = ftp_client.resume(path, reader, offset, UploadProgress(path, record))
+					run.resumed_uploads += 1
+					run.bytes_uploaded += record.size - started_at
+				elif checksum:
+					reader.skip(record.size)
+				else:
+					reader.size = record.size
+
+			ftp_client.verify(path, reader)
+			clear_in_flight(path)
+			if record.file_name:
+				uploaded.add(record.file_name)
+		except JobTimeoutException:
+			raise
+		except Exception as e:
+			if isinstance(e, UploadVerificationError):
+				clear_in_flight(path)
+			did_not_upload.append(record.filename)
+			error_log.append(frappe.get_traceback())
+			run.files_failed += 1
+
+class UploadPool(object):
+	"""Upload files over several FTP sessions sharing one work queue.
+
+	Every worker thread logs in with its own client. Workers only talk FTP,
+	results are handed back to the calling thread which owns the frappe
+	connection and updates `uploaded_to_dropbox`, `did_not_upload` and `error_log`.
+	"""
+	def __init__(self, ftp_settings, use_tls, size, did_not_upload, error_log, uploaded, manifest=None, watermark=None, transfer=None, connection_pool=None):
+		self.ftp_settings = ftp_settings
+		self.use_tls = use_tls
+		self.transfer = transfer
+		self.connection_pool = connection_pool
+		self.did_not_upload = did_not_upload
+		self.error_log = error_log
+		self.uploaded = uploaded
+		self.manifest = manifest
+		self.watermark = watermark
+		self.round_trips_saved = 0
+		self.command_stats = {}
+		self.lock = threading.Lock()
+
+		self.results = Queue()
+		self.start(size)
+
+	def start(self, size):
+		# bounded so a large File table is not queued up in memory
+		self.tasks = Queue(maxsize=size * 4)
+		self.workers = []
+
+		for i in range(size):
+			worker = threading.Thread(target=self.work, name="ftp-upload-%s" % i)
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	def submit(self, file_name, filepath, folder):
+		if os.path.exists(filepath) and not (self.transfer and self.transfer.processor):
+			mark_in_flight(combine_path(folder, os.path.basename(filepath)), filepath, file_name)
+
+		self.put((file_name, filepath, folder))
+		self.process_results()
+
+	def put(self, task):
+		self.tasks.put(task)
+
+	def close(self):
+		self.stop()
+		self.process_results()
+
+	def abort(self):
+		"""Close after the uploads in progress, dropping the queued ones.
+
+		For a run cut short, e.g. by a JobTimeoutException after which the
+		work horse is killed soon. Dropped files stay in flight or unflagged
+		for the next job."""
+		self.clear()
+		self.close()
+
+	def clear(self):
+		while True:
 			try:
-				ftp_client.cwd(currentDir)
-			except error_perm:
-				_mkdirs_('/'.join(currentDir.split('/')[:-1]))
-				ftp_client.mkd(currentDir)
-				ftp_client.cwd(currentDir)
+				self.tasks.get_nowait()
+			except Empty:
+				break
+
+	def stop(self):
+		for worker in self.workers:
+			self.tasks.put(None)
+
+		for worker in self.workers:
+			worker.join()
+
+		self.workers = []
+
+	def process_results(self):
+		run = get_backup_run()
+		while True:
+			try:
+				file_name, filepath, folder, stored, error = self.results.get_nowait()
+			except Empty:
+				break
+
+			if error:
+				self.did_not_upload.append(filepath)
+				self.error_log.append(error)
+				run.files_failed += 1
+				if self.watermark:
+					self.watermark.failed(file_name)
+			else:
+				clear_in_flight(combine_path(folder, os.path.basename(filepath)))
+				self.uploaded.add(file_name)
+				run.file_uploaded(stored)
+				if self.manifest and stored:
+					self.manifest.add(stored.sha256, stored.path, stored.size)
+				if self.watermark:
+					self.watermark.done(file_name)
+
+	def work(self):
+		ftp_client = None
+
+		while True:
+			task = self.tasks.get()
+			if task is None:
+				break
+
+			file_name, filepath, folder = task
+			try:
+				if not ftp_client:
+					ftp_client = self.connect()
+
+				stored = None
+				if os.path.exists(filepath):
+					stored = store_file(filepath, folder, ftp_client, delta=True)
+				self.results.put((file_name, filepath, folder, stored, None))
+			except Exception:
+				self.results.put((file_name, filepath, folder, None, frappe.get_traceback()))
+				if ftp_client:
+					# may have replies left unread or be gone, the next file gets a new session
+					self.add_session_stats(ftp_client)
+					close_quietly(ftp_client)
+					ftp_client = None
+
+		if ftp_client:
+			self.add_session_stats(ftp_client)
+			if self.connection_pool:
+				self.connection_pool.release(ftp_client)
+			else:
+				close_quietly(ftp_client)
+
+	def connect(self):
+		if self.connection_pool:
+			return self.connection_pool.acquire(self.ftp_settings, self.use_tls, self.transfer)
+
+		return get_ftp_client(self.ftp_settings, self.use_tls, self.transfer)
+
+	def add_session_stats(self, ftp_client):
+		with self.lock:
+			self.round_trips_saved += ftp_client.round_trips_saved
+			for command, (count, seconds) in ftp_client.command_stats.items():
+				stats = self.command_stats.setdefault(command, [0, 0])
+				stats[0] += count
+				stats[1] += seconds
+
+def get_upload_pool(backend, *args):
+	"""`UploadPool` with a thread per session, or all sessions on one event loop for asyncio"""
+	if backend == "asyncio":
+		from intergation_ftp_backup.ftp_backup_intrgration.aio_client import AsyncUploadPool
+		return AsyncUploadPool(*args)
+
+	return UploadPool(*args)
+
+def create_folder_if_not_exists(ftp_client, path):
+	"""checked or created once per session, see `BackupClientMixin.ensure_dir`"""
+	return ftp_client.ensure_dir(path)
+
+def get_folder_order(private_files_first):
+	"""`is_private` of the files folders in the order they are uploaded"""
+	return (1, 0) if private_files_first else (0, 1)
+
+class UploadStatusBuffer(object):
+	"""Collects uploaded File names and flags them with one UPDATE per batch.
+
+	Flushed once `batch_size` names are buffered or `interval` seconds have
+	passed since the last flush. Every flush commits, so a worker timeout
+	loses at most one batch of progress."""
+	def __init__(self, batch_size=status_batch_size, interval=status_flush_interval):
+		self.batch_size = batch_size
+		self.interval = interval
+		self.file_names = []
+		self.last_flush = time.time()
+
+	def add(self, file_name):
+		self.file_names.append(file_name)
 
-	pwd = ftp_client.pwd()
-	path = '/'.join([pwd.rstrip('/'), path.lstrip('/')])
-	_mkdirs_(path)
-	ftp_client.cwd(pwd)
+		if (len(self.file_names) >= self.batch_size
+			or time.time() - self.last_flush >= self.interval):
+			self.flush()
 
-def update_file_ftp_status(file_name):
-	frappe.db.set_value("File", file_name, 'uploaded_to_dropbox', 1, update_modified=False)
+	def flush(self):
+		if self.file_names:
+			with get_backup_run().phase("status_updates"):
+				update_file_ftp_status(self.file_names)
+				frappe.db.commit()
+			self.file_names = []
+
+		self.last_flush = time.time()
+
+def update_file_ftp_status(file_names):
+	if not file_names:
+		return
+
+	frappe.db.sql("""update `tabFile` set uploaded_to_dropbox=1
+		where name in ({0})""".format(", ".join(["%s"] * len(file_names))), tuple(file_names))
 
 def is_fresh_upload():
 	file_name = frappe.db.get_value("File", {'uploaded_to_dropbox': 1}, 'name')
 	return not file_name
 
-def get_uploaded_files_meta(ftp_folder, ftp_client):
+def get_remote_index(ftp_client, folder):
+	"""Returns a dict of basename -> frappe._dict(name, size, modify) for the files in `folder`.
+
+	Built with a single MLSD listing where the server supports it, with LIST
+	(and SIZE for lines that can not be parsed) otherwise."""
 	try:
-		return {'entries': ftp_client.nlst(ftp_folder) }
+		return get_remote_index_from_mlsd(ftp_client, folder)
 	except error_perm as e:
-		if str(e) == "550 No files found":
-			return {'entries': [] }
-		else:
+		if is_missing_folder_error(e):
+			return {}
+		if not is_unsupported_command_error(e):
 			raise
 
-def decorate_files(ftp_client, filenames):
-    latest_time = None
+	try:
+		return get_remote_index_from_list(ftp_client, folder)
+	except error_perm as e:
+		if is_missing_folder_error(e):
+			return {}
+		raise
 
-    for name in filenames:
-        time = ftp_client.voidcmd("MDTM " + name)
-        if (latest_time is None) or (time > latest_time):
-            latest_time = time
-        
-        yield name, latest_time
+def get_remote_index_from_mlsd(ftp_client, folder):
+	index = {}
+	for name, facts in ftp_client.mlsd(folder):
+		if facts.get('type', 'file') != 'file':
+			continue
 
-def get_ftp_settings():
-	print ('get_ftp_settings')
-	settings = frappe.get_doc("FTP Backup Settings")
+		name = posixpath.basename(name)
+		index[name] = frappe._dict({
+			"name": name,
+			"size": cint(facts['size']) if 'size' in facts else None,
+			"modify": parse_ftp_time(facts.get('modify'))
+		})
 
-	app_details = {
-		"host": settings.ftp_host,
-		"user": 'anonymous' if settings.ftp_authentication == 'Anonymous' else settings.ftp_username,
-		"passwd": '' if settings.ftp_authentication == 'Anonymous' else settings.get_password(fieldname="ftp_password", raise_exception=False)
-	}
+	return index
 
-	return app_details, settings.ftp_tls, settings.ftp_root_directory, settings.file_backup, settings.limit_no_of_backups, settings.no_of_backups 
+unix_list_line = re.compile(r'^(?P<type>[-dl])\S*\s+\d+\s+\S+\s+\S+\s+(?P<size>\d+)\s+'
+	r'(?P<modify>\w{3}\s+\d{1,2}\s+(?:\d{1,2}:\d{2}|\d{4}))\s+(?P<name>.+)$')
+dos_list_line = re.compile(r'^(?P<modify>\d{2}-\d{2}-\d{2,4}\s+\d{1,2}:\d{2}[AP]M)\s+'
+	r'(?P<size><DIR>|\d+)\s+(?P<name>.+)$')
 
-def delete_older_backups(ftp_client, folder_path, to_keep):
-	print ('delete_older_backups')
-	res = get_uploaded_files_meta(folder_path, ftp_client, )
-	files = []
-	for ft in decorate_files(ftp_client, res['entries']):
-		files.append(ft)
+def get_remote_index_from_list(ftp_client, folder):
+	lines = []
+	ftp_client.retrlines('LIST ' + folder, lines.append)
 
-	if len(files) <= to_keep:
-		return
+	index, unparsed = {}, False
+	for line in lines:
+		match = unix_list_line.match(line) or dos_list_line.match(line)
+		if not match:
+			unparsed = unparsed or not line.startswith('total ')
+			continue
+
+		info = match.groupdict()
+		if info.get('type', '-') != '-' or info['size'] == '<DIR>':
+			continue
+
+		try:
+			modify = parser.parse(info['modify'])
+		except (ValueError, OverflowError):
+			modify = None
+
+		name = posixpath.basename(info['name'])
+		index[name] = frappe._dict({
+			"name": name,
+			"size": cint(info['size']),
+			"modify": modify
+		})
+
+	if unparsed:
+		# unknown listing format, fall back to one SIZE per unknown name
+		for path in ftp_client.nlst(folder):
+			name = posixpath.basename(path)
+			if name in index or name in ('.', '..'):
+				continue
+
+			try:
+				size = ftp_client.size(combine_path(folder, name))
+			except error_perm:
+				# most likely a folder
+				continue
+
+			index[name] = frappe._dict({"name": name, "size": size, "modify": None})
+
+	return index
+
+def get_backup_index(ftp_client, folder):
+	"""Like `get_remote_index` with exact modify times, for retention.
+
+	One MLSD listing where supported. Otherwise NLST plus one MDTM and
+	SIZE per file, since LIST times are only accurate to the minute or day."""
+	try:
+		return get_remote_index_from_mlsd(ftp_client, folder)
+	except error_perm as e:
+		if is_missing_folder_error(e):
+			return {}
+		if not is_unsupported_command_error(e):
+			raise
+
+	try:
+		names = ftp_client.nlst(folder)
+	except error_perm as e:
+		if is_missing_folder_error(e):
+			return {}
+		raise
+
+	index = {}
+	for name in names:
+		name = posixpath.basename(name)
+		if name in ('.', '..'):
+			continue
+
+		path = combine_path(folder, name)
+		try:
+			modify = parse_ftp_time(ftp_client.sendcmd('MDTM ' + path))
+		except error_perm:
+			# most likely a folder
+			continue
+
+		index[name] = frappe._dict({
+			"name": name,
+			"size": ftp_client.remote_size(path),
+			"modify": modify
+		})
+
+	return index
+
+def parse_ftp_time(value):
+	"""Parse MLSD `modify` and MDTM `[213 ]YYYYMMDDHHMMSS[.sss]` timestamps (UTC)"""
+	if not value:
+		return None
+
+	value = value.strip()
+	if value.startswith('213 '):
+		value = value[4:].strip()
+
+	# strptime takes single digit fields, a cut off value would parse as another time
+	if not value[:14].isdigit() or len(value) < 14:
+		return None
+
+	try:
+		return datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+	except ValueError:
+		return None
+
+def is_missing_folder_error(e):
+	return str(e).startswith('550')
+
+def get_file_processor(settings):
+	"""`FileProcessor` compressing and encrypting this backup's uploads, None when neither is on"""
+	if not (settings.compress_files or settings.encrypt_backups):
+		return None
+
+	if settings.transport_backend == "asyncio":
+		frappe.throw(_('Compression and encryption before upload need the ftplib transport backend'))
+
+	key = None
+	if settings.encrypt_backups:
+		if not is_encryption_available():
+			frappe.throw(_('Encryption needs the cryptography python package'))
+		if not settings.encryption_key:
+			frappe.throw(_('Encrypt Backups is on without an Encryption Key'))
+		key = get_encryption_key(settings.encryption_key)
+
+	return FileProcessor(key, settings.compress_files, settings.processing_workers)
+
+def get_transfer_options(settings):
+	"""Block size, the bandwidth cap and upload verification shared by every FTP session of the run"""
+	bucket = None
+	if settings.day_bandwidth_limit or settings.night_bandwidth_limit:
+		schedule = BandwidthSchedule(settings.day_bandwidth_limit * 1024, settings.night_bandwidth_limit * 1024,
+			get_time(settings.night_starts), get_time(settings.night_ends), pytz.timezone(get_time_zone()))
+		bucket = TokenBucket(schedule)
+
+	return frappe._dict({
+		"block_size": settings.upload_block_size * 1024,
+		"auto_tune": settings.auto_tune_block_size,
+		"bucket": bucket,
+		"verification": settings.upload_verification,
+		"keepalive_interval": settings.keepalive_interval,
+		"delta_threshold": settings.delta_threshold * 1024 * 1024 if settings.delta_upload else 0
+	})
+
+def delete_older_backups(ftp_client, folder_path, to_keep=None, remote_index=None, max_age_days=None, max_size=None, chains=None):
+	"""Apply the retention rules to `folder_path` with one listing and pipelined deletes.
+
+	With `chains`, a full dump and its change sets count as one backup,
+	deleted together and only once `chains.json` no longer lists them. Refused
+	deletes go to the Error Log, the next run tries them again."""
+	if remote_index is None:
+		remote_index = get_backup_index(ftp_client, folder_path)
+
+	# leftovers of interrupted database streams
+	to_delete = [f for f in remote_index.values() if f.name.endswith('.part')]
+	backups = [f for f in remote_index.values() if not f.name.endswith('.part')]
+
+	if chains:
+		entries, orphans = get_backup_chains(backups, chains)
+		to_delete += orphans
+
+		removed = [entry for entry in entries if entry.chain and not entry.files]
+		removed += get_backups_to_delete([entry for entry in entries if entry.files],
+			to_keep, max_age_days, max_size)
+		for entry in removed:
+			to_delete += entry.files
+			if entry.chain:
+				chains.remove(entry.chain)
+
+		if any(entry.chain for entry in removed):
+			# a restore must never find a listed chain with files missing
+			chains.save(ftp_client)
+	else:
+		to_delete += get_backups_to_delete(backups, to_keep, max_age_days, max_size)
+
+	failed = ftp_client.delete_many([combine_path(folder_path, f.name) for f in to_delete])
+	if failed:
+		frappe.log_error("\n".join("{0}: {1}".format(path, error) for path, error in failed),
+			"FTP Backup Retention")
+
+def get_backups_to_delete(files, to_keep=None, max_age_days=None, max_size=None, now=None):
+	"""Backups beyond `to_keep` count, older than `max_age_days` or past `max_size` bytes in total.
+
+	Counted newest first, the newest backup is always kept."""
+	files = sorted(files, key=lambda f: (f.modify or datetime.min, f.name), reverse=True)
+	cutoff = (now or datetime.utcnow()) - timedelta(days=max_age_days) if max_age_days else None
+
+	to_delete, total_size, full = [], 0, False
+	for i, f in enumerate(files):
+		total_size += f.size or 0
+		full = full or bool(max_size and total_size > max_size)
 
-	files.sort(key=lambda item:item[1], reverse=True)
-	for f, _ in files[to_keep:]:
-		print ('delete', f)
-		ftp_client.delete(f)
+		if i and ((to_keep and i >= to_keep) or full
+			or (cutoff and f.modify and f.modify < cutoff)):
+			to_delete.append(f)
 
+	return to_delete
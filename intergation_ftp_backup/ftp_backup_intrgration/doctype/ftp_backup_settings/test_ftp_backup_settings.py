@@ -3,8 +3,465 @@
 # See license.txt
 from __future__ import unicode_literals
 
+import os
+import zlib
+import random
+import hashlib
+import shutil
+import tempfile
 import frappe
 import unittest
+from io import BytesIO
+from datetime import datetime, time
+from intergation_ftp_backup.ftp_backup_intrgration.delta import make_signature, make_delta, apply_delta
+from intergation_ftp_backup.ftp_backup_intrgration.pipeline import (FileProcessor, DecodingReader, DecodingWriter,
+	is_encryption_available, generate_encryption_key, get_encryption_key, chunk_size)
+from intergation_ftp_backup.ftp_backup_intrgration.watermark import FileWatermark
+from intergation_ftp_backup.ftp_backup_intrgration.upload_queue import UploadQueue
+from intergation_ftp_backup.ftp_backup_intrgration.transfer import BandwidthSchedule, TokenBucket, BlockSizeTuner
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import (pick_checksum, check_checksum, HashingReader,
+	UploadVerificationError)
+from intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings import ftp_backup_settings as backup
+from intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings import (
+	get_backups_to_delete, parse_ftp_time, unix_list_line, dos_list_line, UploadStatusBuffer)
 
 class TestFTPBackupSettings(unittest.TestCase):
-	pass
+	def test_parse_ftp_time(self):
+		cases = [
+			("20190312081530", datetime(2019, 3, 12, 8, 15, 30)),
+			("20190312081530.123", datetime(2019, 3, 12, 8, 15, 30)),
+			("213 20190312081530", datetime(2019, 3, 12, 8, 15, 30)),
+			(" 213  20190312081530.5\r\n", datetime(2019, 3, 12, 8, 15, 30)),
+			("2019031208", None),
+			("213 not a time", None),
+			("", None),
+			(None, None)
+		]
+
+		for value, expected in cases:
+			self.assertEqual(parse_ftp_time(value), expected, value)
+
+	def test_list_lines(self):
+		cases = [
+			("-rw-r--r--    1 ftp      ftp       1048576 Mar 12 08:15 a.sql.gz",
+				unix_list_line, {"type": "-", "size": "1048576", "modify": "Mar 12 08:15", "name": "a.sql.gz"}),
+			("-rw-r--r--    1 1001     1001          12 Dec  3  2018 name with spaces.txt",
+				unix_list_line, {"type": "-", "size": "12", "modify": "Dec  3  2018", "name": "name with spaces.txt"}),
+			("drwxr-xr-x    2 ftp      ftp          4096 Jan  1 00:00 files",
+				unix_list_line, {"type": "d", "size": "4096", "modify": "Jan  1 00:00", "name": "files"}),
+			("lrwxrwxrwx    1 ftp      ftp             9 Jan  1 00:00 latest -> a.sql.gz",
+				unix_list_line, {"type": "l", "size": "9", "modify": "Jan  1 00:00", "name": "latest -> a.sql.gz"}),
+			("03-12-19  08:15AM              1048576 a.sql.gz",
+				dos_list_line, {"modify": "03-12-19  08:15AM", "size": "1048576", "name": "a.sql.gz"}),
+			("12-03-2018  11:05PM       <DIR>          files",
+				dos_list_line, {"modify": "12-03-2018  11:05PM", "size": "<DIR>", "name": "files"})
+		]
+
+		for line, pattern, expected in cases:
+			match = pattern.match(line)
+			self.assertTrue(match, line)
+			self.assertEqual(match.groupdict(), expected, line)
+
+		for line in ("total 24", "", "03-12-19 08:15 a.sql.gz"):
+			self.assertFalse(unix_list_line.match(line) or dos_list_line.match(line), line)
+
+	def test_backups_to_delete(self):
+		now = datetime(2019, 3, 12)
+		files = [frappe._dict({"name": "day{0}".format(day), "size": 100, "modify": datetime(2019, 3, day)})
+			for day in range(1, 12)]
+		files.append(frappe._dict({"name": "unknown", "size": 100, "modify": None}))
+
+		cases = [
+			({}, []),
+			({"to_keep": 3}, ["day8", "day7", "day6", "day5", "day4", "day3", "day2", "day1", "unknown"]),
+			({"to_keep": 20}, []),
+			({"max_age_days": 3}, ["day8", "day7", "day6", "day5", "day4", "day3", "day2", "day1"]),
+			({"max_size": 450}, ["day7", "day6", "day5", "day4", "day3", "day2", "day1", "unknown"]),
+			({"max_size": 50}, ["day10", "day9", "day8", "day7", "day6", "day5", "day4", "day3", "day2", "day1", "unknown"]),
+			({"to_keep": 10, "max_age_days": 5, "max_size": 800}, ["day6", "day5", "day4", "day3", "day2", "day1", "unknown"])
+		]
+
+		for options, expected in cases:
+			to_delete = get_backups_to_delete(files, now=now, **options)
+			self.assertEqual([f.name for f in to_delete], expected, options)
+
+		# the newest backup is kept even when it is too old or too large
+		self.assertEqual(get_backups_to_delete(files[:1], max_age_days=1, max_size=1, now=now), [])
+
+class TestUploadStatusBuffer(unittest.TestCase):
+	def setUp(self):
+		self.batches = []
+		self.update_file_ftp_status = backup.update_file_ftp_status
+		backup.update_file_ftp_status = self.batches.append
+
+	def tearDown(self):
+		backup.update_file_ftp_status = self.update_file_ftp_status
+
+	def test_batch_size(self):
+		buffer = UploadStatusBuffer()
+		for i in range(1200):
+			buffer.add("file-{0}".format(i))
+		self.assertEqual([len(batch) for batch in self.batches], [500, 500])
+		self.assertEqual(self.batches[1][0], "file-500")
+
+		buffer.flush()
+		self.assertEqual([len(batch) for batch in self.batches], [500, 500, 200])
+
+		buffer.flush()
+		self.assertEqual(len(self.batches), 3)
+
+	def test_interval(self):
+		buffer = UploadStatusBuffer(interval=30)
+		buffer.add("a")
+		self.assertEqual(self.batches, [])
+
+		buffer.last_flush -= 30
+		buffer.add("b")
+		self.assertEqual(self.batches, [["a", "b"]])
+
+class TestFileWatermark(unittest.TestCase):
+	def setUp(self):
+		self.watermark = FileWatermark("test-" + frappe.generate_hash(length=10))
+		self.start = (datetime(2019, 3, 1), "A")
+		self.watermark.reconciled({0: self.start, 1: self.start})
+
+	def track(self, *names):
+		rows = [frappe._dict({"name": name, "is_private": 0, "modified": datetime(2019, 3, day)})
+			for day, name in enumerate(names, 2)]
+		for f in rows:
+			self.watermark.track(f)
+		return [(f.modified, f.name) for f in rows]
+
+	def test_all_done(self):
+		positions = self.track("B", "C", "D")
+		for name in ("B", "C", "D"):
+			self.watermark.done(name)
+
+		self.assertEqual(self.watermark.position(0), positions[-1])
+		self.assertEqual(self.watermark.position(1), self.start)
+
+	def test_failed(self):
+		positions = self.track("B", "C", "D")
+		self.watermark.done("B")
+		self.watermark.failed("C")
+		self.watermark.done("D")
+
+		# up to the row before the failed one, scanned again next run
+		self.assertEqual(self.watermark.position(0), positions[0])
+
+	def test_pending(self):
+		positions = self.track("B", "C", "D", "E")
+		self.watermark.done("B")
+		self.watermark.done("C")
+		self.watermark.done("E")
+
+		self.assertEqual(self.watermark.position(0), positions[1])
+		self.watermark.done("D")
+		self.assertEqual(self.watermark.position(0), positions[-1])
+
+	def test_earliest_hold(self):
+		positions = self.track("B", "C", "D", "E")
+		self.watermark.failed("E")
+		self.watermark.failed("C")
+		self.watermark.done("B")
+		self.watermark.done("D")
+
+		self.assertEqual(self.watermark.position(0), positions[0])
+
+class TestTransfer(unittest.TestCase):
+	def test_night_window(self):
+		wrapping = BandwidthSchedule(100, 1000, time(22, 0), time(6, 0))
+		same_day = BandwidthSchedule(100, 1000, time(1, 0), time(5, 0))
+		cases = [
+			(time(21, 59), False, False),
+			(time(22, 0), True, False),
+			(time(23, 30), True, False),
+			(time(0, 0), True, False),
+			(time(3, 0), True, True),
+			(time(5, 59), True, False),
+			(time(6, 0), False, False),
+			(time(12, 0), False, False)
+		]
+
+		for now, wrapping_night, same_day_night in cases:
+			self.assertEqual(wrapping.is_night(now), wrapping_night, now)
+			self.assertEqual(same_day.is_night(now), same_day_night, now)
+
+		self.assertEqual(wrapping.rate(time(23, 0)), 1000)
+		self.assertEqual(wrapping.rate(time(12, 0)), 100)
+
+	def test_token_bucket(self):
+		bucket = TokenBucket(BandwidthSchedule(1000, 1000, time(0), time(0)))
+		# an empty bucket, a full second of debt
+		self.assertAlmostEqual(bucket.reserve(1000), 1, delta=0.01)
+
+		# idle time refills at most one second worth
+		bucket.updated -= 100
+		self.assertEqual(bucket.reserve(500), 0)
+		self.assertAlmostEqual(bucket.tokens, 500, delta=10)
+
+		unlimited = TokenBucket(BandwidthSchedule(0, 0, time(0), time(0)))
+		self.assertEqual(unlimited.reserve(10 ** 9), 0)
+
+	def tune(self, tuner, throughput):
+		"""Feed `tuner` blocks sent at `throughput(size)` bytes per second until it settles"""
+		sizes = []
+		while not tuner.settled:
+			sizes.append(tuner.size)
+			tuner.sample(tuner.size, tuner.size / float(throughput(tuner.size)))
+		return sizes
+
+	def test_block_size_tuner(self):
+		# faster with larger blocks up to 16 KB, no gain past it
+		tuner = BlockSizeTuner(4096, max_size=1024 * 1024, window=2)
+		sizes = self.tune(tuner, lambda size: min(size, 16384) * 100)
+		self.assertEqual(sorted(set(sizes)), [4096, 8192, 16384, 32768])
+		self.assertEqual(tuner.size, 16384)
+
+		# settled, later samples change nothing
+		tuner.sample(16384, 100)
+		self.assertEqual(tuner.size, 16384)
+
+		# always faster, stops at the largest size
+		tuner = BlockSizeTuner(4096, max_size=32768, window=2)
+		self.tune(tuner, lambda size: size * 100)
+		self.assertEqual(tuner.size, 32768)
+
+class TestChecksums(unittest.TestCase):
+	def test_pick_checksum(self):
+		cases = [
+			({"HASH": "SHA-1;SHA-256*;MD5;CRC32", "XCRC": ""}, ("HASH", "sha256", "SHA-256")),
+			({"HASH": "MD5;crc32*", "XCRC": ""}, ("HASH", "crc32", "CRC32")),
+			({"HASH": "SHA-1*;MD5"}, ("HASH", "md5", "MD5")),
+			({"HASH": "SHA-512*", "XMD5": ""}, ("XMD5", "md5", None)),
+			({"XCRC": "", "XMD5": ""}, ("XCRC", "crc32", None)),
+			({"XMD5": ""}, ("XMD5", "md5", None)),
+			({"MDTM": "", "SIZE": ""}, (None, None, None))
+		]
+
+		for features, expected in cases:
+			self.assertEqual(pick_checksum(features), expected, features)
+
+	def test_check_checksum(self):
+		data = b"checked upload"
+		reader = HashingReader(BytesIO(data), "crc32")
+		reader.read()
+		sha256 = hashlib.sha256(data).hexdigest()
+		crc32 = "%x" % (zlib.crc32(data) & 0xffffffff)
+
+		matching = [
+			("HASH", "SHA-256 0-14 {0} a.txt".format(sha256)),
+			("HASH", "sha-256 0-14 {0} a.txt".format(sha256.upper())),
+			("HASH", "CRC32 0-14 {0} a.txt".format(crc32)),
+			("XCRC", crc32.upper()),
+			("XCRC", "0000" + crc32),
+			# not hashed by the reader, not compared
+			("XMD5", "0" * 32),
+			("HASH", "SHA-1 0-14 {0} a.txt".format("0" * 40))
+		]
+		for command, reply in matching:
+			check_checksum("/a.txt", command, reply, reader)
+
+		failing = [
+			("HASH", "SHA-256 0-14 {0} a.txt".format("0" * 64)),
+			("HASH", "SHA-256"),
+			("XCRC", "0"),
+			("XCRC", "not-hex")
+		]
+		for command, reply in failing:
+			with self.assertRaises(UploadVerificationError):
+				check_checksum("/a.txt", command, reply, reader)
+
+class TestUploadQueue(unittest.TestCase):
+	name_range = ("test-queue-00", "test-queue-99")
+
+	def setUp(self):
+		sizes = [70, 10, 90, 30, 50, 20, 80, 40, 60, 100]
+		for i, size in enumerate(sizes):
+			name = "test-queue-{0:02d}".format(i)
+			frappe.db.sql("""insert into `tabFile` (name, file_name, file_url, is_private, is_folder,
+				uploaded_to_dropbox, file_size, creation, modified)
+				values (%s, %s, %s, 0, 0, 0, %s, %s, %s)""",
+				(name, name, "/files/" + name, size, datetime(2019, 3, 1), datetime(2019, 3, 1)))
+
+		self.smallest_first = ["test-queue-{0:02d}".format(i) for i in sorted(range(len(sizes)), key=sizes.__getitem__)]
+
+	def tearDown(self):
+		self.queue().clear()
+		frappe.db.sql("delete from `tabFile` where name like %s", "test-queue-%")
+
+	def queue(self, resume=False):
+		return UploadQueue(0, "Smallest First", self.name_range, page_length=3, resume=resume)
+
+	def flag(self, names):
+		frappe.db.sql("""update `tabFile` set uploaded_to_dropbox=1
+			where name in ({0})""".format(", ".join(["%s"] * len(names))), tuple(names))
+
+	def time_out(self):
+		"""A job handing out 5 files, cut off in the second page, the third upload failed"""
+		files = iter(self.queue())
+		handed_out = [next(files).name for i in range(5)]
+		self.assertEqual(handed_out, self.smallest_first[:5])
+		self.flag(handed_out[:2] + handed_out[3:])
+
+	def test_order(self):
+		self.assertEqual([f.name for f in self.queue()], self.smallest_first)
+		self.assertEqual([f.name for f in UploadQueue(0, "Name", self.name_range, page_length=3)],
+			sorted(self.smallest_first))
+
+	def test_retry(self):
+		self.time_out()
+		order = self.smallest_first
+
+		# after the last saved page, then the failed upload before it
+		self.assertEqual([f.name for f in self.queue(resume=True)], order[5:] + [order[2]])
+		self.assertFalse(self.queue().load())
+
+	def test_fresh_run(self):
+		self.time_out()
+		order = self.smallest_first
+
+		# the next scheduled run starts at the top of the order
+		self.assertEqual([f.name for f in self.queue()], [order[2]] + order[5:])
+		self.assertFalse(self.queue().load())
+
+class TestDelta(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.random = random.Random(23)
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def write(self, name, data):
+		path = os.path.join(self.folder, name)
+		with open(path, 'wb') as f:
+			f.write(data)
+		return path
+
+	def read(self, path):
+		with open(path, 'rb') as f:
+			return f.read()
+
+	def random_bytes(self, size):
+		return bytes(bytearray(self.random.getrandbits(8) for i in range(size)))
+
+	def patch(self, base, new, block_size=1024):
+		"""Patch of `new` against `base`, applied to a file holding `base`"""
+		signature = make_signature(self.write('base', base), block_size)
+		patch = make_delta(self.write('new', new), signature)
+		self.assertTrue(patch)
+
+		path = self.write('local', base)
+		with patch:
+			self.assertTrue(apply_delta(path, patch))
+		return self.read(path)
+
+	def test_round_trip(self):
+		base = self.random_bytes(64 * 1024 + 100)
+		cases = {
+			"unchanged": base,
+			"changed block": base[:5000] + self.random_bytes(300) + base[5300:],
+			"inserted bytes": base[:2000] + b"inserted" + base[2000:],
+			"removed bytes": base[:3000] + base[3500:],
+			"appended": base + self.random_bytes(2000),
+			"truncated": base[:40000],
+			"moved blocks": base[32 * 1024:] + base[:32 * 1024]
+		}
+
+		for case, new in cases.items():
+			self.assertEqual(self.patch(base, new), new, case)
+
+	def test_patched_already(self):
+		base = self.random_bytes(16 * 1024)
+		new = base[:1000] + b"changed" + base[1007:]
+		signature = make_signature(self.write('base', base), 1024)
+		patch = make_delta(self.write('new', new), signature)
+
+		with patch:
+			self.assertTrue(apply_delta(self.write('local', new), patch))
+		self.assertEqual(self.read(os.path.join(self.folder, 'local')), new)
+
+	def test_other_base(self):
+		base = self.random_bytes(16 * 1024)
+		signature = make_signature(self.write('base', base), 1024)
+		patch = make_delta(self.write('new', base + b"more"), signature)
+
+		with patch:
+			self.assertFalse(apply_delta(self.write('local', base[:-1]), patch))
+
+	def test_too_large(self):
+		signature = make_signature(self.write('base', self.random_bytes(16 * 1024)), 1024)
+		self.assertIsNone(make_delta(self.write('new', self.random_bytes(16 * 1024)), signature))
+
+class TestProcessedFiles(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.key = get_encryption_key(generate_encryption_key()) if is_encryption_available() else None
+		cls.processors = {}
+		for compress in (False, True):
+			cls.processors[compress, None] = FileProcessor(None, compress, 2)
+			if cls.key:
+				cls.processors[compress, cls.key] = FileProcessor(cls.key, compress, 2)
+
+	@classmethod
+	def tearDownClass(cls):
+		for processor in cls.processors.values():
+			processor.close()
+
+	def contents(self):
+		text = b"".join(b"line %d of a compressible file\n" % i for i in range(100000))
+		return {
+			"empty": b"",
+			"short": b"x",
+			"text": text,
+			"random": os.urandom(chunk_size + 1000),
+			"chunk size": text[:chunk_size]
+		}
+
+	def encode(self, processor, data):
+		reader = processor.reader(BytesIO(data))
+		encoded = b"".join(iter(lambda: reader.read(8192), b""))
+		self.assertEqual(reader.source_size, len(data))
+		return encoded
+
+	def test_round_trip(self):
+		for (compress, key), processor in self.processors.items():
+			for case, data in self.contents().items():
+				encoded = self.encode(processor, data)
+				self.assertEqual(DecodingReader(BytesIO(encoded), key).read(), data, case)
+
+				output = []
+				writer = DecodingWriter(output.append, key)
+				for i in range(0, len(encoded), 1000):
+					writer.write(encoded[i:i + 1000])
+				writer.close()
+				self.assertEqual(b"".join(output), data, case)
+
+	def test_compression(self):
+		data = self.contents()["text"]
+		self.assertLess(len(self.encode(self.processors[True, None], data)), len(data) / 2)
+		self.assertGreater(len(self.encode(self.processors[False, None], data)), len(data))
+
+	def test_truncated(self):
+		encoded = self.encode(self.processors[True, None], self.contents()["text"])
+		with self.assertRaises(ValueError):
+			DecodingReader(BytesIO(encoded[:-20])).read()
+
+	@unittest.skipUnless(is_encryption_available(), "needs the cryptography package")
+	def test_encryption(self):
+		data = self.contents()["text"]
+		encoded = self.encode(self.processors[True, self.key], data)
+		self.assertNotIn(b"compressible", encoded)
+
+		with self.assertRaises(ValueError):
+			DecodingReader(BytesIO(encoded)).read()
+
+		other_key = get_encryption_key(generate_encryption_key())
+		with self.assertRaises(ValueError):
+			DecodingReader(BytesIO(encoded), other_key).read()
+
+		tampered = bytearray(encoded)
+		tampered[-100] ^= 1
+		with self.assertRaises(ValueError):
+			DecodingReader(BytesIO(bytes(tampered)), self.key).read()
@@ -0,0 +1,659 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import time
+import zlib
+import socket
+import hashlib
+import threading
+import posixpath
+from io import BytesIO
+from collections import deque
+from ftplib import FTP, FTP_TLS, error_perm, error_temp, error_reply, error_proto
+from intergation_ftp_backup.ftp_backup_intrgration.transfer import BlockSizeTuner
+
+try:
+	from ssl import SSLSocket
+except ImportError:
+	SSLSocket = None
+
+# DELE commands sent before their replies are read
+delete_window = 32
+
+# storbinary's default
+default_block_size = 8192
+
+# control commands the old per-file sequence sent around each upload:
+# PWD + CWD folder + CWD back to check the folder, PWD + CWD folder + CWD back to STOR
+folder_check_round_trips = 3
+relative_store_round_trips = 3
+
+# checksums of HASH (draft-bryan-ftpext-hash) by preference, as hashlib names;
+# sha256 is hashed for the manifest anyway, crc32 is the cheapest to add
+hash_algorithms = [("SHA-256", "sha256"), ("CRC32", "crc32"), ("MD5", "md5"), ("SHA-1", "sha1")]
+
+# seconds without a control command before a NOOP, see `set_transfer`
+default_keepalive_interval = 60
+
+# logins tried after a dropped connection, waiting 1, 2, 4... seconds before each
+reconnect_attempts = 5
+max_reconnect_wait = 30
+
+# 421 is the server closing the session, 425 and 426 a failed or dropped data connection
+connection_error_codes = ('421', '425', '426')
+
+class UploadVerificationError(Exception):
+	pass
+
+class BackupClientMixin(object):
+	"""Session state shared by the plain and the TLS client.
+
+	Remote paths are resolved against the login directory once, so uploads
+	go by absolute path and never change the working directory. Folders
+	checked or created in this session are remembered in `known_dirs`;
+	`round_trips_saved` counts the control commands that saved.
+	`command_stats` holds the count and seconds per command verb.
+	Uploads are sent in blocks of `block_size`, see `set_transfer`, and
+	checked with `verify`.
+
+	A session idle for `keepalive_interval` seconds sends a NOOP before its
+	next command, and during long uploads on the control connection. A
+	dropped session logs in again, see `reconnect`, and `store` goes on
+	with the current file from what the server has.
+	"""
+	def init_session(self):
+		self.ftp_settings = None
+		self.keepalive_interval = default_keepalive_interval
+		self.last_command = time.time()
+		self.in_transfer = False
+		self.home = None
+		self.features = None
+		self.verification = "Checksum"
+		self.checksum = None
+		self.known_dirs = set(['/'])
+		self.round_trips_saved = 0
+		self.command_stats = {}
+		self.sent_commands = deque()
+		self.block_size = default_block_size
+		self.bucket = None
+		self.tuner = None
+		self.delta_threshold = 0
+		self.processor = None
+
+	def reset_stats(self):
+		"""Start counting afresh, for a session reused by another backup"""
+		self.round_trips_saved = 0
+		self.command_stats = {}
+
+	def set_transfer(self, transfer):
+		"""Block size, auto tuning and the shared `TokenBucket` used by `store`"""
+		self.block_size = transfer.block_size or default_block_size
+		self.bucket = transfer.bucket
+		self.tuner = BlockSizeTuner(self.block_size) if transfer.auto_tune else None
+		self.verification = transfer.verification or "Checksum"
+		self.checksum = None
+		self.delta_threshold = transfer.delta_threshold or 0
+		self.processor = transfer.processor
+		if transfer.keepalive_interval is not None:
+			self.keepalive_interval = transfer.keepalive_interval
+
+	def open_session(self, ftp_settings):
+		"""Connect and log in, again by `reconnect`"""
+		self.ftp_settings = ftp_settings
+		self.connect(ftp_settings['host'], int(ftp_settings.get('port') or 21))
+		# a fresh session, no keepalive before the login
+		self.last_command = time.time()
+		self.login(ftp_settings['user'], ftp_settings['passwd'])
+
+	def reconnect(self):
+		"""Log in on a new connection, waiting longer after each failed attempt.
+
+		Folders and features of the old session stay known, they are server state."""
+		self.close()
+		self.sent_commands.clear()
+
+		for attempt in range(reconnect_attempts):
+			time.sleep(min(2 ** attempt, max_reconnect_wait))
+			start = time.time()
+			try:
+				self.open_session(self.ftp_settings)
+				# counted with the commands, so reconnects show on the FTP Backup Run
+				stats = self.command_stats.setdefault('RECONNECT', [0, 0])
+				stats[0] += 1
+				stats[1] += time.time() - start
+				return
+			except Exception as e:
+				self.close()
+				if not is_connection_error(e) or attempt == reconnect_attempts - 1:
+					raise
+
+	def keepalive(self):
+		"""NOOP a session idle too long, reconnect when it is gone"""
+		try:
+			self.voidcmd('NOOP')
+		except Exception as e:
+			if not self.ftp_settings or not is_connection_error(e):
+				raise
+			self.reconnect()
+
+	def putcmd(self, line):
+		if (self.keepalive_interval and not self.in_transfer and self.sock
+			and time.time() - self.last_command > self.keepalive_interval):
+			self.last_command = time.time()
+			self.keepalive()
+
+		self.last_command = time.time()
+		# the verb only, arguments may hold the password
+		self.sent_commands.append((line.split(' ', 1)[0].upper(), time.time()))
+		super(BackupClientMixin, self).putcmd(line)
+
+	def getresp(self):
+		"""Times each command from sending it to its final reply.
+
+		Replies come back in the order commands were sent, which also holds
+		for pipelined DELE. A 1xx reply is preliminary, so a STOR or RETR is
+		timed until the transfer completes."""
+		try:
+			resp = super(BackupClientMixin, self).getresp()
+		except Exception:
+			self.command_done()
+			raise
+
+		if not resp.startswith('1'):
+			self.command_done()
+
+		return resp
+
+	def command_done(self):
+		if not self.sent_commands:
+			# the welcome message
+			return
+
+		command, sent = self.sent_commands.popleft()
+		stats = self.command_stats.setdefault(command, [0, 0])
+		stats[0] += 1
+		stats[1] += time.time() - sent
+
+	def abspath(self, path):
+		if not path.startswith('/'):
+			if self.home is None:
+				self.home = self.pwd()
+			path = posixpath.join(self.home, path)
+
+		return posixpath.normpath(path)
+
+	def ensure_dir(self, path):
+		"""Create `path` and missing parents, returns the absolute path"""
+		path = self.abspath(path)
+		if path in self.known_dirs:
+			self.round_trips_saved += folder_check_round_trips
+			return path
+
+		missing = []
+		current = path
+		while current not in self.known_dirs:
+			try:
+				self.cwd(current)
+				break
+			except error_perm:
+				missing.append(current)
+				current = posixpath.dirname(current)
+
+		self.remember_dir(current)
+		for folder in reversed(missing):
+			try:
+				self.mkd(folder)
+			except error_perm:
+				# created by another session since the existence check
+				self.cwd(folder)
+			self.known_dirs.add(folder)
+
+		return path
+
+	def remember_dir(self, path):
+		while path not in self.known_dirs:
+			self.known_dirs.add(path)
+			path = posixpath.dirname(path)
+
+	def supports(self, feature):
+		"""Whether the server advertises `feature` in its FEAT reply"""
+		if self.features is None:
+			try:
+				self.features = parse_features(self.sendcmd('FEAT').splitlines()[1:-1])
+			except error_perm:
+				self.features = {}
+
+		return feature.upper() in self.features
+
+	def get_checksum(self):
+		"""(command, hashlib name) of the checksum used to verify uploads, (None, None) for none"""
+		if self.checksum is None:
+			self.checksum = (None, None)
+			if self.verification == "Checksum":
+				self.supports('HASH')
+				command, algorithm, name = pick_checksum(self.features)
+				try:
+					if command == 'HASH':
+						self.sendcmd('OPTS HASH ' + name)
+					self.checksum = (command, algorithm)
+				except error_perm:
+					pass
+
+		return self.checksum
+
+	def verify(self, path, reader):
+		"""Compare the remote SIZE, and checksum where supported, of `path` with what `reader` sent"""
+		if self.verification == "None":
+			return
+
+		size = self.remote_size(path)
+		if size is not None and size != reader.size:
+			raise UploadVerificationError("{0}: {1} bytes sent, {2} stored".format(path, reader.size, size))
+
+		command, algorithm = self.get_checksum()
+		if not command:
+			return
+
+		try:
+			reply = self.sendcmd(command + ' ' + path)
+		except error_perm as e:
+			if not is_unsupported_command_error(e):
+				raise
+			self.checksum = (None, None)
+			return
+
+		check_checksum(path, command, reply[4:], reader)
+
+	def remote_size(self, path):
+		"""SIZE of `path` in bytes, None when missing or not supported"""
+		try:
+			self.voidcmd('TYPE I')
+			return self.size(path)
+		except error_perm:
+			return None
+
+	def store(self, path, fp, rest=None, callback=None):
+		"""STOR `fp` to `path`, creating the parent folder when needed.
+
+		When the connection drops, a seekable `fp` is sent on from the
+		remote size after `reconnect`, from the start without REST."""
+		path = posixpath.join(self.ensure_dir(posixpath.dirname(path)), posixpath.basename(path))
+
+		for attempt in range(reconnect_attempts):
+			try:
+				self.send_blocks('STOR ' + path, fp, callback=callback, rest=rest)
+				break
+			except Exception as e:
+				if (not is_connection_error(e) or not self.ftp_settings or not is_seekable(fp)
+					or attempt == reconnect_attempts - 1):
+					raise
+
+				self.reconnect()
+				rest = (self.remote_size(path) or None) if self.supports('REST') else None
+				fp.seek(rest or 0)
+
+		self.round_trips_saved += relative_store_round_trips
+
+		return path
+
+	def send_blocks(self, cmd, fp, callback=None, rest=None):
+		"""`storbinary` with a block size that can change between blocks and a bandwidth cap.
+
+		A NOOP goes over the idle control connection every `keepalive_interval`
+		seconds of the transfer, so no firewall or server drops it meanwhile."""
+		self.voidcmd('TYPE I')
+		conn = self.transfercmd(cmd, rest)
+		noops = 0
+		self.in_transfer = True
+		try:
+			while True:
+				start = time.time()
+				buf = fp.read(self.tuner.size if self.tuner else self.block_size)
+				if not buf:
+					break
+
+				conn.sendall(buf)
+				if self.tuner:
+					self.tuner.sample(len(buf), time.time() - start)
+				if self.bucket:
+					self.bucket.consume(len(buf))
+				if callback:
+					callback(buf)
+
+				if self.keepalive_interval and time.time() - self.last_command > self.keepalive_interval:
+					self.putcmd('NOOP')
+					noops += 1
+
+			# shut the TLS layer down before the reply, like storbinary
+			if SSLSocket is not None and isinstance(conn, SSLSocket):
+				conn.unwrap()
+		finally:
+			self.in_transfer = False
+			conn.close()
+
+		return self.transfer_reply(noops)
+
+	def transfer_reply(self, noops):
+		"""The reply of a transfer, read with those of the `noops` sent during it.
+
+		Servers answer a NOOP during the transfer or only after it, so the
+		replies are told apart by code: 226 or 250 closes the transfer."""
+		if not noops:
+			return self.voidresp()
+
+		replies = []
+		for i in range(noops + 1):
+			replies.append(self.getmultiline())
+			self.command_done()
+
+		resp = ([r for r in replies if r[:3] in ('226', '250')] or [r for r in replies if r[:3] != '200'] or replies)[0]
+		if resp[:1] == '4':
+			raise error_temp(resp)
+		if resp[:1] != '2':
+			raise error_perm(resp)
+
+		return resp
+
+	def resume(self, path, fp, offset, callback=None):
+		"""Continue an interrupted upload of `fp` from `offset` with REST + STOR.
+
+		If the server does not support REST the file is sent again from the
+		start. Returns the offset the transfer actually started at."""
+		if offset and self.supports('REST'):
+			fp.seek(offset)
+			try:
+				self.store(path, fp, rest=offset, callback=callback)
+				return offset
+			except error_perm as e:
+				if not is_unsupported_command_error(e):
+					raise
+
+		fp.seek(0)
+		self.store(path, fp, callback=callback)
+		return 0
+
+	def delete_many(self, paths, window=delete_window):
+		"""DELE `paths`, pipelining up to `window` commands before reading the replies.
+
+		Returns (path, error) for every path the server refused."""
+		failed = []
+		for i in range(0, len(paths), window):
+			batch = paths[i:i + window]
+			for path in batch:
+				self.putcmd('DELE ' + path)
+
+			for path in batch:
+				try:
+					self.voidresp()
+				except (error_perm, error_temp, error_reply) as e:
+					failed.append((path, e))
+
+		return failed
+
+class BackupFTP(BackupClientMixin, FTP):
+	def __init__(self, *args, **kwargs):
+		self.init_session()
+		FTP.__init__(self, *args, **kwargs)
+
+class BackupFTP_TLS(BackupClientMixin, FTP_TLS):
+	"""Protects the data connections too, resuming the TLS session of the control connection.
+
+	Servers like vsftpd and FileZilla Server refuse a data connection that
+	does not reuse it, and a resumed session skips a full handshake per file."""
+	def __init__(self, *args, **kwargs):
+		self.init_session()
+		FTP_TLS.__init__(self, *args, **kwargs)
+
+	def open_session(self, ftp_settings):
+		super(BackupFTP_TLS, self).open_session(ftp_settings)
+		self.prot_p()
+
+	def ntransfercmd(self, cmd, rest=None):
+		conn, size = FTP.ntransfercmd(self, cmd, rest)
+		if self._prot_p:
+			conn = self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session)
+
+		return conn, size
+
+class HashingReader(object):
+	"""Wraps a file object and hashes what is read from it, in the same pass as the upload.
+
+	Always sha256, plus `checksum` when the server verifies with another one."""
+	def __init__(self, fp, checksum=None):
+		self.fp = fp
+		self.algorithms = ['sha256']
+		if checksum and checksum not in self.algorithms:
+			self.algorithms.append(checksum)
+		self.reset()
+
+	def reset(self):
+		self.hashes = dict((algorithm, Crc32() if algorithm == 'crc32' else hashlib.new(algorithm))
+			for algorithm in self.algorithms)
+		self.size = 0
+
+	def read(self, size=-1):
+		data = self.fp.read(size)
+		for digest in self.hashes.values():
+			digest.update(data)
+		self.size += len(data)
+
+		return data
+
+	def skip(self, offset, block_size=1024 * 1024):
+		"""Hash up to `offset` without sending it, for an upload resumed there"""
+		while self.size < offset:
+			if not self.read(min(block_size, offset - self.size)):
+				break
+
+	def seek(self, offset):
+		"""Rehashes from the start, unless `offset` is where the hashes are"""
+		if offset == self.size:
+			return
+
+		self.fp.seek(0)
+		self.reset()
+		self.skip(offset)
+
+	def seekable(self):
+		return is_seekable(self.fp)
+
+	def hexdigest(self, algorithm='sha256'):
+		return self.hashes[algorithm].hexdigest()
+
+class Crc32(object):
+	def __init__(self):
+		self.value = 0
+
+	def update(self, data):
+		self.value = zlib.crc32(data, self.value)
+
+	def hexdigest(self):
+		return "%08x" % (self.value & 0xffffffff)
+
+def parse_features(lines):
+	"""FEAT reply lines, without the first and last, to a dict of feature -> parameters"""
+	features = {}
+	for line in lines:
+		name, _, params = line.strip().partition(' ')
+		features[name.upper()] = params
+
+	return features
+
+def pick_checksum(features):
+	"""(command, hashlib name, HASH name) of the best checksum in `features`"""
+	if 'HASH' in features:
+		offered = [name.strip().rstrip('*').upper() for name in features['HASH'].split(';')]
+		for name, algorithm in hash_algorithms:
+			if name in offered:
+				return 'HASH', algorithm, name
+
+	if 'XCRC' in features:
+		return 'XCRC', 'crc32', None
+	if 'XMD5' in features:
+		return 'XMD5', 'md5', None
+
+	return None, None, None
+
+def check_checksum(path, command, reply, reader):
+	"""Compare the checksum in the text of a HASH or XCRC/XMD5 reply with the one `reader` hashed.
+
+	HASH answers `<algorithm> <range> <hex> <name>`, the X commands the hex
+	first. A HASH in an algorithm `reader` did not hash is not compared.
+	Compared as numbers, servers differ in case and leading zeros."""
+	words = reply.split()
+	if command == 'HASH':
+		algorithm = dict(hash_algorithms).get(words[0].upper()) if words else None
+		value = words[2] if len(words) > 2 else ''
+	else:
+		algorithm = 'crc32' if command == 'XCRC' else 'md5'
+		value = words[0] if words else ''
+
+	if algorithm not in reader.hashes:
+		return
+
+	expected = reader.hexdigest(algorithm)
+	try:
+		matches = int(value, 16) == int(expected, 16)
+	except ValueError:
+		raise UploadVerificationError("{0}: unexpected {1} reply {2}".format(path, command, reply))
+
+	if not matches:
+		raise UploadVerificationError("{0}: {1} {2} on the server, {3} sent".format(path, command, value, expected))
+
+def retrieve_bytes(ftp_client, path):
+	"""Content of `path`, None when there is no such file"""
+	buf = BytesIO()
+	try:
+		ftp_client.retrbinary('RETR ' + path, buf.write)
+	except error_perm as e:
+		if not str(e).startswith('550'):
+			raise
+		return None
+
+	return buf.getvalue()
+
+def store_renamed(ftp_client, path, fp):
+	"""Store and verify `fp` as `<path>.part`, then rename it to `path`. Returns the size stored.
+
+	`path` is never seen half written, a truncated file would fail to load
+	on every later run. On servers refusing to rename onto an existing
+	file, the old one is deleted first."""
+	reader = HashingReader(fp, ftp_client.get_checksum()[1])
+	ftp_client.store(path + '.part', reader)
+	ftp_client.verify(path + '.part', reader)
+
+	try:
+		ftp_client.rename(path + '.part', path)
+	except error_perm:
+		ftp_client.delete_many([path])
+		ftp_client.rename(path + '.part', path)
+
+	return reader.size
+
+def get_ftp_client(ftp_settings, use_tls, transfer=None, backend=None):
+	if backend == "asyncio":
+		from intergation_ftp_backup.ftp_backup_intrgration.aio_client import AsyncFTPClient
+		return AsyncFTPClient(ftp_settings, use_tls, transfer)
+
+	ftp_client = BackupFTP_TLS() if use_tls else BackupFTP()
+	ftp_client.open_session(ftp_settings)
+
+	if transfer:
+		ftp_client.set_transfer(transfer)
+
+	return ftp_client
+
+class ConnectionPool(object):
+	"""Logged in ftplib sessions kept per host, port, user and TLS, for backups of several sites.
+
+	A session serves one backup at a time and must only be released after
+	a backup that completed, so no reply is left unread on it. On reuse it
+	has to answer a NOOP first. asyncio sessions are not pooled.
+	"""
+	def __init__(self, max_idle=4):
+		self.max_idle = max_idle
+		self.idle = {}
+		self.lock = threading.Lock()
+
+	def acquire(self, ftp_settings, use_tls, transfer=None, backend=None):
+		if backend == "asyncio":
+			return get_ftp_client(ftp_settings, use_tls, transfer, backend)
+
+		key = (ftp_settings['host'], int(ftp_settings.get('port') or 21), ftp_settings['user'],
+			ftp_settings['passwd'], bool(use_tls))
+
+		while True:
+			with self.lock:
+				sessions = self.idle.get(key)
+				ftp_client = sessions.pop() if sessions else None
+
+			if not ftp_client:
+				break
+
+			try:
+				ftp_client.voidcmd('NOOP')
+			except Exception:
+				close_quietly(ftp_client)
+				continue
+
+			ftp_client.reset_stats()
+			if transfer:
+				ftp_client.set_transfer(transfer)
+			return ftp_client
+
+		ftp_client = get_ftp_client(ftp_settings, use_tls, transfer)
+		ftp_client.pool_key = key
+		return ftp_client
+
+	def release(self, ftp_client):
+		key = getattr(ftp_client, 'pool_key', None)
+		if key:
+			with self.lock:
+				sessions = self.idle.setdefault(key, [])
+				if len(sessions) < self.max_idle:
+					sessions.append(ftp_client)
+					return
+
+		close_quietly(ftp_client)
+
+	def close(self):
+		with self.lock:
+			sessions = [ftp_client for clients in self.idle.values() for ftp_client in clients]
+			self.idle = {}
+
+		for ftp_client in sessions:
+			close_quietly(ftp_client)
+
+def close_quietly(ftp_client):
+	try:
+		ftp_client.quit()
+	except Exception:
+		try:
+			ftp_client.close()
+		except Exception:
+			pass
+
+def is_connection_error(e):
+	"""Whether `e` means the session is gone, as opposed to the server refusing a command"""
+	if isinstance(e, (error_temp, error_reply, error_perm)):
+		return str(e)[:3] in connection_error_codes
+
+	return isinstance(e, (EOFError, socket.error, error_proto))
+
+def is_seekable(fp):
+	seekable = getattr(fp, 'seekable', None)
+	return bool(seekable and seekable())
+
+def is_unsupported_command_error(e):
+	return str(e)[:3] in ('500', '501', '502', '504')
+
+def is_backend_available(backend):
+	if backend == "asyncio":
+		try:
+			import aioftp
+		except ImportError:
+			return False
+
+	return True
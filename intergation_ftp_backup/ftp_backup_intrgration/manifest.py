@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import json
+import hashlib
+from io import BytesIO
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import retrieve_bytes, store_renamed
+from frappe.utils import encode
+
+manifest_version = 1
+
+class ContentManifest(object):
+	"""Content hash manifest stored next to the backup on the FTP server.
+
+	`objects` maps a sha256 to the remote path holding that content and its
+	size. `links` maps other remote paths to the sha256 they share: when an
+	attachment's content is already on the target it is linked instead of
+	uploaded again. File names linked since the last save are kept in
+	`linked` and only handed back by `save`, so `uploaded_to_dropbox` is never
+	set for a link the server does not know about yet. When a path is
+	overwritten with other content, the links to its old content are dropped
+	and kept in `unlinked`, their attachments have to be uploaded again.
+	"""
+	def __init__(self, path, data=None):
+		data = data or {}
+
+		self.path = path
+		self.objects = data.get("objects", {})
+		self.links = data.get("links", {})
+		self.linked = []
+		self.unlinked = []
+
+		self.paths = {}
+		self.sizes = set()
+		for digest, obj in self.objects.items():
+			self.paths[obj["path"]] = digest
+			self.sizes.add(obj["size"])
+
+		for path, digest in self.links.items():
+			self.paths[path] = digest
+
+	@classmethod
+	def load(cls, ftp_client, path):
+		data = retrieve_bytes(ftp_client, path)
+		if data is None:
+			return cls(path)
+
+		return cls(path, json.loads(data.decode('utf-8')))
+
+	def has(self, path, size):
+		"""Whether `path` was stored or linked with content of `size` bytes"""
+		digest = self.paths.get(path)
+		return bool(digest) and digest in self.objects and self.objects[digest]["size"] == size
+
+	def find(self, filepath, size):
+		"""sha256 of `filepath` if that content is on the target already.
+
+		The local file is only hashed when an object of the same size exists."""
+		if size not in self.sizes:
+			return None
+
+		digest = get_file_hash(filepath)
+		return digest if digest in self.objects else None
+
+	def add(self, digest, path, size):
+		old_digest = self.paths.get(path)
+		if old_digest and old_digest != digest and self.objects.get(old_digest, {}).get("path") == path:
+			# overwritten with different content, nothing on the target holds the old one anymore
+			del self.objects[old_digest]
+			self.unlink(old_digest)
+
+		self.links.pop(path, None)
+		self.objects[digest] = {"path": path, "size": size}
+		self.paths[path] = digest
+		self.sizes.add(size)
+
+	def link(self, path, digest, file_name):
+		self.links[path] = digest
+		self.paths[path] = digest
+		self.linked.append((path, file_name))
+
+	def unlink(self, digest):
+		"""Drop the links to `digest`"""
+		paths = [path for path, link_digest in self.links.items() if link_digest == digest]
+		for path in paths:
+			del self.links[path]
+			del self.paths[path]
+
+		# not flagged yet, they simply stay unflagged
+		self.linked = [(path, file_name) for path, file_name in self.linked if path not in paths]
+		self.unlinked.extend(paths)
+
+	def save(self, ftp_client):
+		"""Write the manifest to the server, returns File names linked since the last save"""
+		data = json.dumps({
+			"version": manifest_version,
+			"objects": self.objects,
+			"links": self.links
+		}, sort_keys=True)
+
+		store_renamed(ftp_client, self.path, BytesIO(encode(data)))
+
+		linked, self.linked = self.linked, []
+		return [file_name for path, file_name in linked]
+
+def get_file_hash(filepath, algorithm='sha256', block_size=1024 * 1024):
+	digest = hashlib.new(algorithm)
+	with open(encode(filepath), 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			digest.update(block)
+
+	return digest.hexdigest()
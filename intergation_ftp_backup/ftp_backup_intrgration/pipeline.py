@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""Compression and encryption of uploads in a process pool.
+
+A processed upload is stored as `<name>.ftpz`: a header, then the content
+in records of up to `chunk_size` bytes, each compressed with zlib unless
+that saves little, and sealed with AES-GCM when there is a key. A record's
+nonce is the file's random prefix and the record number, and its flags
+and number are authenticated with the header, so records can not be
+reordered. The file ends with an empty record flagged last, a truncated
+file fails to decode.
+
+The records are made by the processes of a `FileProcessor` while the ones
+before are sent: a `ProcessedReader` keeps up to `max_pending_per_worker`
+records per process in the pool and hands them to `storbinary` in order.
+Restores decode in process, with `DecodingWriter` or `DecodingReader`.
+"""
+
+from __future__ import unicode_literals
+import os
+import zlib
+import base64
+import struct
+import hashlib
+import binascii
+import multiprocessing
+from collections import deque
+
+try:
+	from cryptography.exceptions import InvalidTag
+	from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+	AESGCM = None
+
+processed_suffix = ".ftpz"
+processed_magic = b"FTPZ0001"
+
+# magic, flags, nonce prefix
+file_header = struct.Struct(">8sB8s")
+# flags, length of the payload that follows
+record_header = struct.Struct(">BI")
+# flags and number of a record, authenticated with the file header
+record_aad = struct.Struct(">BQ")
+
+file_encrypted = 1
+record_compressed = 1
+record_last = 2
+
+chunk_size = 1024 * 1024
+max_pending_per_worker = 2
+
+# a record kept only when compression saves more than this share
+min_compression_saving = 0.1
+compression_level = 6
+
+# seconds to wait for one record before the pool counts as stuck
+record_timeout = 600
+
+# compressed formats, sent without another compression pass
+compressed_extensions = (".gz", ".tgz", ".bz2", ".xz", ".zst", ".zip", ".7z", ".rar",
+	".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".m4a", ".ogg", ".mp4", ".mov",
+	".avi", ".mkv", ".webm", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".ftpz")
+
+# the state of a pool process, see `init_worker`
+worker = {}
+
+# backups running at once on threads of this process, see `site_scheduler`,
+# splitting the cpus between the default pools of their processors
+concurrent_backups = 1
+
+def is_encryption_available():
+	return AESGCM is not None
+
+def is_processed(name):
+	return name.endswith(processed_suffix)
+
+def get_original_name(name):
+	"""Name of the content of a processed file"""
+	return name[:-len(processed_suffix)] if is_processed(name) else name
+
+def is_compressible(filename):
+	return not filename.lower().endswith(compressed_extensions)
+
+def generate_encryption_key():
+	return base64.b64encode(os.urandom(32)).decode('ascii')
+
+def get_encryption_key(value):
+	"""The key of the base64 `value`, ValueError when it is not one of an AES key size"""
+	try:
+		key = base64.b64decode(value.strip())
+	except (TypeError, binascii.Error):
+		raise ValueError("the encryption key is not base64")
+
+	if len(key) not in (16, 24, 32):
+		raise ValueError("the encryption key must be 128, 192 or 256 bits")
+
+	return key
+
+def get_nonce(prefix, index):
+	return prefix + struct.pack(">I", index)
+
+def init_worker(key):
+	worker["aead"] = AESGCM(key) if key else None
+
+def process_record(header, prefix, index, data, compress, last):
+	"""Compress and seal one record, runs in a pool process"""
+	flags = record_last if last else 0
+	if compress and data:
+		compressed = zlib.compress(data, compression_level)
+		if len(compressed) < len(data) * (1 - min_compression_saving):
+			data = compressed
+			flags |= record_compressed
+
+	aead = worker.get("aead")
+	if aead:
+		data = aead.encrypt(get_nonce(prefix, index), data, header + record_aad.pack(flags, index))
+
+	return record_header.pack(flags, len(data)) + data
+
+class FileProcessor(object):
+	"""Process pool compressing and encrypting the uploads of one backup.
+
+	The processes are spawned, not forked: a fork copies the locks other
+	threads of the job hold, e.g. of the other sites `site_scheduler` backs
+	up, and a child waiting on one of them hangs. They only import this
+	module and run `process_record`."""
+	def __init__(self, key=None, compress=False, workers=0):
+		self.key = key
+		self.compress = compress
+		self.workers = workers or max(1, multiprocessing.cpu_count() // concurrent_backups)
+		self.pool = get_pool_context().Pool(self.workers, init_worker, (key,))
+
+	def reader(self, fp, compress=True):
+		"""`ProcessedReader` of `fp`, compressed only when the processor compresses and `compress`"""
+		return ProcessedReader(self, fp, self.compress and compress)
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+	def terminate(self):
+		self.pool.terminate()
+		self.pool.join()
+
+def get_pool_context():
+	# python 2 only forks
+	if hasattr(multiprocessing, "get_context"):
+		return multiprocessing.get_context("spawn")
+	return multiprocessing
+
+class ProcessedReader(object):
+	"""File object of the `.ftpz` output of `fp`, made in the processor's pool while it is read.
+
+	`sha256` and `source_size` are of the content read from `fp`."""
+	def __init__(self, processor, fp, compress):
+		self.processor = processor
+		self.fp = fp
+		self.compress = compress
+		self.prefix = os.urandom(8)
+		self.header = file_header.pack(processed_magic, file_encrypted if processor.key else 0, self.prefix)
+		self.buffer = self.header
+		self.pending = deque()
+		self.max_pending = processor.workers * max_pending_per_worker
+		self.index = 0
+		self.eof = False
+		self.sha256 = hashlib.sha256()
+		self.source_size = 0
+
+	def read(self, size=-1):
+		while (size < 0 or len(self.buffer) < size) and (self.pending or not self.eof):
+			self.fill()
+			self.buffer += self.pending.popleft().get(record_timeout)
+
+		if size < 0:
+			size = len(self.buffer)
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+
+	def fill(self):
+		"""Hand records to the pool until it holds `max_pending` of them"""
+		while not self.eof and len(self.pending) < self.max_pending:
+			data = self.fp.read(chunk_size)
+			if data:
+				self.sha256.update(data)
+				self.source_size += len(data)
+			else:
+				self.eof = True
+
+			self.pending.append(self.processor.pool.apply_async(process_record,
+				(self.header, self.prefix, self.index, data, self.compress, self.eof)))
+			self.index += 1
+
+	def hexdigest(self):
+		return self.sha256.hexdigest()
+
+class DecodingWriter(object):
+	"""Decodes the `.ftpz` content written to it, block by block, into `callback`.
+
+	`received` counts the bytes written, the offset to REST a dropped
+	download at. `close` raises ValueError when the last record is missing."""
+	def __init__(self, callback, key=None):
+		self.callback = callback
+		self.aead = AESGCM(key) if key and AESGCM else None
+		self.buffer = bytearray()
+		self.header = None
+		self.prefix = None
+		self.encrypted = False
+		self.index = 0
+		self.done = False
+		self.received = 0
+
+	def write(self, data):
+		self.received += len(data)
+		self.buffer.extend(data)
+
+		offset = 0
+		if self.header is None:
+			if len(self.buffer) < file_header.size:
+				return
+			self.read_header()
+			offset = file_header.size
+
+		while len(self.buffer) - offset >= record_header.size:
+			flags, length = record_header.unpack_from(self.buffer, offset)
+			end = offset + record_header.size + length
+			if len(self.buffer) < end:
+				break
+
+			if self.done:
+				raise ValueError("data after the last record")
+
+			self.callback(self.decode(flags, bytes(self.buffer[offset + record_header.size:end])))
+			self.done = bool(flags & record_last)
+			self.index += 1
+			offset = end
+
+		del self.buffer[:offset]
+
+	def read_header(self):
+		magic, flags, self.prefix = file_header.unpack_from(self.buffer)
+		if magic != processed_magic:
+			raise ValueError("not a compressed or encrypted backup file")
+
+		self.encrypted = bool(flags & file_encrypted)
+		if self.encrypted and not self.aead:
+			raise ValueError("the file is encrypted, set the Encryption Key of FTP Backup Settings to restore it")
+
+		self.header = bytes(self.buffer[:file_header.size])
+
+	def decode(self, flags, data):
+		if self.encrypted:
+			try:
+				data = self.aead.decrypt(get_nonce(self.prefix, self.index), data,
+					self.header + record_aad.pack(flags, self.index))
+			except InvalidTag:
+				raise ValueError("record {0} does not decrypt, wrong key or a damaged file".format(self.index))
+
+		if flags & record_compressed:
+			data = zlib.decompress(data)
+
+		return data
+
+	def close(self):
+		if not self.done or self.buffer:
+			raise ValueError("the file is truncated")
+
+class DecodingReader(object):
+	"""File object of the content of the `.ftpz` file object `fp`, e.g. for tarfile"""
+	def __init__(self, fp, key=None):
+		self.fp = fp
+		self.output = bytearray()
+		self.writer = DecodingWriter(self.output.extend, key)
+		self.eof = False
+
+	def read(self, size=-1):
+		while (size < 0 or len(self.output) < size) and not self.eof:
+			data = self.fp.read(chunk_size)
+			if data:
+				self.writer.write(data)
+			else:
+				self.writer.close()
+				self.eof = True
+
+		if size < 0:
+			size = len(self.output)
+		data = bytes(self.output[:size])
+		del self.output[:size]
+		return data
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""Restore a site from its FTP backup, see `bench ftp-restore`.
+
+The database dump is streamed from the FTP data connection through the
+decompressor into mysql, followed by the change sets of its chain when
+differential backups are on, while attachments download over several other
+sessions into `.part` files, continued with REST + RETR when a download or
+a whole restore was interrupted. Tar bundles are unpacked as they stream
+in, an attachment also stored on its own is taken from there. Attachments
+uploaded as delta patches are rebuilt from their restored base. Attachments
+the content manifest only links are copied from the restored file holding
+their content. Files stored compressed or encrypted as `.ftpz` are decoded
+while they download, see `pipeline`.
+"""
+
+from __future__ import unicode_literals
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import posixpath
+import frappe
+from frappe import _
+from six.moves.queue import Queue
+from frappe.utils import cint, encode, get_files_path
+from frappe.utils.background_jobs import enqueue
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import get_ftp_client, close_quietly, is_connection_error
+from intergation_ftp_backup.ftp_backup_intrgration.manifest import ContentManifest
+from intergation_ftp_backup.ftp_backup_intrgration.binlog import BackupChains, is_change_set
+from intergation_ftp_backup.ftp_backup_intrgration.delta import get_delta_folder, apply_delta
+from intergation_ftp_backup.ftp_backup_intrgration.settings import get_settings
+from intergation_ftp_backup.ftp_backup_intrgration.pipeline import (DecodingWriter, DecodingReader,
+	get_encryption_key, get_original_name, is_processed, processed_suffix)
+from intergation_ftp_backup.ftp_backup_intrgration.db_dump import (DumpRestore, get_compression,
+	is_compression_available)
+from intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings import (
+	get_backup_index, get_remote_index, combine_path)
+
+# the trees of `upload_from_folder`, relative to the backup root
+file_trees = (("files", 0), ("private/files", 1))
+
+# attempts per download, the first included
+download_attempts = 3
+
+@frappe.whitelist()
+def get_backups():
+	"""Database dumps, newest first, and the attachments on the FTP target"""
+	frappe.only_for("System Manager")
+
+	settings = get_settings()
+	ftp_client = get_ftp_client(settings.ftp_settings, settings.ftp_tls)
+	try:
+		return list_backups(ftp_client, ftp_client.abspath(settings.ftp_root_directory))
+	finally:
+		close_quietly(ftp_client)
+
+@frappe.whitelist()
+def restore(database=None, restore_database=1, restore_files=1):
+	"""Enqueue a restore of `database`, the newest dump when not given"""
+	frappe.only_for("System Manager")
+
+	enqueue("intergation_ftp_backup.ftp_backup_intrgration.restore.restore_backup", queue='long', timeout=6000,
+		database=database, restore_database=cint(restore_database), restore_files=cint(restore_files))
+	frappe.msgprint(_("Queued for restore. It may take a few minutes to an hour."))
+
+def list_backups(ftp_client, root_directory):
+	"""Full dumps newest first, each with the change sets of its chain, and the attachments"""
+	dumps = get_backup_index(ftp_client, combine_path(root_directory, "/database"))
+	databases = sorted([dump for dump in dumps.values()
+		if not dump.name.endswith('.part') and not is_change_set(dump.name)],
+		key=lambda dump: dump.name, reverse=True)
+
+	chains = BackupChains.load(ftp_client, combine_path(root_directory, "/chains.json"))
+	for dump in databases:
+		changes = chains.find(dump.name)[1]
+		dump.changes = [dumps[change["name"]] for change in changes if change["name"] in dumps]
+
+	trees = []
+	for folder, is_private in file_trees:
+		index = get_remote_index(ftp_client, combine_path(root_directory, folder))
+		trees.append(frappe._dict({
+			"folder": folder,
+			"files": len(index),
+			"size": sum(f.size or 0 for f in index.values())
+		}))
+
+	bundles = get_remote_index(ftp_client, combine_path(root_directory, "/bundles"))
+
+	return frappe._dict({
+		"databases": databases,
+		"files": trees,
+		"bundles": len([name for name in bundles if is_bundle(name)])
+	})
+
+def restore_backup(database=None, restore_database=1, restore_files=1, parallel_downloads=None):
+	"""Restore the database dump named `database`, the newest by default, and the attachments.
+
+	A full dump is restored with all change sets of its chain, a change set
+	with its full dump and the change sets up to it."""
+	settings = get_settings()
+	ftp_settings, use_tls, root_directory = settings.ftp_settings, settings.ftp_tls, settings.ftp_root_directory
+	if not ftp_settings['host']:
+		frappe.throw(_('No FTP host! Please enter valid host for FTP.'))
+
+	parallel_downloads = cint(parallel_downloads) or settings.parallel_uploads
+	key = get_encryption_key(settings.encryption_key) if settings.encryption_key else None
+
+	ftp_client = get_ftp_client(ftp_settings, use_tls)
+	pool = None
+	try:
+		root_directory = ftp_client.abspath(root_directory)
+
+		if restore_database and not database:
+			databases = list_backups(ftp_client, root_directory).databases
+			if not databases:
+				frappe.throw(_('No database backup found on the FTP server'))
+			database = databases[0].name
+
+		single_files = set()
+		if restore_files:
+			# the pool's sessions download while this one streams the dump
+			pool = DownloadPool(ftp_settings, use_tls, parallel_downloads, key)
+			single_files = download_files(ftp_client, root_directory, pool)
+
+		if restore_database:
+			ftp_client = restore_database_chain(ftp_client, root_directory, database, ftp_settings, use_tls, key)
+
+		if restore_files:
+			restore_bundles(ftp_client, root_directory, single_files, key)
+			pool.close()
+			failed = pool.failed + restore_deltas(ftp_client, root_directory)
+			restore_links(ftp_client, root_directory)
+
+			if failed:
+				frappe.throw(_('Could not download:\n{0}').format("\n".join(
+					"{0} - {1}".format(path, error) for path, error in failed)))
+	finally:
+		if pool:
+			pool.close()
+		close_quietly(ftp_client)
+
+	print ('restored, run bench migrate if the backup is from an older version of the apps')
+
+def restore_database_chain(ftp_client, root_directory, database, ftp_settings, use_tls, key=None):
+	"""Restore the full dump of `database`'s chain and its change sets up to `database`"""
+	chains = BackupChains.load(ftp_client, combine_path(root_directory, "/chains.json"))
+	chain, changes = chains.find(database)
+	if not chain and is_change_set(database):
+		frappe.throw(_('{0} is not listed in chains.json, its full dump is unknown').format(database))
+
+	names = [chain["base"] if chain else database] + [change["name"] for change in changes]
+	for name in names:
+		# one after the other, every change set continues where the one before ended
+		ftp_client = restore_dump(ftp_client, combine_path(root_directory, "/database/" + name),
+			ftp_settings, use_tls, key)
+
+	return ftp_client
+
+def restore_dump(ftp_client, path, ftp_settings, use_tls, key=None):
+	"""Stream the dump at `path` into mysql, returns the session to go on with"""
+	compression = get_compression(get_original_name(path))
+	if not is_compression_available(compression):
+		frappe.throw(_('Install zstandard to restore {0}').format(path))
+
+	print ('restoring', path)
+	dump = DumpRestore(compression)
+	# the decompressor carries on from the bytes it has, so a dropped
+	# connection is continued at `dump.size`, never from the start
+	write, get_offset = dump.write, lambda: dump.size
+	decoder = None
+	if is_processed(path):
+		# the offset on the server counts the encrypted bytes
+		decoder = DecodingWriter(dump.write, key)
+		write, get_offset = decoder.write, lambda: decoder.received
+
+	try:
+		ftp_client = download(ftp_client, path, write, get_offset, ftp_settings, use_tls)
+		if decoder:
+			decoder.close()
+	except Exception:
+		dump.kill()
+		raise
+
+	dump.close()
+	print ('restored', path, dump.size, 'bytes')
+
+	return ftp_client
+
+def download(ftp_client, path, callback, get_offset, ftp_settings, use_tls):
+	"""RETR `path` to `callback`, continuing with REST on a new session when the connection drops.
+
+	`get_offset` returns the bytes already received. Returns the session
+	used last, the one passed in when it never dropped."""
+	for attempt in range(download_attempts):
+		try:
+			if ftp_client is None:
+				ftp_client = get_ftp_client(ftp_settings, use_tls)
+
+			ftp_client.retrbinary('RETR ' + path, callback, ftp_client.block_size, get_offset() or None)
+			return ftp_client
+		except Exception as e:
+			if not is_connection_error(e) or attempt == download_attempts - 1:
+				raise
+
+			print ('connection lost, continuing', path, 'at', get_offset())
+			close_quietly(ftp_client)
+			ftp_client = None
+
+def download_files(ftp_client, root_directory, pool):
+	"""Hand the attachments stored on their own to `pool`, returns their paths relative to the root"""
+	single_files = set()
+	for folder, is_private in file_trees:
+		index = get_remote_index(ftp_client, combine_path(root_directory, folder))
+		for name, info in index.items():
+			if name.endswith('.part'):
+				continue
+
+			original = get_original_name(name)
+			other = index.get(original if is_processed(name) else name + processed_suffix)
+			if other and is_superseded(info, other):
+				continue
+
+			single_files.add(folder + "/" + original)
+
+			filepath = get_files_path(original, is_private=is_private)
+			# the size of a processed file on the target is not the attachment's
+			if is_processed(name) or get_local_size(filepath) != info.size:
+				pool.submit(combine_path(root_directory, folder + "/" + name), filepath)
+
+	return single_files
+
+def is_superseded(info, other):
+	"""Whether `other`, the same attachment stored plain or processed, was uploaded after `info`"""
+	if info.modify and other.modify:
+		return other.modify > info.modify
+
+	return is_processed(other.name)
+
+def is_bundle(name):
+	return get_original_name(name).endswith('.tar')
+
+def restore_bundles(ftp_client, root_directory, single_files, key=None):
+	"""Unpack the tar bundles, oldest first so a later bundle's copy of a file wins"""
+	bundles = get_remote_index(ftp_client, combine_path(root_directory, "/bundles"))
+	for name in sorted(bundles):
+		if is_bundle(name):
+			restore_bundle(ftp_client, combine_path(root_directory, "/bundles/" + name), single_files, key)
+
+def restore_bundle(ftp_client, path, single_files, key=None):
+	"""Unpack the tar at `path` while it is downloaded"""
+	print ('restoring bundle', path)
+	ftp_client.voidcmd('TYPE I')
+	conn = ftp_client.transfercmd('RETR ' + path)
+	try:
+		with conn.makefile('rb') as fp:
+			source = DecodingReader(fp, key) if is_processed(path) else fp
+			with tarfile.open(fileobj=source, mode="r|") as tar:
+				for member in tar:
+					filepath = get_local_path(member.name)
+					if not member.isfile() or not filepath or member.name in single_files:
+						continue
+
+					if get_local_size(filepath) != member.size:
+						write_file(tar.extractfile(member), filepath)
+
+			# read up to the end, a transfer closed early is answered with 426
+			while fp.read(ftp_client.block_size):
+				pass
+	finally:
+		conn.close()
+
+	ftp_client.voidresp()
+
+def restore_deltas(ftp_client, root_directory):
+	"""Patch the restored bases of the attachments uploaded as deltas since.
+
+	Returns (remote path, error) for every patch that could not be applied."""
+	failed = []
+	for folder, is_private in file_trees:
+		delta_folder = get_delta_folder(combine_path(root_directory, folder))
+		for name in get_remote_index(ftp_client, delta_folder):
+			filepath = get_local_path(folder + "/" + name[:-len(".delta")]) if name.endswith(".delta") else None
+			if not filepath or get_local_size(filepath) is None:
+				continue
+
+			path = combine_path(delta_folder, name)
+			try:
+				with tempfile.TemporaryFile() as patch:
+					ftp_client.retrbinary('RETR ' + path, patch.write)
+					patch.seek(0)
+					if not apply_delta(filepath, patch):
+						failed.append((path, 'the local file is not the base of the patch'))
+			except ValueError as e:
+				failed.append((path, e))
+
+	return failed
+
+def restore_links(ftp_client, root_directory):
+	"""Copy the attachments the manifest links to content stored under another name"""
+	manifest = ContentManifest.load(ftp_client, combine_path(root_directory, "/manifest.json"))
+
+	for path, digest in manifest.links.items():
+		obj = manifest.objects.get(digest)
+		filepath = get_local_path(posixpath.relpath(path, root_directory))
+		if not obj or not filepath or get_local_size(filepath) == obj["size"]:
+			continue
+
+		source = get_local_path(posixpath.relpath(obj["path"], root_directory))
+		if source and get_local_size(source) == obj["size"]:
+			shutil.copyfile(encode(source), encode(filepath))
+
+def get_local_path(path):
+	"""Site path of an attachment at `path` relative to the backup root, None for anything else"""
+	for folder, is_private in file_trees:
+		if path.startswith(folder + "/"):
+			name = path[len(folder) + 1:]
+			if name and "/" not in name and name not in (".", ".."):
+				return get_files_path(name, is_private=is_private)
+
+def get_local_size(filepath):
+	try:
+		return os.stat(encode(filepath)).st_size
+	except OSError:
+		return None
+
+def write_file(fp, filepath):
+	with open(encode(filepath + ".part"), 'wb') as f:
+		shutil.copyfileobj(fp, f)
+
+	os.rename(encode(filepath + ".part"), encode(filepath))
+
+class DownloadPool(object):
+	"""Download files over several FTP sessions sharing one work queue.
+
+	Each file goes to `<path>.part`, renamed once complete. A `.part` left
+	by an interrupted restore is continued from its size, except for a
+	processed file, decoded with `key` from the start again. Workers only talk
+	FTP and write files, errors are collected in `failed` as (remote path, error)."""
+	def __init__(self, ftp_settings, use_tls, size, key=None):
+		self.ftp_settings = ftp_settings
+		self.use_tls = use_tls
+		self.key = key
+		self.failed = []
+		self.lock = threading.Lock()
+
+		# unbounded, the listing is in memory anyway and the caller goes on with the dump
+		self.tasks = Queue()
+		self.workers = []
+
+		for i in range(size):
+			worker = threading.Thread(target=self.work, name="ftp-download-%s" % i)
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	def submit(self, path, filepath):
+		self.tasks.put((path, filepath))
+
+	def close(self):
+		for worker in self.workers:
+			self.tasks.put(None)
+
+		for worker in self.workers:
+			worker.join()
+
+		self.workers = []
+
+	def work(self):
+		ftp_client = None
+
+		while True:
+			task = self.tasks.get()
+			if task is None:
+				break
+
+			path, filepath = task
+			try:
+				ftp_client = self.download(ftp_client, path, filepath)
+			except Exception as e:
+				with self.lock:
+					self.failed.append((path, e))
+				close_quietly(ftp_client)
+				ftp_client = None
+
+		if ftp_client:
+			close_quietly(ftp_client)
+
+	def download(self, ftp_client, path, filepath):
+		part = encode(filepath + ".part")
+		if is_processed(path):
+			with open(part, 'wb') as f:
+				decoder = DecodingWriter(f.write, self.key)
+				ftp_client = download(ftp_client, path, decoder.write, lambda: decoder.received,
+					self.ftp_settings, self.use_tls)
+				decoder.close()
+
+			os.rename(part, encode(filepath))
+			return ftp_client
+
+		with open(part, 'ab') as f:
+			if f.tell():
+				print ('continuing', path, 'at', f.tell())
+			ftp_client = download(ftp_client, path, f.write, f.tell, self.ftp_settings, self.use_tls)
+
+		os.rename(part, encode(filepath))
+		return ftp_client
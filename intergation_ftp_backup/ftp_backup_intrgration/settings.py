@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""Read-only snapshot of `FTP Backup Settings`, loaded once per job.
+
+`get_settings` reads the Single with one query, normalizes every value
+and keeps the result in redis until `FTPBackupSettings.on_update` clears
+it, so the many jobs of a bench or of a sharded backup do not read the
+doctype again. The FTP password and the encryption key are never cached
+in redis, they are decrypted once per job and kept in that job's snapshot
+only.
+"""
+
+from __future__ import unicode_literals
+import frappe
+from collections import namedtuple
+from frappe.utils import cint
+from frappe.utils.password import get_decrypted_password
+
+settings_key = "ftp_backup_settings"
+
+# safety net for values written without `on_update`, e.g. `frappe.db.set_value`
+settings_expiry = 60 * 60
+
+setting_fields = ["enabled", "send_notifications_to", "send_email_for_successful_backup", "backup_frequency",
+	"file_backup", "incremental_file_backup", "reconciliation_interval", "upload_order", "private_files_first",
+	"limit_no_of_backups", "no_of_backups", "keep_backups_for_days", "max_backups_size", "stream_db_backup",
+	"db_backup_compression",
+	"differential_db_backup", "full_backup_interval",
+	"ftp_host", "ftp_port", "ftp_root_directory", "ftp_authentication", "ftp_username", "ftp_tls",
+	"parallel_uploads", "transport_backend", "files_per_shard", "deduplicate_files", "upload_block_size",
+	"auto_tune_block_size", "upload_verification", "keepalive_interval", "bundle_small_files",
+	"bundle_threshold", "bundle_size", "delta_upload", "delta_threshold", "compress_files", "encrypt_backups",
+	"processing_workers", "day_bandwidth_limit", "night_bandwidth_limit", "night_starts", "night_ends"]
+
+class BackupSettings(namedtuple("BackupSettings", setting_fields + ["ftp_password", "encryption_key"])):
+	"""Normalized `FTP Backup Settings`, sizes in the units of their fields"""
+	__slots__ = ()
+
+	@property
+	def ftp_settings(self):
+		"""Login of `get_ftp_client`"""
+		anonymous = self.ftp_authentication == 'Anonymous'
+		return {
+			"host": self.ftp_host,
+			"port": self.ftp_port,
+			"user": 'anonymous' if anonymous else self.ftp_username,
+			"passwd": '' if anonymous else self.ftp_password
+		}
+
+def get_settings():
+	"""The settings of the current job"""
+	if frappe.flags.ftp_backup_settings:
+		return frappe.flags.ftp_backup_settings
+
+	values = frappe.cache().get_value(settings_key)
+	if not values or set(values) != set(setting_fields):
+		values = load_settings()
+		frappe.cache().set_value(settings_key, values, expires_in_sec=settings_expiry)
+
+	password = None
+	if values["ftp_authentication"] != 'Anonymous':
+		password = get_decrypted_password("FTP Backup Settings", "FTP Backup Settings", "ftp_password",
+			raise_exception=False)
+
+	# also with encryption turned off, backups encrypted before are restored with it
+	encryption_key = get_decrypted_password("FTP Backup Settings", "FTP Backup Settings", "encryption_key",
+		raise_exception=False)
+
+	frappe.flags.ftp_backup_settings = BackupSettings(ftp_password=password, encryption_key=encryption_key, **values)
+	return frappe.flags.ftp_backup_settings
+
+def clear_settings_cache():
+	frappe.cache().delete_value(settings_key)
+	frappe.flags.ftp_backup_settings = None
+
+def load_settings():
+	"""Values of the Single with one query, defaults for the ones never saved"""
+	values = frappe.db.get_singles_dict("FTP Backup Settings")
+
+	def get_int(fieldname, default=0):
+		value = values.get(fieldname)
+		return cint(value) if value not in (None, '') else default
+
+	return {
+		"enabled": get_int("enabled"),
+		"send_notifications_to": values.get("send_notifications_to"),
+		"send_email_for_successful_backup": get_int("send_email_for_successful_backup", 1),
+		"backup_frequency": values.get("backup_frequency"),
+		"file_backup": get_int("file_backup", 1),
+		"incremental_file_backup": get_int("incremental_file_backup"),
+		"reconciliation_interval": get_int("reconciliation_interval") or 7,
+		"upload_order": values.get("upload_order") or "Name",
+		"private_files_first": get_int("private_files_first"),
+		"limit_no_of_backups": get_int("limit_no_of_backups"),
+		"no_of_backups": get_int("no_of_backups"),
+		"keep_backups_for_days": get_int("keep_backups_for_days"),
+		"max_backups_size": get_int("max_backups_size"),
+		"stream_db_backup": get_int("stream_db_backup"),
+		"db_backup_compression": values.get("db_backup_compression") or "gzip",
+		"differential_db_backup": get_int("differential_db_backup"),
+		"full_backup_interval": get_int("full_backup_interval") or 7,
+		"ftp_host": values.get("ftp_host"),
+		"ftp_port": get_int("ftp_port") or 21,
+		"ftp_root_directory": values.get("ftp_root_directory"),
+		"ftp_authentication": values.get("ftp_authentication") or "Login",
+		"ftp_username": values.get("ftp_username"),
+		"ftp_tls": get_int("ftp_tls"),
+		"parallel_uploads": max(get_int("parallel_uploads"), 1),
+		"transport_backend": values.get("transport_backend") or "ftplib",
+		"files_per_shard": get_int("files_per_shard"),
+		"deduplicate_files": get_int("deduplicate_files"),
+		"upload_block_size": get_int("upload_block_size") or 1024,
+		"auto_tune_block_size": get_int("auto_tune_block_size"),
+		"upload_verification": values.get("upload_verification") or "Checksum",
+		# 0 turns keepalives off
+		"keepalive_interval": get_int("keepalive_interval", 60),
+		"bundle_small_files": get_int("bundle_small_files"),
+		"bundle_threshold": get_int("bundle_threshold") or 256,
+		"bundle_size": get_int("bundle_size") or 64,
+		"delta_upload": get_int("delta_upload"),
+		"delta_threshold": get_int("delta_threshold") or 16,
+		"compress_files": get_int("compress_files"),
+		"encrypt_backups": get_int("encrypt_backups"),
+		"processing_workers": get_int("processing_workers"),
+		"day_bandwidth_limit": get_int("day_bandwidth_limit"),
+		"night_bandwidth_limit": get_int("night_bandwidth_limit"),
+		"night_starts": values.get("night_starts") or "22:00:00",
+		"night_ends": values.get("night_ends") or "06:00:00"
+	}
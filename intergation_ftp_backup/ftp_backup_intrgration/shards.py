@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""Backups split into RQ jobs, used when Files Per Shard Job is set.
+
+`coordinate_backup` resumes what earlier jobs left half uploaded, then
+plans the shards: one for the database, and one per `files_per_shard`
+unflagged `File` rows of each files folder, as a range of names. Every
+shard is enqueued as its own `take_backup_shard` job, so the long queue
+workers run them in parallel, each within the usual job timeout. Shard
+results are collected in redis and the shard finishing last sends one
+success or failure email for the whole backup.
+"""
+
+from __future__ import unicode_literals
+import frappe
+from frappe.utils.background_jobs import enqueue
+from rq.timeouts import JobTimeoutException
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import get_ftp_client
+from intergation_ftp_backup.ftp_backup_intrgration.backup_run import start_backup_run, get_backup_run
+from intergation_ftp_backup.ftp_backup_intrgration.settings import get_settings
+from intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings import (
+	backup_to_ftp, resume_interrupted_uploads, send_email, get_error_message,
+	get_transfer_options, get_folder_order, UploadStatusBuffer)
+
+# plans and results of a backup whose last shard never finishes, e.g. a killed worker, expire
+shards_expiry = 24 * 60 * 60
+
+def coordinate_backup():
+	settings = get_settings()
+	if not settings.enabled:
+		return
+
+	did_not_upload, error_log = [], []
+	run = start_backup_run()
+	run.shard = "coordinator"
+	try:
+		with run.phase("resume"):
+			did_not_upload, error_log = resume_backup(settings)
+		if did_not_upload: raise Exception
+
+		with run.phase("plan"):
+			shards = get_shards(settings.files_per_shard, settings.file_backup, settings.private_files_first)
+
+		run.backup_id = frappe.generate_hash(length=10)
+		enqueue_shards(run.backup_id, shards)
+		run.save("Success")
+	except Exception:
+		error_message = get_error_message(did_not_upload, error_log) + "\n" + frappe.get_traceback()
+		frappe.errprint(error_message)
+		run.save("Failed", error_message)
+		send_email(False, "FTP", error_message, settings)
+
+def resume_backup(settings):
+	"""Finish the uploads earlier jobs left half done, before shards start new ones"""
+	ftp_settings = settings.ftp_settings
+
+	if not ftp_settings['host']:
+		return 'Failed backup upload', 'No FTP host! Please enter valid host for FTP.'
+
+	if not ftp_settings['user']:
+		return 'Failed backup upload', 'No FTP username! Please enter valid username for FTP.'
+
+	run = get_backup_run()
+	ftp_client = get_ftp_client(ftp_settings, settings.ftp_tls, get_transfer_options(settings), settings.transport_backend)
+
+	did_not_upload = []
+	error_log = []
+	uploaded = UploadStatusBuffer()
+	try:
+		resume_interrupted_uploads(ftp_client, did_not_upload, error_log, uploaded)
+		uploaded.flush()
+	finally:
+		run.add_commands(ftp_client.command_stats)
+		ftp_client.quit()
+
+	return did_not_upload, list(set(error_log))
+
+def get_shards(shard_size, file_backup=1, private_files_first=0):
+	"""The database shard, plus the name ranges of `File` rows not uploaded yet.
+
+	Planned and enqueued in upload order, the database first. The first and
+	last range of a folder are left open, so rows added while the shards
+	wait in the queue are still picked up."""
+	shards = [{"label": "database", "db": 1}]
+	if not file_backup:
+		return shards
+
+	for is_private in get_folder_order(private_files_first):
+		ranges = []
+		last_name = None
+
+		while True:
+			filters = [["is_folder", "=", 0], ["is_private", "=", is_private], ["uploaded_to_dropbox", "=", 0]]
+			if last_name is not None:
+				filters.append(["name", ">", last_name])
+
+			names = [f.name for f in frappe.get_all("File", filters=filters, fields=["name"],
+				order_by="name asc", limit_page_length=shard_size)]
+			if not names:
+				break
+
+			ranges.append([names[0], names[-1]])
+			if len(names) < shard_size:
+				break
+
+			last_name = names[-1]
+
+		if ranges:
+			ranges[0][0] = None
+			ranges[-1][1] = None
+
+		for i, (first, last) in enumerate(ranges):
+			shards.append({
+				"label": "{0}-{1}".format("private-files" if is_private else "files", i + 1),
+				"db": 0,
+				"is_private": is_private,
+				"first": first,
+				"last": last
+			})
+
+	return shards
+
+def enqueue_shards(backup_id, shards):
+	cache = frappe.cache()
+	for shard_id, shard in enumerate(shards):
+		cache.hset(get_key(backup_id, "shards"), shard_id, shard)
+
+	for name in ("shards", "results"):
+		cache.expire(cache.make_key(get_key(backup_id, name)), shards_expiry)
+
+	for shard_id, shard in enumerate(shards):
+		enqueue("intergation_ftp_backup.ftp_backup_intrgration.shards.take_backup_shard",
+			queue='long', timeout=1500, backup_id=backup_id, shard_id=shard_id)
+
+def take_backup_shard(backup_id, shard_id, retry_count=0):
+	shard = frappe.cache().hget(get_key(backup_id, "shards"), shard_id)
+	if not shard:
+		frappe.log_error("Shard {0} of backup {1} ran after the backup expired".format(shard_id, backup_id),
+			"FTP Backup Shard")
+		return
+
+	shard = frappe._dict(shard)
+	settings = get_settings()
+	did_not_upload, error_log = [], []
+	run = start_backup_run(retry_count)
+	run.backup_id = backup_id
+	run.shard = shard.label
+	try:
+		did_not_upload, error_log = backup_to_ftp(shard.db, shard=shard, settings=settings)
+		if did_not_upload: raise Exception
+
+		run.save("Success")
+		finish_shard(backup_id, shard_id)
+	except JobTimeoutException:
+		run.save("Timed Out")
+		if retry_count < 2:
+			# what the shard uploaded stays flagged, the retry goes on from there
+			enqueue("intergation_ftp_backup.ftp_backup_intrgration.shards.take_backup_shard",
+				queue='long', timeout=1500, backup_id=backup_id, shard_id=shard_id, retry_count=retry_count + 1)
+		else:
+			finish_shard(backup_id, shard_id, "Timed out {0} times".format(retry_count + 1))
+	except Exception:
+		error_message = get_error_message(did_not_upload, error_log) + "\n" + frappe.get_traceback()
+		frappe.errprint(error_message)
+		run.save("Failed", error_message)
+		finish_shard(backup_id, shard_id, error_message)
+
+def finish_shard(backup_id, shard_id, error=None):
+	"""Record the result of a shard, the last one to finish sends the email"""
+	cache = frappe.cache()
+	cache.hset(get_key(backup_id, "results"), shard_id, error or "")
+
+	# INCR is atomic, exactly one shard sees the final count
+	done_key = cache.make_key(get_key(backup_id, "done"))
+	done = cache.incr(done_key)
+	cache.expire(done_key, shards_expiry)
+
+	shards = cache.hgetall(get_key(backup_id, "shards")) or {}
+	if done < len(shards):
+		return
+
+	results = cache.hgetall(get_key(backup_id, "results")) or {}
+	errors = ["{0}:\n{1}".format(shards[i]["label"], results[i])
+		for i in sorted(results, key=int) if results[i]]
+
+	try:
+		if errors:
+			send_email(False, "FTP", "\n\n".join(errors))
+		else:
+			send_email(True, "FTP")
+	finally:
+		cache.delete_key(get_key(backup_id, "shards"))
+		cache.delete_key(get_key(backup_id, "results"))
+		cache.delete(done_key)
+
+def get_key(backup_id, name):
+	return "ftp_backup_{0}:{1}".format(name, backup_id)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""Bench level FTP backups of many sites, see `bench ftp-backup-all-sites`.
+
+Sites are backed up on threads of one process, at most `concurrency` at a
+time, so they can share logged in FTP sessions per host. The sites
+expected to take longest start first, and starts are spaced `stagger`
+seconds apart so their database dumps do not all hit MySQL at once.
+"""
+
+from __future__ import unicode_literals
+import time
+import threading
+import frappe
+from frappe.utils import cint, flt
+from intergation_ftp_backup.ftp_backup_intrgration import pipeline
+from intergation_ftp_backup.ftp_backup_intrgration.ftp_client import ConnectionPool
+from intergation_ftp_backup.ftp_backup_intrgration.settings import get_settings
+from intergation_ftp_backup.ftp_backup_intrgration.doctype.ftp_backup_settings.ftp_backup_settings import take_backup_to_ftp
+
+def backup_sites(sites, frequency=None, concurrency=4, stagger=10):
+	"""Back up `sites` whose FTP backup is enabled, and set to `frequency` when given"""
+	plan = get_backup_plan(sites, frequency)
+	connection_pool = ConnectionPool(max_idle=concurrency)
+	slots = threading.BoundedSemaphore(concurrency)
+	threads = []
+
+	# the compression pools of the sites running at once share the cpus
+	pipeline.concurrent_backups = min(concurrency, len(plan)) or 1
+
+	try:
+		for i, site in enumerate(plan):
+			slots.acquire()
+			if i and stagger:
+				time.sleep(stagger)
+
+			print ('starting', site.name, 'expected', site.expected)
+			thread = threading.Thread(target=backup_site, args=(site.name, connection_pool, slots),
+				name="ftp-backup-" + site.name)
+			thread.start()
+			threads.append(thread)
+
+		for thread in threads:
+			thread.join()
+	finally:
+		connection_pool.close()
+		pipeline.concurrent_backups = 1
+
+def backup_site(site, connection_pool, slots):
+	try:
+		frappe.init(site=site)
+		frappe.connect()
+		take_backup_to_ftp(connection_pool=connection_pool)
+	except Exception:
+		print ('backup of', site, 'failed')
+		print (frappe.get_traceback())
+	finally:
+		frappe.destroy()
+		slots.release()
+
+def get_backup_plan(sites, frequency=None):
+	"""Sites to back up, longest expected first.
+
+	A site is expected to take as long as its last successful FTP Backup
+	Run. Sites without one go first, largest database and attachments first."""
+	plan = []
+	for site in sites:
+		try:
+			frappe.init(site=site)
+			frappe.connect()
+
+			settings = get_settings()
+			if not settings.enabled or (frequency and settings.backup_frequency != frequency):
+				continue
+
+			plan.append(frappe._dict({
+				"name": site,
+				"last_duration": get_last_duration(),
+				"size": get_site_size()
+			}))
+		except Exception:
+			print ('skipping', site)
+			print (frappe.get_traceback())
+		finally:
+			frappe.destroy()
+
+	for site in plan:
+		site.expected = "{0}s".format(int(site.last_duration)) if site.last_duration else "{0} MB".format(site.size // 1048576)
+
+	return sorted(plan, key=lambda site: (bool(site.last_duration), -(site.last_duration or site.size)))
+
+def get_last_duration():
+	if not frappe.db.table_exists("FTP Backup Run"):
+		return None
+
+	duration = frappe.db.get_value("FTP Backup Run", {"status": "Success"}, "duration", order_by="creation desc")
+	return flt(duration) or None
+
+def get_site_size():
+	"""Bytes of database data plus attachments"""
+	db_size = frappe.db.sql("""select sum(data_length + index_length) from information_schema.tables
+		where table_schema=%s""", frappe.conf.db_name)[0][0]
+	files_size = frappe.db.sql("""select sum(file_size) from `tabFile` where is_folder=0""")[0][0]
+
+	return cint(db_size) + cint(files_size)
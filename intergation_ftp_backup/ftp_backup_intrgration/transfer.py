@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import time
+import threading
+from datetime import datetime
+
+# largest block the auto tuner grows to
+max_block_size = 16 * 1024 * 1024
+
+class BandwidthSchedule(object):
+	"""Bytes per second allowed now, from a day and a night profile.
+
+	The night window may wrap around midnight. A rate of 0 means no limit.
+	`timezone` is resolved by the caller, so worker threads never need the
+	frappe connection to tell day from night.
+	"""
+	def __init__(self, day_rate, night_rate, night_starts, night_ends, timezone=None):
+		self.day_rate = day_rate
+		self.night_rate = night_rate
+		self.night_starts = night_starts
+		self.night_ends = night_ends
+		self.timezone = timezone
+
+	def is_night(self, now=None):
+		now = now or datetime.now(self.timezone).time()
+		if self.night_starts <= self.night_ends:
+			return self.night_starts <= now < self.night_ends
+
+		return now >= self.night_starts or now < self.night_ends
+
+	def rate(self, now=None):
+		return self.night_rate if self.is_night(now) else self.day_rate
+
+class TokenBucket(object):
+	"""Caps the bytes per second sent over all the sessions sharing it.
+
+	Holds at most one second worth of tokens. A block larger than what is
+	available is sent anyway and the sender sleeps off the debt, so the
+	average rate holds for any block size. The rate is read from the
+	schedule on every call, a run going past night starts speeds up.
+	"""
+	def __init__(self, schedule):
+		self.schedule = schedule
+		self.tokens = 0
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+	def consume(self, size):
+		wait = self.reserve(size)
+		if wait:
+			time.sleep(wait)
+
+	def reserve(self, size):
+		"""Takes `size` bytes worth of tokens, returns the seconds to wait before sending more"""
+		with self.lock:
+			now = time.time()
+			rate = self.schedule.rate()
+			if not rate:
+				self.tokens = 0
+				self.updated = now
+				return 0
+
+			self.tokens = min(self.tokens + (now - self.updated) * rate, rate) - size
+			self.updated = now
+
+			return -self.tokens / float(rate) if self.tokens < 0 else 0
+
+class BlockSizeTuner(object):
+	"""Grows the block size of one session while the throughput keeps improving.
+
+	Throughput is measured over `window` blocks, without the time spent
+	waiting on the bandwidth cap. The size doubles after a window faster
+	than the best so far by `min_gain`. Otherwise it goes back to the best
+	size and stays there for the rest of the session.
+	"""
+	def __init__(self, size, max_size=max_block_size, window=8, min_gain=0.05):
+		self.size = size
+		self.max_size = max_size
+		self.window = window
+		self.min_gain = min_gain
+		self.best_size = size
+		self.best = None
+		self.settled = False
+		self.reset_window()
+
+	def reset_window(self):
+		self.blocks = 0
+		self.bytes = 0
+		self.seconds = 0
+
+	def sample(self, size, seconds):
+		if self.settled:
+			return
+
+		self.blocks += 1
+		self.bytes += size
+		self.seconds += seconds
+		if self.blocks < self.window:
+			return
+
+		throughput = self.bytes / max(self.seconds, 1e-6)
+		self.reset_window()
+
+		if self.best is None or throughput > self.best * (1 + self.min_gain):
+			self.best = throughput
+			self.best_size = self.size
+			if self.size * 2 <= self.max_size:
+				self.size *= 2
+			else:
+				self.settled = True
+		else:
+			self.size = self.best_size
+			self.settled = True
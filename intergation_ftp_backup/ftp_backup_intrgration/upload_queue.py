@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+"""Order in which a run uploads the attachments not flagged yet.
+
+The database backup always goes first. The files folders follow, the
+private one first with Private Files First, each in its Upload Order: by
+name, newest first, or smallest first for the most files saved in a short
+window. Incremental runs go by modification time, see `watermark`.
+
+The last row a scan handed out is kept in redis as the folder's cursor. A
+retried job starts right after it and scans the rows before it last, so it
+goes on with the files the timed out job never reached before it retries
+the ones that failed. A run that is not a retry starts at the top of the
+order, writing over the cursor a failed run left. A completed scan drops
+the cursor.
+"""
+
+from __future__ import unicode_literals
+import frappe
+
+queue_key = "ftp_backup_queue"
+
+# cursors of scans that are never completed, e.g. of a shard whose retries ran out, expire
+queue_expiry = 7 * 24 * 60 * 60
+
+# sort expression and direction per Upload Order, ties go by name the same way
+upload_orders = {
+	"Name": ("name", "asc"),
+	"Newest First": ("creation", "desc"),
+	"Smallest First": ("ifnull(file_size, 0)", "asc")
+}
+
+class UploadQueue(object):
+	"""`File` rows of one files folder not uploaded yet, in `order`, resumable.
+
+	Keyset paginated on the sort expression and `name`, so rows flagged
+	as uploaded while the scan runs do not shift the next page. `name_range`
+	limits it to names between its first and last, inclusive, None leaving
+	that end open. The saved cursor is continued from only when `resume`."""
+	def __init__(self, is_private, order=None, name_range=None, page_length=500, resume=False):
+		self.is_private = is_private
+		self.resume = resume
+		self.order = order if order in upload_orders else "Name"
+		self.name_range = name_range or (None, None)
+		self.page_length = page_length
+		self.field = "{0}:{1}:{2}".format(is_private, self.name_range[0] or "", self.name_range[1] or "")
+
+	def __iter__(self):
+		cursor = self.load() if self.resume else None
+		for f in self.scan(start=cursor):
+			yield f
+
+		if cursor:
+			# the rows up to the cursor, what the last job failed on or left queued
+			for f in self.scan(stop=cursor):
+				yield f
+
+		self.clear()
+
+	def scan(self, start=None, stop=None):
+		"""Rows after `start` up to and including `stop`, both (sort value, name) positions"""
+		expression, direction = upload_orders[self.order]
+		after, before = (">", "<") if direction == "asc" else ("<", ">")
+
+		conditions = ["is_folder=0", "is_private=%(is_private)s", "uploaded_to_dropbox=0"]
+		values = {"is_private": self.is_private, "page_length": self.page_length}
+		if self.name_range[0] is not None:
+			conditions.append("name >= %(first)s")
+			values["first"] = self.name_range[0]
+		if self.name_range[1] is not None:
+			conditions.append("name <= %(last)s")
+			values["last"] = self.name_range[1]
+		if stop:
+			conditions.append("({0}, name) {1}= (%(stop_value)s, %(stop_name)s)".format(expression, before))
+			values["stop_value"], values["stop_name"] = stop
+
+		position = start
+		while True:
+			page_conditions = list(conditions)
+			if position:
+				page_conditions.append("({0}, name) {1} (%(value)s, %(name)s)".format(expression, after))
+				values["value"], values["name"] = position
+
+			files = frappe.db.sql("""select name, file_url, file_name, is_private, {0} as sort_value
+				from `tabFile`
+				where {1}
+				order by {0} {2}, name {2}
+				limit %(page_length)s""".format(expression, " and ".join(page_conditions), direction),
+				values, as_dict=True)
+
+			for f in files:
+				yield f
+
+			if len(files) < self.page_length:
+				break
+
+			position = (files[-1].sort_value, files[-1].name)
+			if not stop:
+				self.save(position)
+
+	def load(self):
+		cursor = frappe.cache().hget(queue_key, self.field)
+		if not cursor or cursor.get("order") != self.order:
+			return None
+
+		return tuple(cursor["position"])
+
+	def save(self, position):
+		cache = frappe.cache()
+		cache.hset(queue_key, self.field, {"order": self.order, "position": position})
+		cache.expire(cache.make_key(queue_key), queue_expiry)
+
+	def clear(self):
+		frappe.cache().hdel(queue_key, self.field)
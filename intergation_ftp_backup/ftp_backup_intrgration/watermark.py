@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import json
+import hashlib
+import frappe
+from frappe.utils import cint, cstr, encode, get_datetime, now_datetime, add_days
+
+class FileWatermark(object):
+	"""High-water mark of the `File` rows handled by incremental runs, per FTP target.
+
+	Kept as a global default. There is one (modified, name) position per
+	`is_private` folder. Every row handed out by the scan is pending until it
+	is settled with `done` or `failed`. The saved position never moves past a
+	row that failed or is still pending, so a timed out or partly failed run
+	scans those rows again next time.
+	"""
+	def __init__(self, target):
+		self.key = "ftp_backup_watermark:" + hashlib.md5(encode(target)).hexdigest()
+		data = json.loads(frappe.db.get_global(self.key) or "{}")
+
+		self.reconciled_on = data.get("reconciled_on")
+		self.positions = {}
+		for is_private in (0, 1):
+			position = data.get(cstr(is_private))
+			self.positions[is_private] = (get_datetime(position[0]), position[1]) if position else None
+
+		self.scanned = dict(self.positions)
+		self.held = {0: None, 1: None}
+		self.pending = {}
+
+	def needs_reconciliation(self, interval_days):
+		"""Whether this run should use the flag based full scan instead"""
+		if not all(self.positions.values()) or not self.reconciled_on:
+			return True
+
+		return get_datetime(self.reconciled_on) <= add_days(now_datetime(), -cint(interval_days))
+
+	def track(self, f):
+		self.pending[f.name] = (f.is_private, self.scanned[f.is_private])
+		self.scanned[f.is_private] = (f.modified, f.name)
+
+	def done(self, file_name):
+		self.pending.pop(file_name, None)
+
+	def failed(self, file_name):
+		if file_name not in self.pending:
+			return
+
+		is_private, previous = self.pending.pop(file_name)
+		if previous and (not self.held[is_private] or previous < self.held[is_private]):
+			self.held[is_private] = previous
+
+	def position(self, is_private):
+		candidates = [self.scanned[is_private], self.held[is_private]]
+		candidates += [previous for folder, previous in self.pending.values() if folder == is_private]
+
+		candidates = [c for c in candidates if c]
+		return min(candidates) if candidates else None
+
+	def reconciled(self, positions):
+		"""Restart from `positions`, taken before a full flag based scan"""
+		self.scanned = dict(positions)
+		self.held = {0: None, 1: None}
+		self.pending = {}
+		self.reconciled_on = now_datetime()
+
+	def save(self):
+		data = {"reconciled_on": cstr(self.reconciled_on) if self.reconciled_on else None}
+		for is_private in (0, 1):
+			position = self.position(is_private)
+			data[cstr(is_private)] = [cstr(position[0]), position[1]] if position else None
+
+		frappe.db.set_global(self.key, json.dumps(data))
+
+def get_latest_positions():
+	"""(modified, name) of the newest `File` row per `is_private`"""
+	positions = {}
+	for is_private in (0, 1):
+		latest = frappe.db.sql("""select modified, name from `tabFile`
+			where is_folder=0 and is_private=%s
+			order by modified desc, name desc limit 1""", is_private)
+
+		# an empty folder starts at the beginning of time
+		positions[is_private] = tuple(latest[0]) if latest else (get_datetime("1900-01-01"), "")
+
+	return positions
+
+def get_files_modified_since(is_private, position, page_length=500):
+	"""Yields `File` rows past `position`, keyset paginated on (modified, name)"""
+	modified, name = position
+
+	while True:
+		files = frappe.db.sql("""select name, file_url, file_name, modified, is_private
+			from `tabFile`
+			where is_folder=0 and is_private=%(is_private)s
+				and (modified > %(modified)s or (modified = %(modified)s and name > %(name)s))
+			order by modified asc, name asc
+			limit %(page_length)s""", {
+				"is_private": is_private,
+				"modified": modified,
+				"name": name,
+				"page_length": page_length
+			}, as_dict=True)
+
+		for f in files:
+			yield f
+
+		if len(files) < page_length:
+			break
+
+		modified, name = files[-1].modified, files[-1].name